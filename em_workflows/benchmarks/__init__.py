@@ -0,0 +1,5 @@
+"""
+Benchmarks used to calibrate the performance related parameters of the workflows.
+
+Each module can be run with ``python -m em_workflows.benchmarks.<module> --help``.
+"""
@@ -0,0 +1,138 @@
+"""
+Calibration benchmark of the bioformats2raw conversion parameters.
+
+Converts an input with each combination of bioformats2raw worker count, JVM heap size
+and number of concurrent conversions, reporting the wall time and peak memory of the
+runs, along with the values chosen by ``neuroglancer.bioformats_resources`` on the
+current machine or allocation. Run it on a node of the partition used by the workflows,
+eg::
+
+    python -m em_workflows.benchmarks.bioformats input.czi --workers 5 10 20 60
+    --heap-mb 4096 16384 --concurrent 1 2
+"""
+import argparse
+import itertools
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from em_workflows.config import Config
+from em_workflows.utils import neuroglancer as ng
+
+
+def run_bioformats2raw(
+    input_fp: Path, output_zarr: Path, max_workers: int, heap_mb: int
+) -> Dict:
+    """
+    Runs a single conversion with the same options as the workflows.
+
+    :return: dict with the wall time in seconds, and the peak resident memory in MB of
+      the conversion
+    """
+    cmd = [
+        Config.bioformats2raw,
+        f"--max_workers={max_workers}",
+        "--overwrite",
+        "--compression",
+        "blosc",
+        "--compression-properties",
+        "cname=zstd",
+        "--compression-properties",
+        "clevel=5",
+        "--compression-properties",
+        "shuffle=1",
+        input_fp.as_posix(),
+        output_zarr.as_posix(),
+    ]
+    env = os.environ | {"JAVA_OPTS": f"{Config.java_opts} -Xmx{heap_mb}m"}
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env
+    )
+    _, status, rusage = os.wait4(p.pid, 0)
+    wall_s = time.perf_counter() - start
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        raise RuntimeError(f"Failed to run command: {' '.join(cmd)}")
+    # ru_maxrss is in KB on linux
+    return dict(wall_s=wall_s, max_rss_mb=rusage.ru_maxrss / 1024)
+
+
+def benchmark(
+    input_fp: Path,
+    workers: List[int],
+    heaps_mb: List[int],
+    concurrents: List[int],
+    scratch_dir: Path,
+) -> List[Dict]:
+    """
+    Runs ``concurrent`` simultaneous conversions for each combination of the parameters.
+
+    :return: one result dict per combination, with the mean wall time and the maximum
+      peak memory of the runs
+    """
+    results = list()
+    for max_workers, heap_mb, concurrent in itertools.product(
+        workers, heaps_mb, concurrents
+    ):
+        with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp_dir:
+            outputs = [Path(tmp_dir) / f"run{i}.zarr" for i in range(concurrent)]
+            with ThreadPoolExecutor(max_workers=concurrent) as executor:
+                runs = list(
+                    executor.map(
+                        lambda out: run_bioformats2raw(
+                            input_fp, out, max_workers, heap_mb
+                        ),
+                        outputs,
+                    )
+                )
+        results.append(
+            dict(
+                max_workers=max_workers,
+                heap_mb=heap_mb,
+                concurrent=concurrent,
+                wall_s=sum(run["wall_s"] for run in runs) / concurrent,
+                max_rss_mb=max(run["max_rss_mb"] for run in runs),
+            )
+        )
+    return results
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", type=Path, help="input file to convert")
+    parser.add_argument("--workers", type=int, nargs="+", default=[5, 10, 20, 60])
+    parser.add_argument("--heap-mb", type=int, nargs="+", default=[4096, 16384, 40960])
+    parser.add_argument("--concurrent", type=int, nargs="+", default=[1])
+    parser.add_argument(
+        "--scratch-dir", type=Path, default=None, help="directory of the zarr outputs"
+    )
+    args = parser.parse_args(argv)
+
+    for concurrent in args.concurrent:
+        max_workers, heap_mb = ng.bioformats_resources(
+            args.input, concurrent=concurrent
+        )
+        print(
+            f"adaptive choice for {concurrent} concurrent: "
+            f"max_workers={max_workers} heap_mb={heap_mb}"
+        )
+
+    print("max_workers\theap_mb\tconcurrent\twall_s\tmax_rss_mb")
+    for result in benchmark(
+        args.input, args.workers, args.heap_mb, args.concurrent, args.scratch_dir
+    ):
+        print(
+            f"{result['max_workers']}\t{result['heap_mb']}\t{result['concurrent']}\t"
+            f"{result['wall_s']:.1f}\t{result['max_rss_mb']:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
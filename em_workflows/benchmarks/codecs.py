@@ -0,0 +1,233 @@
+"""
+Benchmark of the blosc compressors of the zarr outputs.
+
+Compresses the chunks of representative synthetic images of each pixel type produced by
+the workflows, or of a zarr array given with ``--zarr``, with each combination of blosc
+compressor, level and shuffle, and reports the compression ratio and the single thread
+compress and decompress throughputs. The compressor chosen by
+``neuroglancer.select_codec`` for each pixel type is marked with a ``*``. Decompression
+speed governs the viewer latency, the ratio the storage and the copy time of the assets,
+eg::
+
+    python -m em_workflows.benchmarks.codecs --cnames zstd lz4 --clevels 1 3 5 --dtypes
+    uint8 uint16
+"""
+import argparse
+import itertools
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import numcodecs
+import numpy as np
+from numcodecs import Blosc
+
+from em_workflows.utils import neuroglancer as ng
+
+SHUFFLES = {
+    "noshuffle": Blosc.NOSHUFFLE,
+    "shuffle": Blosc.SHUFFLE,
+    "bitshuffle": Blosc.BITSHUFFLE,
+}
+
+
+def _smooth_noise(
+    rng: np.random.Generator, shape: Tuple[int, ...], scale: int
+) -> np.ndarray:
+    """
+    :return: random structure varying over ``scale`` pixels, in [0, 1]
+    """
+    coarse = rng.random([-(-size // scale) + 1 for size in shape])
+    for axis, size in enumerate(shape):
+        # linear interpolation of the coarse grid along the axis
+        pos = np.arange(size) / scale
+        idx = pos.astype(int)
+        weight = (pos - idx).reshape(
+            [-1 if a == axis else 1 for a in range(len(shape))]
+        )
+        coarse = (
+            np.take(coarse, idx, axis=axis) * (1 - weight)
+            + np.take(coarse, idx + 1, axis=axis) * weight
+        )
+    return coarse
+
+
+def synthetic_images(
+    size: int = 1024, depth: int = 64, seed: int = 0
+) -> Dict[str, np.ndarray]:
+    """
+    :return: synthetic images indexed by name: an RGB brightfield slide with a white
+      background (uint8, y x c), a sparse 12-bit fluorescence image (uint16), an 8-bit
+      EM image, and a float32 tomogram (z y x) with noise
+    """
+    rng = np.random.default_rng(seed)
+    tissue = _smooth_noise(rng, (size, size), 64)
+    stain = _smooth_noise(rng, (size, size), 8)
+    slide = 255 - (tissue > 0.5)[..., None] * stain[..., None] * np.array([80, 160, 60])
+    slide = np.clip(slide + rng.normal(0, 4, slide.shape), 0, 255).astype(np.uint8)
+
+    cells = np.clip(_smooth_noise(rng, (size, size), 16) - 0.7, 0, None) / 0.3
+    fluorescence = rng.poisson(100 + 3000 * cells).clip(0, 4095).astype(np.uint16)
+
+    em = np.clip(
+        128
+        + 60 * (_smooth_noise(rng, (size, size), 32) - 0.5)
+        + rng.normal(0, 20, (size, size)),
+        0,
+        255,
+    )
+
+    structure = _smooth_noise(rng, (depth, size // 2, size // 2), 16)
+    tomogram = (structure + rng.normal(0, 0.5, structure.shape)).astype(np.float32)
+    return dict(
+        rgb_slide=slide,
+        fluorescence=fluorescence,
+        em=em.astype(np.uint8),
+        tomogram=tomogram,
+    )
+
+
+def _chunks(image: np.ndarray, channels: int) -> Iterator[np.ndarray]:
+    """
+    Splits an image in the chunks planned by ``plan_chunks``, channels last for RGB
+    images.
+    """
+    shape = image.shape[:-1] if channels > 1 else image.shape
+    chunk_shape = ng.plan_chunks(shape, image.dtype, channels=channels, levels=1)[0]
+    for start in itertools.product(
+        *[range(0, size, chunk) for size, chunk in zip(shape, chunk_shape)]
+    ):
+        yield np.ascontiguousarray(
+            image[tuple(slice(s, s + c) for s, c in zip(start, chunk_shape))]
+        )
+
+
+def measure(
+    codec: numcodecs.abc.Codec, chunks: List[np.ndarray], min_time: float = 0.2
+) -> Dict:
+    """
+    Compresses and decompresses all the ``chunks`` repeatedly for at least ``min_time``
+    seconds each.
+
+    :return: dict with the compression ratio, and the compress and decompress
+      throughputs in MB/s of raw data
+    """
+    n_bytes = sum(chunk.nbytes for chunk in chunks)
+    encoded = [codec.encode(chunk) for chunk in chunks]
+    for original, data in zip(chunks, encoded):
+        if codec.decode(data) != original.tobytes():
+            raise RuntimeError(f"{codec} does not round trip")
+
+    def throughput(fn, items) -> float:
+        runs, start = 0, time.perf_counter()
+        while True:
+            for item in items:
+                fn(item)
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                return runs * n_bytes / elapsed / 2**20
+
+    return dict(
+        ratio=n_bytes / sum(len(data) for data in encoded),
+        compress_mbs=throughput(codec.encode, chunks),
+        decompress_mbs=throughput(codec.decode, encoded),
+    )
+
+
+def benchmark(
+    images: Dict[str, np.ndarray],
+    cnames: List[str],
+    clevels: List[int],
+    shuffles: List[str],
+    min_time: float = 0.2,
+) -> List[Dict]:
+    """
+    :return: one result dict per image and blosc configuration, ``selected`` is True for
+      the compressors chosen by ``select_codec``
+    """
+    results = list()
+    for name, image in images.items():
+        channels = image.shape[-1] if image.ndim == 3 and image.shape[-1] == 3 else 1
+        chunks = list(_chunks(image, channels))
+        selected = ng.select_codec(image.dtype).get_config()
+        for cname, clevel, shuffle in itertools.product(cnames, clevels, shuffles):
+            codec = Blosc(cname=cname, clevel=clevel, shuffle=SHUFFLES[shuffle])
+            config = codec.get_config()
+            result = measure(codec, chunks, min_time)
+            result.update(
+                image=name,
+                dtype=image.dtype.name,
+                cname=cname,
+                clevel=clevel,
+                shuffle=shuffle,
+                selected=all(
+                    config[k] == selected[k] for k in ("cname", "clevel", "shuffle")
+                ),
+            )
+            results.append(result)
+    return results
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--zarr",
+        default=None,
+        help="benchmark this zarr array rather than the synthetic images",
+    )
+    parser.add_argument(
+        "--dtypes",
+        nargs="+",
+        default=None,
+        help="only the synthetic images of these dtypes",
+    )
+    parser.add_argument(
+        "--size", type=int, default=1024, help="size of the synthetic images"
+    )
+    parser.add_argument(
+        "--cnames", nargs="+", default=["zstd", "lz4", "lz4hc", "blosclz", "zlib"]
+    )
+    parser.add_argument("--clevels", type=int, nargs="+", default=[1, 3, 5, 9])
+    parser.add_argument(
+        "--shuffles", nargs="+", choices=list(SHUFFLES), default=list(SHUFFLES)
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="seconds of each throughput measurement",
+    )
+    args = parser.parse_args(argv)
+
+    # single thread throughputs, the workflows compress many chunks concurrently
+    numcodecs.blosc.use_threads = False
+    if args.zarr:
+        import zarr
+
+        array = zarr.open_array(args.zarr, mode="r")
+        # a plane of the full resolution level, TCZYX
+        images = {
+            args.zarr: array[(0,) * (array.ndim - 2)] if array.ndim > 2 else array[:]
+        }
+    else:
+        images = synthetic_images(args.size)
+        if args.dtypes:
+            images = {
+                name: image
+                for name, image in images.items()
+                if image.dtype.name in args.dtypes
+            }
+
+    print("image\tdtype\tcname\tclevel\tshuffle\tratio\tcompress_MB/s\tdecompress_MB/s")
+    for r in benchmark(images, args.cnames, args.clevels, args.shuffles, args.min_time):
+        print(
+            f"{r['image']}\t{r['dtype']}\t{r['cname']}\t{r['clevel']}\t"
+            f"{r['shuffle']}{' *' if r['selected'] else ''}\t"
+            f"{r['ratio']:.2f}\t{r['compress_mbs']:.0f}\t{r['decompress_mbs']:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
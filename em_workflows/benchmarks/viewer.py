@@ -0,0 +1,453 @@
+"""
+Read benchmark of zarr assets, replaying the chunk requests of a Neuroglancer viewer.
+
+Opens a zarr produced by any of the workflows (eg ``gen_zarr``,
+``generate_czi_imageset``), zarr v2 or sharded zarr v3 (see ``utils.sharding``), and
+replays a seeded sequence of views as Neuroglancer issues them: 2D cross-sections of a
+viewport, zooming in from the lowest resolution level down to the full resolution,
+followed by random pans at each zoom level. The chunks of a view are fetched
+concurrently, as the browser does, and decoded with the codec of the array. Chunks
+already fetched are not fetched again, as with the viewer's chunk cache. Chunks of
+sharded arrays are read with range requests, after a request of the index of their
+shard.
+
+The chunks are read from the local filesystem, or over HTTP from a local stand-in server
+of the zarr directory (with an optional delay per request to emulate the network), or
+from the ``--url`` of a running server. Chunk fetch counts, bytes, and the latency
+percentiles of the chunks and of the views are reported, eg::
+
+    python -m em_workflows.benchmarks.viewer sample.zarr --backend http --delay-ms 20
+    --concurrency 6
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numcodecs
+import numpy as np
+
+from em_workflows.utils.sharding import EMPTY_CHUNK
+
+# a view reads the chunks of these TCZYX index ranges (start, stop) of a level
+View = Tuple[str, Tuple[Tuple[int, int], ...]]
+# fetches the bytes of a key, or the size bytes from start (the last -start bytes if
+# start is negative), None if missing
+Fetch = Callable[..., Optional[bytes]]
+_BLOSC_SHUFFLE = {
+    "noshuffle": numcodecs.Blosc.NOSHUFFLE,
+    "shuffle": numcodecs.Blosc.SHUFFLE,
+    "bitshuffle": numcodecs.Blosc.BITSHUFFLE,
+}
+
+
+class _Level:
+    """
+    Metadata of a zarr v2 array, or of a zarr v3 array which may be sharded, of a
+    multiscale group.
+    """
+
+    def __init__(self, array_fp: Path, path: str) -> None:
+        self.path = path
+        self.shards = None
+        self.index_fetches = 0
+        self._shard_indexes = dict()
+        self._lock = threading.Lock()
+        if (array_fp / "zarr.json").is_file():
+            meta = json.loads((array_fp / "zarr.json").read_text())
+            self.shape = tuple(meta["shape"])
+            codecs = meta["codecs"]
+            grid_shape = tuple(meta["chunk_grid"]["configuration"]["chunk_shape"])
+            if codecs[0]["name"] == "sharding_indexed":
+                self.shards = grid_shape
+                self.chunks = tuple(codecs[0]["configuration"]["chunk_shape"])
+                codecs = codecs[0]["configuration"]["codecs"]
+            else:
+                self.chunks = grid_shape
+            encoding = meta["chunk_key_encoding"]
+            default_separator = "/" if encoding["name"] == "default" else "."
+            self.separator = encoding.get("configuration", {}).get(
+                "separator", default_separator
+            )
+            self.key_prefix = "c/" if encoding["name"] == "default" else ""
+            blosc = [
+                codec["configuration"] for codec in codecs if codec["name"] == "blosc"
+            ]
+            self.codec = (
+                numcodecs.Blosc(
+                    cname=blosc[0]["cname"],
+                    clevel=blosc[0]["clevel"],
+                    shuffle=_BLOSC_SHUFFLE[blosc[0]["shuffle"]],
+                    blocksize=blosc[0].get("blocksize", 0),
+                )
+                if blosc
+                else None
+            )
+        else:
+            meta = json.loads((array_fp / ".zarray").read_text())
+            self.shape = tuple(meta["shape"])
+            self.chunks = tuple(meta["chunks"])
+            self.separator = meta.get("dimension_separator", ".")
+            self.key_prefix = ""
+            self.codec = (
+                numcodecs.get_codec(meta["compressor"])
+                if meta.get("compressor")
+                else None
+            )
+
+    def chunk_indices(
+        self, ranges: Tuple[Tuple[int, int], ...]
+    ) -> List[Tuple[int, ...]]:
+        """
+        :return: indices of the chunks intersecting the index ``ranges``, one (start,
+          stop) per dimension
+        """
+        chunk_ranges = [
+            range(start // chunk, (stop - 1) // chunk + 1)
+            for (start, stop), chunk in zip(ranges, self.chunks)
+        ]
+        return list(product(*chunk_ranges))
+
+    def _key(self, idx: Tuple[int, ...]) -> str:
+        return f"{self.path}/{self.key_prefix}" + self.separator.join(
+            str(i) for i in idx
+        )
+
+    def _shard_index(
+        self, fetch: Fetch, key: str, per_shard: List[int]
+    ) -> Optional[np.ndarray]:
+        with self._lock:
+            if key in self._shard_indexes:
+                return self._shard_indexes[key]
+        data = fetch(key, -16 * int(np.prod(per_shard)))
+        index = (
+            None
+            if data is None
+            else np.frombuffer(data, dtype="<u8").reshape(per_shard + [2])
+        )
+        with self._lock:
+            self.index_fetches += 1
+            self._shard_indexes[key] = index
+        return index
+
+    def read_chunk(self, fetch: Fetch, idx: Tuple[int, ...]) -> Optional[bytes]:
+        """
+        :return: the encoded chunk at ``idx``, or None if it is not stored. The index of
+          a shard is fetched once.
+        """
+        if self.shards is None:
+            return fetch(self._key(idx))
+        per_shard = [shard // chunk for shard, chunk in zip(self.shards, self.chunks)]
+        key = self._key(tuple(i // n for i, n in zip(idx, per_shard)))
+        index = self._shard_index(fetch, key, per_shard)
+        if index is None:
+            return None
+        offset, nbytes = index[tuple(i % n for i, n in zip(idx, per_shard))].tolist()
+        if offset == EMPTY_CHUNK:
+            return None
+        return fetch(key, offset, nbytes)
+
+
+def _multiscale_levels(zarr_fp: Path) -> List[_Level]:
+    """
+    :return: the levels, from full resolution, of the first multiscale image found in
+      ``zarr_fp``, which may be the root of a bioformats2raw layout zarr or the
+      multiscale group itself
+    """
+    for group_fp in [zarr_fp] + sorted(
+        p.parent for p in zarr_fp.glob("*/*") if p.name in (".zattrs", "zarr.json")
+    ):
+        if (group_fp / "zarr.json").is_file():
+            attrs = json.loads((group_fp / "zarr.json").read_text()).get(
+                "attributes", {}
+            )
+            # OME-NGFF 0.5
+            attrs = attrs.get("ome", attrs)
+        elif (group_fp / ".zattrs").is_file():
+            attrs = json.loads((group_fp / ".zattrs").read_text())
+        else:
+            continue
+        multiscales = attrs.get("multiscales")
+        if multiscales:
+            prefix = group_fp.relative_to(zarr_fp).as_posix()
+            return [
+                _Level(
+                    group_fp / ds["path"],
+                    ds["path"] if prefix == "." else f"{prefix}/{ds['path']}",
+                )
+                for ds in multiscales[0]["datasets"]
+            ]
+    raise RuntimeError(f"No multiscale image found in {zarr_fp}")
+
+
+def gen_views(
+    levels: List[_Level], viewport: Tuple[int, int], pans: int, seed: int = 0
+) -> Iterator[View]:
+    """
+    Generates the views of a session: a cross-section of the ``viewport`` (in screen
+    pixels, width and height) zoomed in from the lowest resolution level to the full
+    resolution around a random point, with ``pans`` random pans of up to half a viewport
+    at each level. Volumes are viewed on XY, XZ and YZ planes in turn.
+
+    :return: iterator of the level path and TCZYX index ranges of each view
+    """
+    rng = random.Random(seed)
+    _, channels, depth, height, width = levels[0].shape
+    center = [rng.randrange(depth), rng.randrange(height), rng.randrange(width)]
+    planes = [(1, 2), (0, 2), (0, 1)] if depth > 1 else [(1, 2)]
+    for level_idx in reversed(range(len(levels))):
+        level = levels[level_idx]
+        for pan in range(pans + 1):
+            plane = planes[pan % len(planes)]
+            if pan:
+                for axis, size in zip(plane, viewport[::-1]):
+                    center[axis] += rng.randint(-size // 2, size // 2) * 2**level_idx
+                    center[axis] = min(
+                        max(center[axis], 0), levels[0].shape[2 + axis] - 1
+                    )
+            ranges = [(0, 1), (0, channels)]
+            for axis in range(3):
+                size = level.shape[2 + axis]
+                pos = min(center[axis] * size // levels[0].shape[2 + axis], size - 1)
+                if axis in plane:
+                    half = viewport[::-1][plane.index(axis)] // 2
+                    ranges.append((max(0, pos - half), min(size, pos + half)))
+                else:
+                    ranges.append((pos, pos + 1))
+            yield level.path, tuple(ranges)
+
+
+def fs_fetcher(zarr_fp: Path) -> Fetch:
+    def fetch(key: str, start: int = None, size: int = None) -> Optional[bytes]:
+        try:
+            with open(zarr_fp / key, "rb") as f:
+                if start is not None:
+                    f.seek(start, 2 if start < 0 else 0)
+                return f.read(-1 if size is None else size)
+        except FileNotFoundError:
+            return None
+
+    return fetch
+
+
+def http_fetcher(base_url: str) -> Fetch:
+    def fetch(key: str, start: int = None, size: int = None) -> Optional[bytes]:
+        request = urllib.request.Request(f"{base_url.rstrip('/')}/{key}")
+        if start is not None:
+            byte_range = (
+                f"{start}"
+                if start < 0
+                else f"{start}-{'' if size is None else start + size - 1}"
+            )
+            request.add_header("Range", f"bytes={byte_range}")
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    return fetch
+
+
+class _DelayedHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler, with single range requests (used to read shards) and a delay
+    per request.
+    """
+
+    delay_s = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay_s)
+        byte_range = self.headers.get("Range")
+        if byte_range is None:
+            return super().do_GET()
+        fp = Path(self.translate_path(self.path))
+        if not fp.is_file():
+            return self.send_error(404)
+        file_size = fp.stat().st_size
+        start, end = byte_range.removeprefix("bytes=").split("-")
+        if start:
+            start, end = (
+                int(start),
+                min(int(end), file_size - 1) if end else file_size - 1,
+            )
+        else:
+            start, end = max(0, file_size - int(end)), file_size - 1
+        with open(fp, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer:
+    """
+    Local HTTP server of a directory, standing in for the server of the assets, as a
+    context manager.
+    """
+
+    def __init__(self, directory: Path, delay_ms: float = 0.0) -> None:
+        handler = type("Handler", (_DelayedHandler,), dict(delay_s=delay_ms / 1000))
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(handler, directory=directory.as_posix())
+        )
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "LocalServer":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def replay(
+    levels: List[_Level], views: List[View], fetch: Fetch, concurrency: int = 6
+) -> Dict:
+    """
+    Fetches and decodes the chunks of each view not fetched by a previous view,
+    ``concurrency`` at a time.
+
+    :return: dict of the chunk fetch count, missing (fill value) chunk count, bytes of
+      the chunks, number of shard index fetches, total time, and the latencies in
+      seconds of each chunk fetch and decode, and of each view
+    """
+    by_path = {level.path: level for level in levels}
+    fetched = set()
+    chunk_s, decode_s, view_s = list(), list(), list()
+    n_bytes, n_missing = 0, 0
+
+    def fetch_chunk(
+        level: _Level, idx: Tuple[int, ...]
+    ) -> Tuple[Optional[bytes], float, float]:
+        start = time.perf_counter()
+        data = level.read_chunk(fetch, idx)
+        fetched_at = time.perf_counter()
+        if data is not None and level.codec is not None:
+            level.codec.decode(data)
+        return data, fetched_at - start, time.perf_counter() - fetched_at
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for path, ranges in views:
+            level = by_path[path]
+            indices = [
+                idx for idx in level.chunk_indices(ranges) if (path, idx) not in fetched
+            ]
+            fetched.update((path, idx) for idx in indices)
+            view_start = time.perf_counter()
+            for data, fetch_time, decode_time in executor.map(
+                partial(fetch_chunk, level), indices
+            ):
+                chunk_s.append(fetch_time)
+                decode_s.append(decode_time)
+                if data is None:
+                    n_missing += 1
+                else:
+                    n_bytes += len(data)
+            view_s.append(time.perf_counter() - view_start)
+    return dict(
+        chunks=len(chunk_s),
+        missing=n_missing,
+        bytes=n_bytes,
+        index_fetches=sum(level.index_fetches for level in levels),
+        total_s=time.perf_counter() - start,
+        chunk_s=chunk_s,
+        decode_s=decode_s,
+        view_s=view_s,
+    )
+
+
+def _percentiles(values: List[float]) -> str:
+    if not values:
+        return "-"
+    p50, p90, p99 = np.percentile(values, [50, 90, 99]) * 1000
+    return (
+        f"p50={p50:.1f}ms p90={p90:.1f}ms p99={p99:.1f}ms "
+        f"max={max(values) * 1000:.1f}ms"
+    )
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "zarr", type=Path, help="zarr to read, or a multiscale group in it"
+    )
+    parser.add_argument("--backend", choices=["fs", "http"], default="fs")
+    parser.add_argument(
+        "--url",
+        default=None,
+        help="read from this server of the zarr rather than a local one",
+    )
+    parser.add_argument(
+        "--delay-ms",
+        type=float,
+        default=0.0,
+        help="delay per request of the local http server",
+    )
+    parser.add_argument(
+        "--viewport",
+        type=int,
+        nargs=2,
+        default=[1920, 1080],
+        metavar=("WIDTH", "HEIGHT"),
+    )
+    parser.add_argument(
+        "--pans", type=int, default=10, help="random pans at each zoom level"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=6, help="concurrent chunk requests"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    levels = _multiscale_levels(args.zarr)
+    views = list(gen_views(levels, tuple(args.viewport), args.pans, seed=args.seed))
+    for level in levels:
+        print(
+            f"level {level.path}: shape={level.shape} chunks={level.chunks} "
+            f"shards={level.shards}"
+        )
+
+    if args.backend == "fs":
+        result = replay(levels, views, fs_fetcher(args.zarr), args.concurrency)
+    elif args.url:
+        result = replay(levels, views, http_fetcher(args.url), args.concurrency)
+    else:
+        with LocalServer(args.zarr, args.delay_ms) as server:
+            result = replay(levels, views, http_fetcher(server.url), args.concurrency)
+
+    print(f"views: {len(views)} in {result['total_s']:.2f}s")
+    print(
+        f"chunks: {result['chunks']} fetched ({result['missing']} missing), "
+        f"{result['bytes'] / 2**20:.1f} MB"
+    )
+    print(f"shard indexes: {result['index_fetches']} fetched")
+    print(f"chunk fetch: {_percentiles(result['chunk_s'])}")
+    print(f"chunk decode: {_percentiles(result['decode_s'])}")
+    print(f"view: {_percentiles(result['view_s'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +0,0 @@
-BRT_DEPTH = 64
-BRT_WIDTH = 256
-BRT_HEIGHT = 256
@@ -40,10 +40,10 @@ import json
 import glob
 import os
 import subprocess
-from typing import Optional
+from typing import List, Optional
 from pathlib import Path
 from natsort import os_sorted
-from prefect import task, flow, unmapped
+from prefect import task, flow
 from pytools.HedwigZarrImages import HedwigZarrImages
 
 from em_workflows.utils import utils
@@ -51,7 +51,19 @@ from em_workflows.utils import neuroglancer as ng
 from em_workflows.constants import AssetType
 from em_workflows.file_path import FilePath
 from em_workflows.brt.config import BRTConfig
-from em_workflows.brt.constants import BRT_DEPTH, BRT_HEIGHT, BRT_WIDTH
+
+# working files deleted as soon as their consumers have finished, see utils.declare_intermediates
+INTERMEDIATES = {
+    # input stack, staged by stage_brt_input
+    "{name}": ["run_brt"],
+    "{base}_ali.mrc": ["gen_tilt_movie"],
+    "ali_{base}_ali.mrc": ["gen_tilt_movie"],
+    "{base}_rec.mrc": ["gen_ave_mrc", "gen_zarr"],
+    "ave_{base}_rec.mrc": ["gen_recon_movie", "gen_ave_8_vol", "copy_asset_gen_elt"],
+    "ave_{base}_rec_mp4.*.jpg": ["gen_recon_movie"],
+    "avebin8_ave_{base}_rec.mrc": ["copy_asset_gen_elt"],
+    "{base}_rec.zarr": ["gen_ng_metadata"],
+}
 
 
 @task(
@@ -152,7 +164,7 @@ def find_middle_image(fp_in: Path) -> Path:
 @task(
     name="Tilt movie generation",
 )
-def gen_tilt_movie(brt_output: utils.BrtOutput) -> Path:
+def gen_tilt_movie(file_path: FilePath, brt_output: utils.BrtOutput) -> Path:
     """
     generates the tilt movie, eg::
 
@@ -199,13 +211,14 @@ def gen_tilt_movie(brt_output: utils.BrtOutput) -> Path:
     FilePath.run(cmd=cmd, log_file=log_file)
     
     utils.cleanup_files(file_path=ali_file, pattern="*_align_*.mrc")
+    file_path.release_intermediates("gen_tilt_movie")
     return Path(movie_file)
 
 
 @task(
     name="Average mrc generation",
 )
-def gen_ave_mrc(brt_output: utils.BrtOutput) -> Path:
+def gen_ave_mrc(file_path: FilePath, brt_output: utils.BrtOutput) -> Path:
     rec_file = brt_output.rec_file
     utils.log("gen recon dims")
     rec_z_dim = utils.gen_dimension_command(fp_in=rec_file)
@@ -214,13 +227,14 @@ def gen_ave_mrc(brt_output: utils.BrtOutput) -> Path:
     utils.log("gen average mrc")
     ave_mrc = consolidate_ave_mrcs(fp_in=rec_file)
     utils.log(f"average mrc: {ave_mrc}")
+    file_path.release_intermediates("gen_ave_mrc")
     return ave_mrc
 
 
 @task(
     name="Movie compilation",
 )
-def gen_recon_movie(ave_mrc: Path) -> Path:
+def gen_recon_movie(file_path: FilePath, ave_mrc: Path) -> Path:
     """
     compiles a stack of jpgs into a movie. eg::
 
@@ -264,6 +278,7 @@ def gen_recon_movie(ave_mrc: Path) -> Path:
     log_file = f"{ave_mrc.parent}/{ave_mrc.stem}_keyMov.log"
     FilePath.run(cmd=cmd, log_file=log_file)
     utils.cleanup_files(file_path=ave_mrc, pattern="_mp4.*.jpg")
+    file_path.release_intermediates("gen_recon_movie")
     return Path(key_mov)
 
 @task(
@@ -328,7 +343,7 @@ def consolidate_ave_mrcs(fp_in: Path) -> Path:
 @task(
     name="Volume asset creation",
 )
-def gen_ave_8_vol(ave_mrc: Path) -> Path:
+def gen_ave_8_vol(file_path: FilePath, ave_mrc: Path) -> Path:
     """
     - creates volume asset, for volslicer, eg::
 
@@ -338,6 +353,7 @@ def gen_ave_8_vol(ave_mrc: Path) -> Path:
     cmd = [BRTConfig.binvol, "-binning", "2", ave_mrc.as_posix(), ave_8_mrc]
     log_file = f"{ave_mrc.parent}/ave_8_mrc.log"
     FilePath.run(cmd=cmd, log_file=log_file)
+    file_path.release_intermediates("gen_ave_8_vol")
     return Path(ave_8_mrc)
 
 
@@ -402,25 +418,24 @@ def gen_ave_jpgs_from_ave_mrc(ave_mrc: Path):
 @task(
     name="Zarr generation",
 )
-def gen_zarr(brt_output: utils.BrtOutput) -> Path:
+def gen_zarr(file_path: FilePath, brt_output: utils.BrtOutput) -> Path:
 
     if not brt_output.rec_file.is_file():
         raise ValueError(f"{brt_output.rec_file} does not exist")
 
     output_zarr = ng.bioformats_gen_zarr_dup(
         fp_in=brt_output.rec_file,
-        depth=BRT_DEPTH,
-        width=BRT_WIDTH,
-        height=BRT_HEIGHT,
         resolutions=1,
     )
     ng.zarr_build_multiscales2(output_zarr)
+    file_path.release_intermediates("gen_zarr")
     return output_zarr
 
 
 @task
 def copy_asset_gen_elt(file_path: FilePath, fp_to_cp: Path, asset_type: str) -> dict:
     asset_fp = file_path.copy_to_assets_dir(fp_to_cp=fp_to_cp)
+    file_path.release_intermediates("copy_asset_gen_elt", patterns=[fp_to_cp.name])
     asset_elt = file_path.gen_asset(asset_type=asset_type, asset_fp=asset_fp)
     return asset_elt
 
@@ -428,13 +443,13 @@ def copy_asset_gen_elt(file_path: FilePath, fp_to_cp: Path, asset_type: str) ->
 @task(
     name="Neuroglancer metadata generation",
 )
-def gen_ng_metadata(fp_in: FilePath, zarr: Path) -> Dict:
+def gen_ng_metadata(fp_in: FilePath, zarr: Path, sharded_zarr: bool = False) -> Dict:
     # Note; the seemingly redundancy of working and asset fp here.
     # However asset fp is in the network file system and is deployed for access to the users
     # Working fp is actually used for getting the metadata
 
     file_path = fp_in
-    asset_fp = file_path.copy_to_assets_dir(fp_to_cp=Path(zarr))
+    asset_fp = ng.copy_zarr_to_assets_dir(file_path, Path(zarr), sharded=sharded_zarr)
 
     utils.log("Instantiating HWZarrImages")
     hw_images = HedwigZarrImages(zarr_path=zarr, read_only=False)
@@ -454,12 +469,16 @@ def gen_ng_metadata(fp_in: FilePath, zarr: Path) -> Dict:
     utils.log("... getting dims")
     hdims = hw_image.dims
     utils.log("... getting shader params")
-    hparams = hw_image.neuroglancer_shader_parameters(mad_scale=5.0)
+    # the zarr is already in the assets, the parameters are cached there too
+    hparams = ng.neuroglancer_shader_parameters(
+        hw_image, assets_group=asset_fp / hw_image.path.name, mad_scale=5.0
+    )
     ng_asset["metadata"] = {
         "shader": htype,
         "dimensions": hdims,
         "shaderParameters": hparams,
     }
+    file_path.release_intermediates("gen_ng_metadata")
     utils.log("DONE!!!")
     return ng_asset
 
@@ -476,121 +495,103 @@ def get_callback_result(callback_data: list) -> list:
     return cb_data
 
 
-@flow(
-    name="BRT",
-    flow_run_name=utils.generate_flow_run_name,
-    log_prints=True,
-    task_runner=BRTConfig.get_high_slurm_task_runner(),
-    on_completion=[utils.notify_api_completion],
-    on_failure=[utils.notify_api_completion],
-    on_crashed=[utils.notify_api_completion],
-)
-def brt_flow(
-    # This block of params map are for adoc file specfication.
-    # Note the ugly names, these parameters are lifted verbatim from
-    # https://bio3d.colorado.edu/imod/doc/directives.html where possible.
-    # (there are two thickness args, these are not verbatim.)
-    montage: int,
-    gold: int,
-    focus: int,
-    fiducialless: int,
-    trackingMethod: int,
-    TwoSurfaces: int,
-    TargetNumberOfBeads: int,
-    LocalAlignments: int,
-    THICKNESS: int,
-    # end user facing adoc params
-    file_share: str,
-    input_dir: str,
-    x_file_name: Optional[str] = None,
-    callback_url: Optional[str] = None,
-    token: Optional[str] = None,
-    x_no_api: bool = False,
-    x_keep_workdir: bool = False,
-    adoc_template: str = "plastic_brt",
-):
-    utils.notify_api_running(x_no_api, token, callback_url)
+def map_pipeline(
+    fps: List[FilePath],
+    adoc_template: str,
+    x_keep_workdir: bool,
+    x_sharded_zarr: bool,
+    x_link_input: bool,
+    **adoc_params,
+) -> List:
+    """
+    Submits a task per step and file.
 
-    input_dir_fp_future = utils.get_input_dir.submit(
-        share_name=file_share, input_dir=input_dir
-    )
-    input_fps_future = utils.list_files.submit(
-        input_dir=input_dir_fp_future,
-        exts=["MRC", "ST", "mrc", "st"],
-        single_file=x_file_name,
+    :param adoc_params: parameters of the adoc file, see ``utils.run_brt``
+    :return: for each file, the future of its callback element
+    """
+    # intermediates are deleted by their last consumer, rather than with the working dir
+    declared_fps = utils.map_pinned(
+        utils.declare_intermediates,
+        fps,
+        file_path=fps,
+        intermediates=INTERMEDIATES,
+        x_keep_workdir=x_keep_workdir,
     )
-
-    fps_future = utils.gen_fps.submit(
-        share_name=file_share,
-        input_dir=input_dir_fp_future,
-        fps_in=input_fps_future,
+    # heavy steps wait for enough free scratch space
+    admitted_fps = utils.map_pinned(utils.admit_to_scratch, fps, file_path=declared_fps, workflow="brt")
+    # inputs are cloned into the working dirs, or copied while brt runs on the previous ones
+    staged_fps = utils.map_pinned(
+        utils.stage_brt_input, fps, file_path=admitted_fps, link_input=x_link_input
     )
-
-    brt_outputs = utils.run_brt.map(
-        file_path=fps_future,
-        adoc_template=unmapped(adoc_template),
-        montage=unmapped(montage),
-        gold=unmapped(gold),
-        focus=unmapped(focus),
-        fiducialless=unmapped(fiducialless),
-        trackingMethod=unmapped(trackingMethod),
-        TwoSurfaces=unmapped(TwoSurfaces),
-        TargetNumberOfBeads=unmapped(TargetNumberOfBeads),
-        LocalAlignments=unmapped(LocalAlignments),
-        THICKNESS=unmapped(THICKNESS),
+    brt_outputs = utils.map_pinned(
+        utils.run_brt,
+        fps,
+        file_path=staged_fps,
+        adoc_template=adoc_template,
+        **adoc_params,
     )
     # wait for brt to finish
     utils.log("Waiting for BRT to finish")
 
     # END BRT, check files for success (else fail here)
 
-    tilt_movies = gen_tilt_movie.map(brt_output=brt_outputs)
+    tilt_movies = utils.map_pinned(gen_tilt_movie, fps, file_path=fps, brt_output=brt_outputs)
 
-    tilt_movie_assets = copy_asset_gen_elt.map(
-       file_path=fps_future,
-       fp_to_cp=tilt_movies,
-       asset_type=unmapped(AssetType.TILT_MOVIE),
+    tilt_movie_assets = utils.map_pinned(
+        copy_asset_gen_elt,
+        fps,
+        file_path=fps,
+        fp_to_cp=tilt_movies,
+        asset_type=AssetType.TILT_MOVIE,
     )
 
-    mid_images = find_middle_image.map(tilt_movies)
+    mid_images = utils.map_pinned(find_middle_image, fps, fp_in=tilt_movies)
 
-    keyimg_assets = copy_asset_gen_elt.map(
-        file_path=fps_future,
+    keyimg_assets = utils.map_pinned(
+        copy_asset_gen_elt,
+        fps,
+        file_path=fps,
         fp_to_cp=mid_images,
-        asset_type=unmapped(AssetType.KEY_IMAGE),
+        asset_type=AssetType.KEY_IMAGE,
     )
 
-    thumbs = gen_thumbs.map(mid_images)
+    thumbs = utils.map_pinned(gen_thumbs, fps, middle_i_jpg=mid_images)
 
-    thumb_assets = copy_asset_gen_elt.map(
-        file_path=fps_future, fp_to_cp=thumbs, asset_type=unmapped(AssetType.THUMBNAIL)
+    thumb_assets = utils.map_pinned(
+        copy_asset_gen_elt, fps, file_path=fps, fp_to_cp=thumbs, asset_type=AssetType.THUMBNAIL
     )
 
-    ave_mrcs = gen_ave_mrc.map(brt_output=brt_outputs)
+    ave_mrcs = utils.map_pinned(gen_ave_mrc, fps, file_path=fps, brt_output=brt_outputs)
 
-    averagedVolume_assets = copy_asset_gen_elt.map(
-        file_path=fps_future, fp_to_cp=ave_mrcs, asset_type=unmapped(AssetType.VOLUME)
+    averagedVolume_assets = utils.map_pinned(
+        copy_asset_gen_elt, fps, file_path=fps, fp_to_cp=ave_mrcs, asset_type=AssetType.VOLUME
     )
 
-    recon_movies = gen_recon_movie.map(ave_mrc=ave_mrcs)
+    recon_movies = utils.map_pinned(gen_recon_movie, fps, file_path=fps, ave_mrc=ave_mrcs)
 
-    recon_movie_assets = copy_asset_gen_elt.map(
-        file_path=fps_future,
+    recon_movie_assets = utils.map_pinned(
+        copy_asset_gen_elt,
+        fps,
+        file_path=fps,
         fp_to_cp=recon_movies,
-        asset_type=unmapped(AssetType.REC_MOVIE),
+        asset_type=AssetType.REC_MOVIE,
     )
     # Binned volume assets, for volslicer.
-    bin_vol_mrcs = gen_ave_8_vol.map(ave_mrc=ave_mrcs)
+    bin_vol_mrcs = utils.map_pinned(gen_ave_8_vol, fps, file_path=fps, ave_mrc=ave_mrcs)
 
-    bin_vol_assets = copy_asset_gen_elt.map(
-        file_path=fps_future,
+    bin_vol_assets = utils.map_pinned(
+        copy_asset_gen_elt,
+        fps,
+        file_path=fps,
         fp_to_cp=bin_vol_mrcs,
-        asset_type=unmapped(AssetType.AVERAGED_VOLUME),
+        asset_type=AssetType.AVERAGED_VOLUME,
     )
 
-    zarrs = gen_zarr.map(brt_output=brt_outputs)
+    zarrs = utils.map_pinned(gen_zarr, fps, file_path=fps, brt_output=brt_outputs)
 
-    pyramid_assets = gen_ng_metadata.map(fp_in=fps_future, zarr=zarrs)
+    pyramid_assets = utils.map_pinned(
+        gen_ng_metadata, fps, fp_in=fps, zarr=zarrs, sharded_zarr=x_sharded_zarr
+    )
 
     # now we've done the computational work.
     # the relevant files have been put into the Assets dirs, but we need to inform the API
@@ -599,7 +600,7 @@ def brt_flow(
     # allow_failure in gen_fps because we want to include EVERY fp, not just OK ones
     # prim_fps = utils.gen_prim_fps.map(fp_in=fps_future, wait_for=[allow_failure(brt_outputs)])
 
-    prim_fps = utils.gen_prim_fps.map(fp_in=fps_future)
+    prim_fps = utils.gen_prim_fps.map(fp_in=fps)
 
     callback_with_thumbs = utils.add_asset.map(prim_fp=prim_fps, asset=thumb_assets)
 
@@ -626,16 +627,128 @@ def brt_flow(
     callback_with_tilt_mov = utils.add_asset.map(
         prim_fp=callback_with_recon_mov, asset=tilt_movie_assets
     )
- 
+    return callback_with_tilt_mov
+
+
+@flow(
+    name="BRT",
+    flow_run_name=utils.generate_flow_run_name,
+    log_prints=True,
+    task_runner=BRTConfig.get_high_slurm_task_runner(),
+    on_completion=[utils.notify_api_completion],
+    on_failure=[utils.notify_api_completion],
+    on_crashed=[utils.notify_api_completion],
+)
+def brt_flow(
+    # This block of params map are for adoc file specfication.
+    # Note the ugly names, these parameters are lifted verbatim from
+    # https://bio3d.colorado.edu/imod/doc/directives.html where possible.
+    # (there are two thickness args, these are not verbatim.)
+    montage: int,
+    gold: int,
+    focus: int,
+    fiducialless: int,
+    trackingMethod: int,
+    TwoSurfaces: int,
+    TargetNumberOfBeads: int,
+    LocalAlignments: int,
+    THICKNESS: int,
+    # end user facing adoc params
+    file_share: str,
+    input_dir: str,
+    x_file_name: Optional[str] = None,
+    callback_url: Optional[str] = None,
+    token: Optional[str] = None,
+    x_no_api: bool = False,
+    x_keep_workdir: bool = False,
+    x_sharded_zarr: bool = False,
+    x_local_scratch: bool = False,
+    x_order: str = "listed",
+    x_callback_batch: int = 0,
+    x_link_input: bool = False,
+    adoc_template: str = "plastic_brt",
+):
+    """
+    :param x_sharded_zarr: write the zarr asset as a zarr v3 with sharded arrays, which has far fewer files
+    :param x_local_scratch: put the working dirs on the local disk of the dask workers, rather than the shared
+      scratch, and run all the tasks of each file on its worker. A file whose worker is lost is run again in the
+      shared scratch.
+    :param x_order: order of submission of the files, "listed", "smallest" or "largest" first, see
+      ``utils.submission_order``. The callback keeps the listing order.
+    :param x_callback_batch: post the callback elements of the files as they complete, by batches of this many
+      files, before the final callback with all the files, see ``utils.IncrementalCallback``. 0 for the final only.
+    :param x_link_input: allow hard and symbolic links to the tilt series on the Projects share, rather than a
+      copy, where a reflink is not possible. The input fails if the original is modified, see ``utils.staging``.
+    """
+    utils.notify_api_running(x_no_api, token, callback_url)
+
+    input_dir_fp_future = utils.get_input_dir.submit(
+        share_name=file_share, input_dir=input_dir
+    )
+    input_fps_future = utils.list_files.submit(
+        input_dir=input_dir_fp_future,
+        exts=["MRC", "ST", "mrc", "st"],
+        single_file=x_file_name,
+    )
+
+    fps_future = utils.gen_fps.submit(
+        share_name=file_share,
+        input_dir=input_dir_fp_future,
+        fps_in=input_fps_future,
+    )
+
+    fps = fps_future.result()
+    # bad inputs are reported in the callback, without scheduling any of their heavy work
+    rejected = utils.preflight.submit(fps, "brt").result()
+    incremental = utils.IncrementalCallback(x_callback_batch, x_no_api, token, callback_url)
+    incremental.add(rejected)
+    submitted = utils.submission_order.submit(fps, x_order, rejected).result()
+    fps = [fps[idx] for idx in submitted]
+    if x_local_scratch:
+        # working dirs on the local disk of the workers, the tasks of each file are pinned to its worker
+        fps = utils.use_local_work_dir.map(fps).result()
+
+    def pipeline(file_paths: List[FilePath]) -> List:
+        return map_pipeline(
+            file_paths,
+            adoc_template,
+            x_keep_workdir,
+            x_sharded_zarr,
+            x_link_input,
+            montage=montage,
+            gold=gold,
+            focus=focus,
+            fiducialless=fiducialless,
+            trackingMethod=trackingMethod,
+            TwoSurfaces=TwoSurfaces,
+            TargetNumberOfBeads=TargetNumberOfBeads,
+            LocalAlignments=LocalAlignments,
+            THICKNESS=THICKNESS,
+        )
+
+    callback_with_tilt_mov = pipeline(fps)
+    if x_callback_batch > 0 or x_local_scratch:
+        # the files whose local working dir was lost with their worker are run again in the shared scratch
+        callback_with_tilt_mov = utils.collect_callback(
+            fps, callback_with_tilt_mov, incremental, rerun=pipeline if x_local_scratch else None
+        )
+    callback_with_tilt_mov = utils.listing_order(callback_with_tilt_mov, submitted, rejected)
+
     send_callback_task = utils.send_callback_body.submit(
         x_no_api=x_no_api,
         token=token,
         callback_url=callback_url,
         files_elts=callback_with_tilt_mov,
+        summary=x_callback_batch > 0,
     )
 
-    utils.final_cleanup_task.submit(
-        fps_future, x_keep_workdir, wait_for=[utils.allow_failure(send_callback_task)]
+    # each working dir is cleaned up on its worker
+    utils.map_pinned(
+        utils.final_cleanup_task,
+        fps,
+        fps=[[fp] for fp in fps],
+        x_keep_workdir=x_keep_workdir,
+        wait_for=[utils.allow_failure(send_callback_task)],
     ).wait()
 
     return callback_with_tilt_mov
@@ -89,16 +89,21 @@ def SLURM_exec(asynchronous: bool = False, **cluster_kwargs):
 
 class Config:
     bioformats2raw = os.environ.get("BIOFORMATS2RAW_LOC", "bioformats2raw")
+    showinf_loc = os.environ.get("SHOWINF_LOC", "showinf")
     brt_binary = os.environ.get("BRT_LOC", "batchruntomo")
     header_loc = os.environ.get("HEADER_LOC", "header")
     mrc2tif_loc = os.environ.get("MRC2TIF_LOC", "mrc2tif")
     newstack_loc = os.environ.get("NEWSTACK_LOC", "newstack")
     ffmpeg_loc = os.environ.get("FFMPEG_LOC", "ffmpeg")
     gm_loc = os.environ.get("GM_LOC", "gm")
+    identify_loc = os.environ.get("IDENTIFY_LOC", "identify")
+    stream_loc = os.environ.get("STREAM_LOC", "stream")
     java_opts = os.environ.get("JAVA_OPTS", "-Djava.io.tmpdir=/data/scratch")
     java_tool_options = os.environ.get(
         "JAVA_TOOL_OPTIONS", "-Djava.io.tmpdir=/data/scratch"
     )
+    # gzip the large request bodies to the API, only if it decodes Content-Encoding: gzip
+    api_gzip = os.environ.get("HEDWIG_API_GZIP", "").strip().lower() == "true"
 
     @classmethod
     def get_base_job_script_prologue(cls, current_dir: Path = None) -> list[str]:
@@ -185,6 +190,8 @@ class Config:
 
     user = os.environ["USER"]
     tmp_dir = f"/data/scratch/{user}"
+    # node-local disk of the dask workers, for the working dirs of the flows run with x_local_scratch
+    local_tmp_dir = os.environ.get("LOCAL_TMP_DIR", os.environ.get("TMPDIR", ""))
 
     @staticmethod
     def _mount_point(share_name: str) -> str:
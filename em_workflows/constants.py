@@ -2,12 +2,78 @@ from collections import namedtuple
 
 LARGE_DIM = 1024
 SMALL_DIM = 300
-RECHUNK_SIZE = 512
+# Zarr chunk shapes are planned by neuroglancer.plan_chunks for chunks of about this many bytes once compressed
+ZARR_CHUNK_TARGET_BYTES = 2 * 2**20
+# expected compression ratio of the image data, converts ZARR_CHUNK_TARGET_BYTES to a number of pixels
+ZARR_COMPRESSION_RATIO = 2.5
+# chunk edges are a multiple of this, unless the chunk spans the whole (smaller) axis
+ZARR_CHUNK_ALIGN = 64
+# blosc compressor (cname, clevel, shuffle) of the zarr outputs by byte size of the pixel type, see
+# neuroglancer.select_codec. Calibrated with python -m em_workflows.benchmarks.codecs
+ZARR_CODECS = {
+    # 8-bit gray and RGB, shuffling single bytes does nothing
+    1: ("zstd", 5, "noshuffle"),
+    # 16-bit, byte shuffle groups the mostly constant high bytes of fluorescence and EM data
+    2: ("zstd", 5, "shuffle"),
+    # float32 tomograms, the mantissa does not compress, a lower level is as small and faster
+    4: ("zstd", 3, "shuffle"),
+    8: ("zstd", 3, "shuffle"),
+}
+# blosc compressor of the speed critical outputs, eg intermediate zarrs which are rewritten
+ZARR_FAST_CODEC = ("lz4", 5)
+# number of chunks in each shard of the sharded (zarr v3) assets, see utils.sharding
+ZARR_SHARD_CHUNKS = 256
+# number of shards written concurrently
+ZARR_SHARD_MAX_WORKERS = 8
+# Neuroglancer shader parameters are computed from the smallest pyramid level with at least this many pixels
+SHADER_PARAMETERS_MIN_PIXELS = 2**22
 
+# Upper bound of the bioformats2raw --max_workers, the value used is adapted to the cpus of the dask worker
 BIOFORMATS_NUM_WORKERS = 60
-# This is expected to be less than the available memory for a dask worker
+# bioformats2raw workers are not increased beyond one per this many bytes of input
+BIOFORMATS_BYTES_PER_WORKER = 32 * 2**20
+# maximum number of series converted concurrently when not running on a dask worker
+BIOFORMATS_MAX_CONCURRENT_SERIES = 4
+# Bounds of the JVM heap of bioformats2raw, the value used is adapted to the memory of the dask worker
 # Ref em_workflows/config:SLURM_exec
-JAVA_MAX_HEAP_SIZE = "-Xmx40G"
+JAVA_MAX_HEAP_MB = 40 * 1024
+JAVA_MIN_HEAP_MB = 2 * 1024
+# fraction of the memory available to a conversion used for the JVM heap, the rest is left for off heap memory
+JAVA_HEAP_MEMORY_FRACTION = 0.75
+
+# peak scratch use of an input, as a multiple of its uncompressed size, see utils.scratch
+SCRATCH_FOOTPRINT_FACTORS = {
+    # copy of the input, BRT outputs, aligned and reconstructed stacks, averages and zarr
+    "brt": 8,
+    # source, adjusted and mid stacks, jpegs and zarr
+    "sem": 4,
+}
+# fraction of the scratch space left free by the admission control
+SCRATCH_FREE_MARGIN = 0.05
+SCRATCH_POLL_SECONDS = 30
+# inputs fail when not admitted to scratch within this time
+SCRATCH_ADMISSION_TIMEOUT_SECONDS = 12 * 3600
+
+# orders of submission of the per-file tasks, see utils.submission_order
+FILE_ORDERS = ("listed", "smallest", "largest")
+# number of inputs validated concurrently, see utils.preflight
+PREFLIGHT_THREADS = 16
+# ways of putting the BRT inputs in the working dirs, in order of preference, see utils.staging
+BRT_STAGING_MODES = ("reflink", "copy")
+# with x_link_input, the inputs may share their data with the original on the Projects share
+BRT_LINK_STAGING_MODES = ("reflink", "hardlink", "symlink", "copy")
+
+# limits of the copies of the inputs in flight across the workers, see utils.prefetch
+PREFETCH_MAX_CONCURRENT = 8
+PREFETCH_MAX_BYTES = 64 * 2**30
+PREFETCH_POLL_SECONDS = 5
+
+# connections to the API, see utils.api_client
+API_TIMEOUT_SECONDS = 60
+API_MAX_CONNECTIONS = 8
+API_KEEPALIVE_SECONDS = 120
+# request bodies of this size or more are sent gzipped
+API_GZIP_MIN_BYTES = 16 * 2**10
 
 # Refer to AssetType.yaml in documentation source for reference
 ASSET_TYPE = namedtuple(
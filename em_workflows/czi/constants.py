@@ -2,4 +2,7 @@ VALID_CZI_INPUTS = ["czi", "CZI", "svs", "SVS", "ome.tiff", "OME.TIFF", "ome.tif
 SITK_COMPRESSION_LVL = 90
 THUMB_X_DIM = 300
 THUMB_Y_DUM = 300
+# tile size of the bioformats2raw conversion, the zarr is then rechunked to the shape planned by plan_chunks
 TILE_SIZE = 512
+# maximum number of series (scenes) of a file processed concurrently by generate_imageset
+SERIES_MAX_WORKERS = 8
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Optional
 
+import numpy as np
 import SimpleITK as sitk
+from distributed import get_client
 from prefect import flow, task
+from prefect.futures import PrefectFutureList
 from pytools import HedwigZarrImage, HedwigZarrImages
 
 from em_workflows.file_path import FilePath
@@ -16,6 +20,7 @@ from em_workflows.czi.constants import (
     THUMB_Y_DUM,
     SITK_COMPRESSION_LVL,
     TILE_SIZE,
+    SERIES_MAX_WORKERS,
 )
 from em_workflows.czi.config import CZIConfig
 
@@ -53,17 +58,73 @@ def rechunk_zarr(file_path: FilePath) -> None:
 
 
 @task
-def copy_zarr_to_assets_dir(file_path: FilePath) -> None:
+def copy_zarr_to_assets_dir(file_path: FilePath, sharded_zarr: bool = False) -> None:
     """
     Copy the zarr files generated from CZI or SVS files using bioformats2raw to the assets folder
+
+    :param sharded_zarr: write the zarr as a zarr v3 with sharded arrays
     """
     output_zarr = Path(f"{file_path.working_dir}/{file_path.base}.zarr")
-    file_path.copy_to_assets_dir(fp_to_cp=Path(output_zarr))
+    ng.copy_zarr_to_assets_dir(file_path, output_zarr, sharded=sharded_zarr)
+
+
+def _working_to_assets_fp(file_path: FilePath, working_fp: Path) -> Path:
+    """
+    The path in the assets directory of a file or directory copied from the working directory.
+    """
+    return Path(file_path.assets_dir) / Path(working_fp).relative_to(file_path.working_dir)
+
+
+def _generate_image_elt(
+    file_path: FilePath,
+    image: HedwigZarrImage,
+    k_idx: int,
+    image_name: str,
+    compute_args: Dict,
+) -> Optional[Dict]:
+    """
+    Generates the imageSet element of a single zarr sub-image.
+
+    :return: the image element, or None for the macro image which is ignored
+    """
+    if image_name == "macro image":
+        # we don't care about the macro image
+        return None
+    # single image element
+    image_elt = dict()
+    image_elt["imageMetadata"] = None
+    assets = list()
+    if not image_name:
+        image_name = f"Scene {k_idx}"
+    image_elt["imageName"] = image_name
+
+    if image_name == "label image":
+        assets.append(
+            gen_thumb(image=image, file_path=file_path, image_name=image_name)
+        )
+
+    else:
+        ng_asset = file_path.gen_asset(
+            asset_type="neuroglancerZarr",
+            asset_fp=_working_to_assets_fp(file_path, image.path),
+        )
+        # note - dims should be image.dims, but GUI does not want XYC
+        # hardcoding in XY for now.
+        ng_asset["metadata"] = dict(
+            shader=image.shader_type,
+            dimensions="XY",
+            shaderParameters=ng.neuroglancer_shader_parameters(
+                image, compute_args=compute_args, middle_quantile=(0.01, 0.99)
+            ),
+        )
+        assets.append(ng_asset)
+    image_elt["assets"] = assets
+    return image_elt
 
 
 @task
 def generate_imageset(file_path: FilePath,
-                      use_default_dask=False) -> List[Dict]:
+                      use_default_dask=False) -> Dict:
     """
     :param: use_default_dask: If True, reuses the Prefect Dask Scheduler for the ZARR and Dask array operations.
 
@@ -75,53 +136,49 @@ def generate_imageset(file_path: FilePath,
         - shader (RGB, Grayscale, or MultiChannel — determined from OME-XML metadata)
         - dimensions
         - shaderParameters
+
+    | The zarr in the (fast disk) working directory is read, the asset paths are those of its copy in the
+    | assets directory. The OME-XML location is read from the same zarr for ``update_file_metadata``.
+    | Sub-images are processed concurrently by up to ``SERIES_MAX_WORKERS`` threads, the imageSet keeps the
+    | order of the sub-images in the file.
+
+    :return: dict with the "imageSet", and the "fileMetadata" of the file
     """
-    zarr_fp = f"{file_path.assets_dir}/{file_path.base}.zarr"
-    image_set = list()
+    zarr_fp = f"{file_path.working_dir}/{file_path.base}.zarr"
 
     if use_default_dask:
-        compute_args = {}
+        try:
+            # the sub-images are processed in other threads, where the dask client of this task
+            # cannot be found, so it is passed explicitly.
+            compute_args = {"scheduler": get_client()}
+        except ValueError:
+            compute_args = {}
     else:
         # This task is used in a sub-flow where it's the only task running.
         # use all the cores in a thread pool.
         compute_args = {"scheduler": "threads"}
     zarr_images = HedwigZarrImages(Path(zarr_fp), compute_args=compute_args)
-    # for image_name, image in zarr_images.series():
-    for k_idx, image_name in enumerate(zarr_images.get_series_keys()):
-        image = zarr_images[k_idx]
-        # single image element
-        image_elt = dict()
-        image_elt["imageMetadata"] = None
-        assets = list()
-        if image_name == "macro image":
-            # we don't care about the macro image
-            continue
-        if not image_name:
-            image_name = f"Scene {k_idx}"
-        image_elt["imageName"] = image_name
+    series_keys = list(zarr_images.get_series_keys())
 
-        if image_name == "label image":
-            assets.append(
-                gen_thumb(image=image, file_path=file_path, image_name=image_name)
-            )
+    def _image_elt(k_idx: int) -> Optional[Dict]:
+        return _generate_image_elt(
+            file_path, zarr_images[k_idx], k_idx, series_keys[k_idx], compute_args
+        )
 
-        else:
-            ng_asset = file_path.gen_asset(
-                asset_type="neuroglancerZarr", asset_fp=image.path
-            )
-            # note - dims should be image.dims, but GUI does not want XYC
-            # hardcoding in XY for now.
-            ng_asset["metadata"] = dict(
-                shader=image.shader_type,
-                dimensions="XY",
-                shaderParameters=image.neuroglancer_shader_parameters(
-                    middle_quantile=(0.01, 0.99)
-                ),
-            )
-            assets.append(ng_asset)
-        image_elt["assets"] = assets
-        image_set.append(image_elt)
-    return image_set
+    max_workers = max(1, min(SERIES_MAX_WORKERS, len(series_keys)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map returns the results in the order of the sub-images
+        image_elts = list(executor.map(_image_elt, range(len(series_keys))))
+    image_set = [image_elt for image_elt in image_elts if image_elt is not None]
+
+    file_metadata = None
+    ome_xml_path = zarr_images.ome_xml_path
+    if ome_xml_path:
+        xml_path = _working_to_assets_fp(file_path, ome_xml_path).relative_to(
+            file_path.asset_root
+        )
+        file_metadata = dict(omeXml=xml_path.as_posix())
+    return dict(imageSet=image_set, fileMetadata=file_metadata)
 
 
 @flow(
@@ -129,38 +186,51 @@ def generate_imageset(file_path: FilePath,
     log_prints=True,
     task_runner=CZIConfig.get_slurm_task_runner(),
 )
-async def generate_czi_imageset(file_path: FilePath) -> List[Dict]:
+async def generate_czi_imageset(
+    file_path: FilePath, split_series: bool = False, sharded_zarr: bool = False, prefetch: bool = False
+) -> Dict:
     """
     Subflow for per-file processing of CZI or SVS inputs.
 
     Overview:
         - Convert input file (CZI or SVS) to OME-NGFF zarr using bioformats2raw
         - Rechunk zarr so channels are not split between chunks
-        - Copy zarr files to assets folder
-        - Generate imageset (neuroglancer metadata and thumbnails) for the assets
+        - Generate imageset (neuroglancer metadata and thumbnails) from the working zarr
+        - Copy zarr files to assets folder, including the cached shader parameters
     """
-    zarr_result = generate_zarr.submit(file_path)
+    if prefetch:
+        file_path = utils.prefetch_input.submit(file_path, consumer="generate_zarr")
+    zarr_result = generate_zarr.submit(file_path, split_series=split_series)
     rechunk_result = rechunk_zarr.submit(file_path, wait_for=[zarr_result])
+    imageset_result = generate_imageset.submit(file_path,
+                                               use_default_dask=True,
+                                               wait_for=[rechunk_result])
     copy_to_assets = copy_zarr_to_assets_dir.submit(
-        file_path, wait_for=[rechunk_result]
+        file_path, sharded_zarr=sharded_zarr, wait_for=[imageset_result]
     )
-    return generate_imageset.submit(file_path,
-                                    use_default_dask=True,
-                                    wait_for=[copy_to_assets])
+    copy_to_assets.result()
+    return imageset_result
 
 
 @task
-def generate_zarr(file_path: FilePath):
+def generate_zarr(file_path: FilePath, split_series: bool = False):
     """
     Uses bioformats2raw to convert a CZI or SVS input file to OME-NGFF zarr format.
+
+    :param split_series: If True, each series (scene) of the input is converted by its own bioformats2raw run,
+      concurrently on the cluster, and the results merged into a single zarr.
     """
-    input_czi = file_path.fp_in.as_posix()
-    ng.bioformats_gen_zarr(
+    input_czi = file_path.input_fp.as_posix()
+    gen_zarr = ng.bioformats_gen_zarr_by_series if split_series else ng.bioformats_gen_zarr
+    gen_zarr(
         file_path=file_path,
         input_fname=input_czi,
         width=TILE_SIZE,
         height=TILE_SIZE,
+        # the zarr is rewritten by rechunk_zarr with the codec selected for its dtype
+        codec=ng.select_codec(np.uint8, speed_critical=True),
     )
+    file_path.release_intermediates("generate_zarr")
 
 
 @task
@@ -176,20 +246,21 @@ def find_thumb_idx(callback: List[Dict]) -> List[Dict]:
 
 
 @task
-def update_file_metadata(file_path: FilePath, callback_with_zarr: Dict) -> Dict:
+def update_file_metadata(prim_fp: Dict, imageset_result: Dict) -> Dict:
     """
+    Adds the imageSet generated by ``generate_imageset`` to the primary element.
+
     OME-xml metadata can be informative for developers to understand why the
     neuroglancer view is not appropriately rendering. This function attaches
     xml file location as the file metadata to the zarr group
     """
-    zarr_fp = f"{file_path.assets_dir}/{file_path.base}.zarr"
-    zarr_images = HedwigZarrImages(Path(zarr_fp))
-    ome_xml_path = zarr_images.ome_xml_path
-    if ome_xml_path:
-        xml_path = ome_xml_path.relative_to(file_path.asset_root)
+    callback_with_zarr = utils.add_imageSet.fn(
+        prim_fp=prim_fp, imageSet=imageset_result["imageSet"]
+    )
+    if imageset_result["fileMetadata"]:
         if callback_with_zarr["fileMetadata"] is None:
             callback_with_zarr["fileMetadata"] = dict()
-        callback_with_zarr["fileMetadata"]["omeXml"] = xml_path.as_posix()
+        callback_with_zarr["fileMetadata"].update(imageset_result["fileMetadata"])
     return callback_with_zarr
 
 
@@ -217,7 +288,20 @@ async def czi_flow(
     token: Optional[str] = None,
     x_no_api: bool = False,
     x_keep_workdir: bool = False,
+    x_split_series: bool = False,
+    x_sharded_zarr: bool = False,
+    x_prefetch: bool = False,
+    x_callback_batch: int = 0,
 ):
+    """
+    :param x_split_series: convert each series (scene) of the inputs with a separate bioformats2raw run, spreading
+      the conversion of multi-scene files across the cluster.
+    :param x_sharded_zarr: write the zarr assets as zarr v3 with sharded arrays, which have far fewer files
+    :param x_prefetch: copy each input into its working dir before bioformats2raw reads it, with the copies bounded
+      across the workers, see ``utils.prefetch``
+    :param x_callback_batch: post the callback elements of the files as they complete, by batches of this many
+      files, before the final callback with all the files, see ``utils.IncrementalCallback``. 0 for the final only.
+    """
     utils.notify_api_running.fn(x_no_api, token, callback_url)
 
     input_dir_fp = utils.get_input_dir.submit(
@@ -233,23 +317,44 @@ async def czi_flow(
     fps = utils.gen_fps.submit(
         share_name=file_share, input_dir=input_dir_fp, fps_in=input_fps
     ).result()
+    # bad inputs are reported in the callback, without scheduling their conversion
+    rejected = utils.preflight.submit(fps, "czi").result()
+    incremental = utils.IncrementalCallback(x_callback_batch, x_no_api, token, callback_url)
+    incremental.add(rejected)
+    submitted = utils.submission_order.submit(fps, "listed", rejected).result()
+    fps = [fps[idx] for idx in submitted]
 
     prim_fps = utils.gen_prim_fps.map(fp_in=fps)
-    imageSets = await asyncio.gather(
-        *[generate_czi_imageset(file_path=fp) for fp in fps]
-    )
-    callback_with_zarrs = utils.add_imageSet.map(prim_fp=prim_fps, imageSet=imageSets)
-    callback_with_zarrs = update_file_metadata.map(
-        file_path=fps, callback_with_zarr=callback_with_zarrs
-    )
+    subflows = {
+        asyncio.ensure_future(
+            generate_czi_imageset(
+                file_path=fp, split_series=x_split_series, sharded_zarr=x_sharded_zarr, prefetch=x_prefetch
+            )
+        ): idx
+        for idx, fp in enumerate(fps)
+    }
+    # the callback element of each file is generated as soon as its subflow completes
+    callback_with_zarrs = [None] * len(fps)
+    async for subflow in asyncio.as_completed(subflows):
+        idx = subflows[subflow]
+        callback_with_zarrs[idx] = update_file_metadata.submit(
+            prim_fp=prim_fps[idx], imageset_result=subflow.result()
+        )
+        if x_callback_batch > 0:
+            incremental.add(find_thumb_idx.fn([callback_with_zarrs[idx].result()]))
+    incremental.flush()
+    callback_with_zarrs = PrefectFutureList(callback_with_zarrs)
 
-    callback_with_idx = find_thumb_idx.submit(callback=callback_with_zarrs)
+    callback_with_idx = find_thumb_idx.submit(
+        callback=utils.listing_order(callback_with_zarrs, submitted, rejected)
+    )
 
     send_callback_task = utils.send_callback_body.submit(
         x_no_api=x_no_api,
         files_elts=callback_with_idx,
         token=token,
         callback_url=callback_url,
+        summary=x_callback_batch > 0,
         wait_for=[utils.allow_failure(callback_with_zarrs)],
     )
 
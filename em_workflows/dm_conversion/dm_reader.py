@@ -0,0 +1,182 @@
+"""
+Minimal reader for Gatan Digital Micrograph (DM3 and DM4) images.
+
+Only what is needed to get the pixels of the main image is supported: the tag tree is
+parsed, and the largest image in the ``ImageList`` (the first image is usually a small
+thumbnail) is returned as a NumPy array. Large numeric arrays are not read while parsing
+the tags, only the selected image data is read from disk.
+
+Format reference: https://personal.ntu.edu.sg/cbb/info/dmformat/index.html
+"""
+import struct
+from collections import namedtuple
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Union
+
+import numpy as np
+
+# tag data encoded types to numpy dtype (without byte order)
+DM_DTYPES = {
+    2: "i2",
+    3: "i4",
+    4: "u2",
+    5: "u4",
+    6: "f4",
+    7: "f8",
+    8: "?",
+    9: "i1",
+    10: "u1",
+    11: "i8",
+    12: "u8",
+}
+DM_STRUCT = 15
+DM_STRING = 18
+DM_ARRAY = 20
+
+DM_TAG_GROUP = 20
+DM_TAG_DATA = 21
+
+# ImageData.DataType of packed 8-bit RGBA images
+DM_RGB_DATA_TYPE = 23
+# ImageData.DataType of complex images
+DM_COMPLEX_DATA_TYPES = (3, 13)
+
+# numeric arrays larger than this are recorded as a reference rather than read while
+# parsing
+_LAZY_ARRAY_BYTES = 4096
+
+# reference to a numeric array within the file, read on demand
+DMArray = namedtuple("DMArray", "offset dtype count")
+
+
+class _DMParser:
+    def __init__(self, fh: BinaryIO) -> None:
+        self.fh = fh
+        self.version = self._read_header_int(4)
+        if self.version not in (3, 4):
+            raise RuntimeError(f"Unsupported Digital Micrograph version {self.version}")
+        # DM4 uses 8 byte integers for lengths and counts, DM3 4 byte integers.
+        self.int_size = 8 if self.version == 4 else 4
+        self._read_header_int(self.int_size)  # root length
+        # byte order of the tag data, the header itself is always big endian
+        self.byte_order = "<" if self._read_header_int(4) == 1 else ">"
+
+    def _read_header_int(self, size: int) -> int:
+        return struct.unpack(">q" if size == 8 else ">i", self.fh.read(size))[0]
+
+    def _read_int(self) -> int:
+        return self._read_header_int(self.int_size)
+
+    def _read_value(self, enc_type: int):
+        dtype = np.dtype(self.byte_order + DM_DTYPES[enc_type])
+        return np.frombuffer(self.fh.read(dtype.itemsize), dtype=dtype)[0].item()
+
+    def parse_group(self) -> Union[Dict, List]:
+        self.fh.read(2)  # is sorted, is open
+        n_tags = self._read_int()
+        named = dict()
+        unnamed = list()
+        for _ in range(n_tags):
+            tag_type = self.fh.read(1)[0]
+            label_len = struct.unpack(">h", self.fh.read(2))[0]
+            label = self.fh.read(label_len).decode("latin-1")
+            if self.version == 4:
+                self._read_int()  # tag size
+            if tag_type == DM_TAG_GROUP:
+                value = self.parse_group()
+            elif tag_type == DM_TAG_DATA:
+                value = self._parse_data()
+            else:
+                raise RuntimeError(
+                    f"Invalid DM tag type {tag_type} at {self.fh.tell()}"
+                )
+            if label:
+                named[label] = value
+            else:
+                unnamed.append(value)
+        # groups of unnamed tags (eg ImageList, Dimensions) are lists
+        return unnamed if unnamed and not named else named
+
+    def _parse_data(self):
+        if self.fh.read(4) != b"%%%%":
+            raise RuntimeError(f"Invalid DM tag data delimiter at {self.fh.tell()}")
+        n_info = self._read_int()
+        info = [self._read_int() for _ in range(n_info)]
+        enc_type = info[0]
+        if enc_type in DM_DTYPES:
+            return self._read_value(enc_type)
+        elif enc_type == DM_STRING:
+            return self.fh.read(info[1] * 2).decode("utf-16-le", errors="replace")
+        elif enc_type == DM_STRUCT:
+            # info: struct, name length, n fields, then (name length, type) per field
+            field_types = info[4::2]
+            return tuple(self._read_value(t) for t in field_types)
+        elif enc_type == DM_ARRAY:
+            return self._parse_array(info)
+        raise RuntimeError(f"Unsupported DM tag data type {enc_type}")
+
+    def _parse_array(self, info: List[int]):
+        elem_type = info[1]
+        count = info[-1]
+        if elem_type == DM_STRUCT:
+            # info: array, struct, name length, n fields, (name length, type)..., count
+            field_types = info[5:-1:2]
+            return [
+                tuple(self._read_value(t) for t in field_types) for _ in range(count)
+            ]
+        if elem_type not in DM_DTYPES:
+            raise RuntimeError(f"Unsupported DM array element type {elem_type}")
+        dtype = np.dtype(self.byte_order + DM_DTYPES[elem_type])
+        offset = self.fh.tell()
+        n_bytes = dtype.itemsize * count
+        if n_bytes > _LAZY_ARRAY_BYTES:
+            self.fh.seek(n_bytes, 1)
+            return DMArray(offset=offset, dtype=dtype, count=count)
+        return np.frombuffer(self.fh.read(n_bytes), dtype=dtype)
+
+
+def _array_len(arr: Union[DMArray, np.ndarray]) -> int:
+    return arr.count if isinstance(arr, DMArray) else len(arr)
+
+
+def read_dm_tags(fp: Path) -> Dict:
+    """
+    :param fp: pathlib.Path of a DM3 or DM4 file
+    :return: the root tag group as nested dicts (named tags) and lists (unnamed tags)
+
+    Numeric arrays larger than a few KB are returned as ``DMArray`` references.
+    """
+    with open(fp, "rb") as fh:
+        return _DMParser(fh).parse_group()
+
+
+def read_dm(fp: Path) -> np.ndarray:
+    """
+    :param fp: pathlib.Path of a DM3 or DM4 file
+    :return: the main image as a NumPy array, indexed [z,] y, x. RGB images are y, x, 3
+      uint8.
+
+    Raises RuntimeError if the file contains no image, or only complex valued images.
+    """
+    tags = read_dm_tags(fp)
+    images = [
+        image["ImageData"]
+        for image in tags.get("ImageList", [])
+        if isinstance(image, dict)
+        and isinstance(image.get("ImageData", {}).get("Data"), (DMArray, np.ndarray))
+    ]
+    if not images:
+        raise RuntimeError(f"No image data found in {fp}")
+    image_data = max(images, key=lambda data: _array_len(data["Data"]))
+    data_type = image_data.get("DataType")
+    if data_type in DM_COMPLEX_DATA_TYPES:
+        raise RuntimeError(f"Complex DM image data is not supported: {fp}")
+
+    arr = image_data["Data"]
+    if isinstance(arr, DMArray):
+        arr = np.fromfile(fp, dtype=arr.dtype, count=arr.count, offset=arr.offset)
+    # dimensions are x, y, [z]; x varies fastest
+    shape = [int(dim) for dim in reversed(image_data["Dimensions"])]
+    if data_type == DM_RGB_DATA_TYPE:
+        return arr.view(np.uint8).reshape(shape + [4])[..., :3]
+    return arr.reshape(shape)
@@ -1,95 +1,151 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
+import numpy as np
 import SimpleITK as sitk
 import SimpleITK.utilities as sitkutils
 
-from prefect import flow, task, allow_failure
-from pytools.meta import is_16bit
+from prefect import flow, task, allow_failure, unmapped
+from prefect.futures import as_completed
 
 from em_workflows.utils import utils
 from em_workflows.file_path import FilePath
 from em_workflows.constants import AssetType
 from em_workflows.dm_conversion.config import DMConfig
+from em_workflows.dm_conversion.dm_reader import read_dm
 from em_workflows.dm_conversion.constants import (
     LARGE_DIM,
     SMALL_DIM,
     # LARGE_2D,
     # SMALL_2D,
     # KEYIMG_EXTS,
-    TIFS_EXT,
     DMS_EXT,
     MRCS_EXT,
     VALID_2D_INPUT_EXTS,
 )
 
 
-def _calculate_shrink_factor(
-    filepath: Path, enforce_2d: bool = True, target_size: int = LARGE_DIM
-) -> float:
+def _lanczos_shrink_axis(
+    arr: np.ndarray, axis: int, shrink_factor: float, lobes: int = 3
+) -> np.ndarray:
     """
-    Calculate the shrink factor for the newstack command to produce an image of the target size on the largest dimension.
+    Reduce the size of ``arr`` along ``axis`` by ``shrink_factor`` with a Lanczos windowed sinc
+    kernel stretched by the shrink factor, which is the antialiasing filter newstack uses with
+    ``-antialias 6``. Samples beyond the edges are replicated.
     """
-    dims = utils.lookup_dims(filepath)
+    in_size = arr.shape[axis]
+    out_size = max(1, int(in_size / shrink_factor))
+    # centers of the output pixels in input pixel coordinates
+    centers = (np.arange(out_size) + 0.5) * shrink_factor - 0.5
+    n_taps = int(np.ceil(2 * lobes * shrink_factor)) + 1
+    idxs = np.floor(centers - lobes * shrink_factor).astype(int)[:, None] + np.arange(
+        1, n_taps + 1
+    )
+    x = (idxs - centers[:, None]) / shrink_factor
+    weights = np.where(np.abs(x) < lobes, np.sinc(x) * np.sinc(x / lobes), 0.0)
+    weights /= weights.sum(axis=1, keepdims=True)
+    idxs = np.clip(idxs, 0, in_size - 1)
+
+    arr = np.moveaxis(arr, axis, 0)
+    out = np.zeros((out_size,) + arr.shape[1:], dtype=np.float32)
+    weight_shape = (out_size,) + (1,) * (arr.ndim - 1)
+    for tap in range(n_taps):
+        out += (
+            weights[:, tap].reshape(weight_shape).astype(np.float32) * arr[idxs[:, tap]]
+        )
+    return np.moveaxis(out, 0, axis)
 
-    if enforce_2d and dims.z != 1:
-        msg = f"mrc file {filepath} is not 2 dimensional. Contains {dims.z} Z dims."
-        raise RuntimeError(msg)
 
-    # use the max dimension of x & y to compute shrink_factor
-    max_xy = max(dims.x, dims.y)
-    # work out shrink_factor to make the resulting image LARGE_DIM at max
-    return max_xy / target_size
+def _shrink_antialias(arr: np.ndarray, shrink_factor: float) -> np.ndarray:
+    """
+    In-process equivalent of ``newstack -shrink {shrink_factor} -antialias 6`` for a 2D image.
+    Images are not enlarged when the shrink factor is less than 1.
 
+    :param arr: 2D image array indexed y, x
+    :param shrink_factor: factor to reduce both dimensions by
+    :return: float32 array of the shrunk image
+    """
+    arr = arr.astype(np.float32, copy=False)
+    if shrink_factor <= 1.0:
+        return arr
+    for axis in range(arr.ndim):
+        arr = _lanczos_shrink_axis(arr, axis, shrink_factor)
+    return arr
 
-def _newstack_mrc_to_tiff(
-    input_fn: Path, output_fn: Path, log_fn: Path, use_float=True, verbose=False
-) -> None:
+
+def _scale_to_uint8(
+    arr: np.ndarray, use_float: bool = True, meansd_stats: tuple = None
+) -> np.ndarray:
     """
-    Convert mrc files to tiff using newstack while reducing the size of the image, and performing antialiasing suitable
-    for EM images.
-
-    https://bio3d.colorado.edu/imod/doc/man/newstack.html
-
-    :param input_fn: Input file path of a mrc file.
-    :param output_fn: Output file path of a tiff file.
-    :param log_fn: File path to a log file for the newstack command output.
-    :param use_float: If true uses the newstack "float" option to  fill the data range of the output. This range is
-      computed after the shrink operation. If false, uses the "meansd" option with the default values of 140,50, which
-      computed before the shrink operation.
-    :param verbose: If true, the newstack command is run in normal mode. Otherwise, quiet mode is enabled.
-    :return:
+    In-process equivalent of the newstack ``-mode 0`` intensity scaling options.
+
+    :param arr: image array to scale
+    :param use_float: If true, equivalent of "-float 1", the range of ``arr`` is stretched to fill 0-255.
+      If false, equivalent of "-meansd 140,50": intensities are scaled to a mean of 140 and standard deviation of 50.
+    :param meansd_stats: (mean, standard deviation) to use for "-meansd" scaling, newstack computes these before
+      the shrink operation so they should be computed from the input image. Defaults to the stats of ``arr``.
+    :return: uint8 array
     """
+    if use_float:
+        a_min, a_max = float(arr.min()), float(arr.max())
+        scale = 255.0 / (a_max - a_min) if a_max > a_min else 0.0
+        scaled = (arr - a_min) * scale
+    else:
+        mean, sd = (
+            meansd_stats if meansd_stats else (float(arr.mean()), float(arr.std()))
+        )
+        scale = 50.0 / sd if sd > 0 else 0.0
+        scaled = (arr - mean) * scale + 140.0
+    return np.clip(np.rint(scaled), 0, 255).astype(np.uint8)
 
-    shrink_factor = _calculate_shrink_factor(input_fn, target_size=LARGE_DIM)
 
-    cmd = [
-        DMConfig.newstack_loc,
-        "-shrink",
-        f"{shrink_factor:.3f}",
-        "-antialias",
-        "6",
-        "-mode",
-        "0",
-    ]
+def _read_2d_image(filepath: Path, target_size: int = LARGE_DIM) -> sitk.Image:
+    """
+    Reads a 2D input image once and returns it ready for jpeg encoding.
+
+    EM images are broadly characterized by a low signal-to-noise ratio and a high dynamic range, often with potential
+     outliers. They are shrunk with an antialiasing kernel so the largest dimension is ``target_size``, then scaled to
+     8-bit, in-process and equivalent to ``newstack -shrink -antialias 6 -mode 0``:
+      - mrc files are scaled with the "meansd" option
+      - dm3/dm4 files, and 16-bit (or other non 8-bit gray-scale) tiff files are scaled with the "float" option
 
-    if not verbose:
-        cmd.append("-quiet")
+    Other images, such as 8-bit gray-scale or RGB images, are returned as read.
 
-    if use_float:
-        cmd.extend(["-float", "1"])
+    The bit depth and dimensions are obtained from the same read of the file, no header is read separately.
+    """
+    ext = filepath.suffix.strip(".").lower()
+    if ext in DMS_EXT:
+        arr = read_dm(filepath)
+        if arr.ndim == 3 and arr.shape[-1] == 3 and arr.dtype == np.uint8:
+            # RGB images need no intensity scaling, they are resized for the jpegs as is
+            return sitk.GetImageFromArray(arr, isVector=True)
     else:
-        cmd.extend(["-meansd", "140,50"])
+        img = sitk.ReadImage(filepath)
+        if ext not in MRCS_EXT and (
+            img.GetNumberOfComponentsPerPixel() > 1
+            or img.GetPixelID() == sitk.sitkUInt8
+        ):
+            return img
+        arr = sitk.GetArrayViewFromImage(img)
+
+    arr = np.squeeze(arr)
+    if arr.ndim != 2:
+        msg = f"Image file {filepath} is not 2 dimensional. Has shape {arr.shape}."
+        raise RuntimeError(msg)
 
-    cmd.extend(
-        [
-            input_fn.as_posix(),
-            output_fn.as_posix(),
-        ]
+    use_float = ext not in MRCS_EXT
+    # newstack computes the meansd stats before the shrink operation
+    meansd_stats = None if use_float else (float(arr.mean()), float(arr.std()))
+    shrink_factor = max(arr.shape) / target_size
+    utils.log(msg=f"Shrinking {filepath} by {shrink_factor:.3f}...")
+    arr = _shrink_antialias(arr, shrink_factor)
+    return sitk.GetImageFromArray(
+        _scale_to_uint8(arr, use_float=use_float, meansd_stats=meansd_stats)
     )
 
-    FilePath.run(cmd, str(log_fn), env={"IMOD_OUTPUT_FORMAT": "TIF"})
-
 
 def _write_image_as_size(
     img: sitk.Image, size: tuple[int, int], output_path: Path, compression_level: int
@@ -121,64 +177,6 @@ def _write_image_as_size(
     )
 
 
-@task(
-    name="Convert EM images to tiff",
-)
-def convert_em_to_tiff(file_path: FilePath) -> Path:
-    """
-    Performs the conversion of EM images to tiff format, adjusting the dynamic range and reducing the size of the image.
-
-    Three types of files are detected to need conversion:
-      - mrc files are converted to tiff using newstack
-      - 16-bit tiff files are converted to 8-bit tiff
-      - dm3/dm4 files are converted to mrc using dm2mrc, then to tiff using newstack
-
-    EM images are broadly characterized by a low signal-to-noise ratio and a high dynamic range, often with potential
-     outliers. Using newstack with shrink and antialiasing kernels is required to reduce the noise to produce a
-     high-quality tiff image. Additionally, to adjust the dynamic range, the meansd, or float options are used.
-
-
-    :param file_path:
-    :return:
-    """
-
-    out_fp = file_path.gen_output_fp(output_ext="_as_tiff.tiff")
-    log_fp = file_path.gen_output_fp(output_ext="_as_tiff.log")
-
-    if file_path.fp_in.suffix.strip(".").lower() in MRCS_EXT:
-
-        utils.log(
-            f"{file_path.fp_in.as_posix()} is a mrc file, will convert to {out_fp}."
-        )
-
-        _newstack_mrc_to_tiff(file_path.fp_in, out_fp, log_fp, use_float=False)
-
-    elif file_path.fp_in.suffix.strip(".").lower() in TIFS_EXT and is_16bit(
-        file_path.fp_in
-    ):
-
-        utils.log(f"{file_path.fp_in} is a 16 bit tiff, converting to {out_fp}")
-
-        _newstack_mrc_to_tiff(file_path.fp_in, out_fp, log_fp, use_float=True)
-
-    elif file_path.fp_in.suffix.strip(".").lower() in DMS_EXT:
-        dm_as_mrc = file_path.gen_output_fp(output_ext="dm_as_mrc.mrc")
-        utils.log(msg=f"{file_path.fp_in} is a dm file, will convert to {dm_as_mrc}.")
-
-        mrc_log_fp = file_path.gen_output_fp(output_ext="_dm2mrc.log")
-
-        cmd = [DMConfig.dm2mrc_loc, file_path.fp_in.as_posix(), dm_as_mrc.as_posix()]
-        FilePath.run(cmd=cmd, log_file=str(mrc_log_fp))
-
-        utils.log(f"{dm_as_mrc} convert to {out_fp}.")
-
-        _newstack_mrc_to_tiff(dm_as_mrc, out_fp, log_fp, use_float=True)
-    else:
-        return file_path.fp_in
-
-    return out_fp
-
-
 @task(
     name="Generate key and thumbnail jpeg images ",
     task_run_name="Generate JPEG {file_path.fp_in}",
@@ -187,21 +185,15 @@ def generate_jpegs(file_path: FilePath) -> dict:
     """
     Generates small and large jpegs from the input file and produce an asset dictionary.
 
-    The input image is converted to tiff for certain EM image, if needed.
+    The input image is read once, and EM images are shrunk and scaled to 8-bit in-process by ``_read_2d_image``.
 
-    SimpleITK is used to the original input or the converted tiff image to generate the jpegs.
+    SimpleITK is used to generate the jpegs from the resulting image.
 
     """
 
-    current_image_path = convert_em_to_tiff.fn(file_path)
-
-    if not current_image_path.exists():
-        raise RuntimeError(
-            f"File {current_image_path} does not exist. Cannot convert to jpeg."
-        )
-
-    utils.log(msg=f"Reading {current_image_path}...")
-    img = sitk.ReadImage(current_image_path)
+    utils.log(msg=f"Reading {file_path.input_fp}...")
+    img = _read_2d_image(file_path.input_fp)
+    file_path.release_intermediates("generate_jpegs")
 
     # Produce a small thumbnail
     output_small = file_path.gen_output_fp(output_ext="_SM.jpeg")
@@ -228,6 +220,46 @@ def generate_jpegs(file_path: FilePath) -> dict:
     )
 
 
+def _generate_jpegs_or_error(file_path: FilePath) -> Dict:
+    """
+    Runs ``generate_jpegs`` for one file of a batch, turning a failure into the file's error element
+    so that the other files of the batch are still reported.
+    """
+    try:
+        return generate_jpegs.fn(file_path)
+    except Exception as e:
+        utils.log(f"Failed to generate jpegs for {file_path.fp_in}: {e}")
+        return file_path.gen_prim_fp_elt(f"Error: {str(e)}.")
+
+
+@task(
+    name="Generate key and thumbnail jpeg images for a batch",
+    task_run_name="Generate JPEG batch of {file_paths[0].fp_in.name}...",
+)
+def generate_jpegs_batch(
+    file_paths: List[FilePath], max_workers: Optional[int] = None
+) -> List[Dict]:
+    """
+    Generates the jpegs of a batch of small images inside a single task, using a local process
+    pool. One primaryFilePath element is returned per input file, in the order of ``file_paths``;
+    files which fail carry their error message rather than failing the whole batch.
+
+    :param file_paths: the FilePaths of the batch
+    :param max_workers: number of processes, defaults to the cores available to this worker
+    """
+    if max_workers is None:
+        max_workers = len(os.sched_getaffinity(0))
+    max_workers = min(max_workers, len(file_paths))
+    utils.log(
+        f"Processing batch of {len(file_paths)} files with {max_workers} processes"
+    )
+    # spawn rather than fork, the task runs in a threaded (Prefect/Dask) process
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return list(executor.map(_generate_jpegs_or_error, file_paths))
+
+
 @flow(
     name="Small 2D",
     flow_run_name=utils.generate_flow_run_name,
@@ -245,12 +277,23 @@ def dm_flow(
     token: Optional[str] = None,
     x_no_api: bool = False,
     x_keep_workdir: bool = False,
+    x_batch_size: int = 0,
+    x_prefetch: bool = False,
+    x_callback_batch: int = 0,
 ):
     """
     - List all inputs (files of a relevant input type)
     - Create output directories
     - Generate thumbnails and key images
     - Post callback to the API with the access
+
+    :param x_batch_size: if greater than 0, inputs are grouped into size balanced batches of
+      about this many files, and each batch is processed by a single task. This avoids the
+      per-task orchestration overhead for directories of many small images.
+    :param x_prefetch: copy each input into its working dir before it is read, with the copies bounded across the
+      workers, see ``utils.prefetch``. Not used with batches.
+    :param x_callback_batch: post the callback elements of the files as they complete, by batches of this many
+      files, before the final callback with all the files, see ``utils.IncrementalCallback``. 0 for the final only.
     """
     utils.notify_api_running(x_no_api, token, callback_url)
 
@@ -264,29 +307,55 @@ def dm_flow(
         single_file=x_file_name,
     )
 
-    fps_future = utils.gen_fps.submit(
+    fps = utils.gen_fps.submit(
         share_name=file_share, input_dir=input_dir_fp_future, fps_in=input_fps_future
+    ).result()
+    # bad inputs are reported in the callback, without scheduling their conversion
+    rejected = utils.preflight.submit(fps, "dm").result()
+    incremental = utils.IncrementalCallback(
+        x_callback_batch, x_no_api, token, callback_url
     )
-
-    prim_fps = generate_jpegs.map(fps_future, return_state=True)
-
-    callback_result = list()
-
-    for idx, (fp, cb) in enumerate(zip(fps_future.result(), prim_fps)):
-        try:
-            callback_result.append(cb.result())
-        except Exception as e:
-            callback_result.append(fp.gen_prim_fp_elt(f"Error: {str(e)}."))
+    incremental.add(rejected)
+    submitted = utils.submission_order.submit(fps, "listed", rejected).result()
+    fps = [fps[idx] for idx in submitted]
+
+    if x_batch_size > 0:
+        batches = utils.gen_batches.submit(fps, x_batch_size).result()
+        batch_futures = generate_jpegs_batch.map(batches)
+        batch_of = {id(future): batch for future, batch in zip(batch_futures, batches)}
+        elts_by_fp = dict()
+        for future in as_completed(list(batch_futures)):
+            batch = batch_of[id(future)]
+            try:
+                batch_elts = future.result()
+            except Exception as e:
+                batch_elts = [fp.gen_prim_fp_elt(f"Error: {str(e)}.") for fp in batch]
+            elts_by_fp.update(zip([fp.fp_in for fp in batch], batch_elts))
+            incremental.add(batch_elts)
+        incremental.flush()
+        callback_result = [elts_by_fp[fp.fp_in] for fp in fps]
+    else:
+        if x_prefetch:
+            fps_in = utils.prefetch_input.map(
+                file_path=fps, consumer=unmapped("generate_jpegs")
+            )
+        else:
+            fps_in = fps
+        prim_fps = generate_jpegs.map(fps_in)
+        callback_result = utils.collect_callback(fps, prim_fps, incremental)
+    # with the elements of the rejected inputs, in the listing order
+    callback_result = utils.listing_order(callback_result, submitted, rejected)
 
     send_callback_task = utils.send_callback_body.submit(
         x_no_api=x_no_api,
         token=token,
         callback_url=callback_url,
         files_elts=callback_result,
+        summary=x_callback_batch > 0,
     )
 
     utils.final_cleanup_task.submit(
-        fps_future, x_keep_workdir, wait_for=[allow_failure(send_callback_task)]
+        fps, x_keep_workdir, wait_for=[allow_failure(send_callback_task)]
     ).wait()
 
     return callback_result
@@ -3,9 +3,12 @@ import shutil
 import os
 from typing import List, Dict, Optional, AnyStr
 from pathlib import Path
+from urllib.parse import quote, unquote
 import tempfile
 import subprocess
+import uuid
 
+from distributed import get_worker
 from prefect import get_run_logger
 from prefect.exceptions import MissingContextError
 
@@ -34,12 +37,36 @@ class FilePath:
     An "asset" is a resource the Hedwig Web application uses. For example an asset might be an image,
     or a movie, or output of the pipeline, that the web application users care about.
 
+    The FilePaths are created for all the inputs before any work starts, and copied to the dask worker of
+    each task, so they only hold a few paths, and their directories are created on first use, by the worker using
+    them.
+
     :todo: Consider making entire class immutable
     """
 
+    # subdir of the working dir holding, for each declared intermediate, a marker file per pending consumer
+    INTERMEDIATES_DIR = ".intermediates"
+    # subdir of the working dir holding the copy of the input, see utils.prefetch
+    PREFETCH_DIR = "prefetch"
+    # file of the shared working dir of an input whose local working dir was lost, see use_shared_work_dir
+    LOST_MARKER = "lost_local_work_dir"
+
+    __slots__ = (
+        "proj_dir",
+        "fp_in",
+        "base",
+        "worker",
+        "input_bytes",
+        "proj_root",
+        "asset_root",
+        "_working_dir",
+        "_assets_dir",
+        "_made_dirs",
+    )
+
     def __init__(self, share_name: str, input_dir: Path, fp_in: Path) -> None:
         """
-        sets up:
+        sets up, without creating them:
 
         - _working_dir (fast disk where IO can occur)
         - _assets_dir (slow / big disk where outputs get moved to)
@@ -51,37 +78,77 @@ class FilePath:
         # not a great name - used to create the subdir into which assets are put eg
         self.base = fp_in.stem
         self._working_dir = self.make_work_dir()
+        # address of the dask worker holding a node-local working dir, see use_local_work_dir
+        self.worker = None
+        # size of the input when listed, see utils.gen_fps
+        self.input_bytes = None
         self._assets_dir = self.make_assets_dir()
-        self.environment = self.get_environment()
         self.proj_root = Path(Config.proj_dir(share_name=share_name))
         self.asset_root = Path(Config.assets_dir(share_name=share_name))
-        self.prim_fp_elt = self.gen_prim_fp_elt()
+        # directories already created by this copy of the FilePath
+        self._made_dirs = set()
 
     def __str__(self) -> str:
         return f"FilePath: proj_root:{self.proj_root}\n\
                 fp_in:{self.fp_in}\n\
-                prim_fp:{self.prim_fp_elt}\n\
-                working_dir:{self.working_dir}\n\
-                assets_dir: {self.assets_dir}."
+                working_dir:{self._working_dir}\n\
+                assets_dir: {self._assets_dir}."
+
+    def _make_dir(self, path: Path) -> Path:
+        """
+        Creates path once for this copy of the FilePath.
+        """
+        if path not in self._made_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._made_dirs.add(path)
+        return path
 
     @property
     def assets_dir(self) -> Path:
         """
-        the top level directory where results are left.
+        the top level directory where results are left, created on first use.
 
         other subdirs are attached here containing the outputs of individual files
         """
-        return self._assets_dir
+        return self._make_dir(self._assets_dir)
 
     @property
     def working_dir(self) -> Path:
         """
         A pathlib.Path of the temporary (high-speed) directory where the working files
-        will be stored. This is a property without a setter to make it immutable.
+        will be stored, created on first use. This is a property without a setter to make it immutable.
         :return: pathlib.Path
         """
 
-        return self._working_dir
+        if self.worker:
+            if not self._working_dir.is_dir():
+                # the flow runs the input again in this shared working dir, see use_shared_work_dir
+                shared_dir = self._make_dir(self._shared_work_dir())
+                (shared_dir / self.LOST_MARKER).write_text(self.worker)
+                raise RuntimeError(
+                    f"Local working dir {self._working_dir} of worker {self.worker} is not on this node, "
+                    "the worker was probably lost"
+                )
+            return self._working_dir
+        return self._make_dir(self._working_dir)
+
+    @property
+    def input_fp(self) -> Path:
+        """
+        The input to read: its copy in the working dir when prefetched, see ``utils.prefetch_input``,
+        otherwise fp_in.
+        """
+        prefetched = self._working_dir / self.PREFETCH_DIR / self.fp_in.name
+        if prefetched.exists():
+            return prefetched
+        return self.fp_in
+
+    @property
+    def environment(self) -> str:
+        """
+        see ``get_environment``
+        """
+        return self.get_environment()
 
     def get_environment(self) -> str:
         """
@@ -98,27 +165,75 @@ class FilePath:
 
     def make_work_dir(self) -> Path:
         """
-        a temporary dir to house all files in the form:
-        {Config.tmp_dir}{fname.stem}.
-        eg: /gs1/home/macmenaminpe/tmp/tmp7gcsl4on/tomogram_fname/
+        a unique temporary dir to house all files in the form:
+        {Config.tmp_dir}/{uuid}.
+        eg: /gs1/home/macmenaminpe/tmp/0f8c1e.../
+        Only named here, created on first use, see ``working_dir``.
         Will be rm'd upon completion.
         """
-        working_dir = Path(tempfile.mkdtemp(dir=f"{Config.tmp_dir}"))
-        return Path(working_dir)
+        return Path(Config.tmp_dir) / uuid.uuid4().hex
+
+    def _shared_work_dir(self) -> Path:
+        """
+        The working dir in the shared scratch, named as the local one, see ``use_local_work_dir``.
+        """
+        return Path(Config.tmp_dir) / self._working_dir.name
+
+    def use_local_work_dir(self) -> None:
+        """
+        Replaces the (empty) working dir in the shared scratch by one in the node-local ``Config.local_tmp_dir``
+        (by default ``$TMPDIR``) of the dask worker running this, which is several times faster for the intermediate
+        files. The downstream tasks
+        of the file must then run on that worker, see ``utils.map_pinned``.
+        Keeps the shared working dir when there is no local dir, or when not running on a dask worker.
+        """
+        try:
+            worker = get_worker()
+        except ValueError:
+            log("Not running on a dask worker, keeping the shared working dir")
+            return
+        try:
+            local_dir = Path(Config.local_tmp_dir or tempfile.gettempdir()) / self._working_dir.name
+            local_dir.mkdir(mode=0o700, parents=True)
+        except OSError as e:
+            log(f"Cannot create a local working dir in {Config.local_tmp_dir}, keeping the shared one: {e}")
+            return
+        shutil.rmtree(self._working_dir, ignore_errors=True)
+        self._working_dir = local_dir
+        self.worker = worker.address
+        log(f"Local working dir {local_dir} on worker {worker.address}")
+
+    def use_shared_work_dir(self) -> bool:
+        """
+        Switches an input whose local working dir was lost with its worker, as recorded by ``working_dir``, back to
+        its working dir in the shared scratch, so that its tasks can run again from the input on any worker, see
+        ``utils.collect_callback``.
+
+        :return: True if the local working dir was lost
+        """
+        if not self.worker:
+            return False
+        shared_dir = self._shared_work_dir()
+        marker = shared_dir / self.LOST_MARKER
+        if not marker.exists():
+            return False
+        log(f"Local working dir {self._working_dir} of worker {self.worker} was lost, using {shared_dir}")
+        marker.unlink()
+        self._working_dir = shared_dir
+        self.worker = None
+        return True
 
     def make_assets_dir(self) -> Path:
         """
         proj_dir comes in the form {mount_point}/RMLEMHedwigQA/Projects/Lab/PI/
-        want to create: {mount_point}/RMLEMHedwigQA/Assets/Lab/PI/
+        want: {mount_point}/RMLEMHedwigQA/Assets/Lab/PI/
+        Only named here, created on first use, see ``assets_dir``.
         """
         if "Projects" not in self.proj_dir.as_posix():
             msg = f"Error: Input directory {self.proj_dir} must contain the string 'Projects'."
             raise RuntimeError(msg)
         assets_dir_as_str = self.proj_dir.as_posix().replace("/Projects", "/Assets")
-        assets_dir = Path(f"{assets_dir_as_str}/{self.base}")
-        assets_dir.mkdir(parents=True, exist_ok=True)
-        log(f"Created Assets dir {assets_dir}")
-        return assets_dir
+        return Path(f"{assets_dir_as_str}/{self.base}")
 
     def copy_to_assets_dir(self, fp_to_cp: Path) -> Path:
         """
@@ -224,6 +339,57 @@ class FilePath:
             imageSet=imageSet,
         )
 
+    def declare_intermediates(self, intermediates: Dict[str, List[str]]) -> None:
+        """
+        Declares working files which are deleted as soon as all the steps consuming them have finished,
+        rather than with the whole working dir after the callback, see ``release_intermediates``.
+        State is kept in the working dir, as the FilePath is copied to each dask worker.
+
+        :param intermediates: glob patterns of files or dirs relative to the working dir, eg ``source.mrc``,
+          mapped to the names of their consumers
+        """
+        for pattern, consumers in intermediates.items():
+            marker_dir = self.working_dir / self.INTERMEDIATES_DIR / quote(pattern, safe="")
+            marker_dir.mkdir(parents=True, exist_ok=True)
+            for consumer in consumers:
+                (marker_dir / consumer).touch()
+
+    def release_intermediates(self, consumer: str, patterns: List[str] = None) -> List[Path]:
+        """
+        Records that ``consumer`` has finished with its declared intermediates, and deletes those which have no
+        other pending consumer. Does nothing for undeclared intermediates, eg when the working dir is kept.
+
+        :param consumer: name of the consumer, as declared in ``declare_intermediates``
+        :param patterns: only release these intermediates, for consumers called for several files
+        :return: list of the deleted files and dirs
+        """
+        intermediates_dir = self.working_dir / self.INTERMEDIATES_DIR
+        if not intermediates_dir.is_dir():
+            return []
+        deleted = list()
+        for marker_dir in intermediates_dir.iterdir():
+            pattern = unquote(marker_dir.name)
+            if patterns is not None and pattern not in patterns:
+                continue
+            marker = marker_dir / consumer
+            if not marker.exists():
+                continue
+            marker.unlink(missing_ok=True)
+            try:
+                # only succeeds for the last consumer, even if several are released concurrently
+                marker_dir.rmdir()
+            except OSError:
+                continue
+            for fp in self.working_dir.glob(pattern):
+                if fp.is_dir():
+                    shutil.rmtree(fp, ignore_errors=True)
+                else:
+                    fp.unlink(missing_ok=True)
+                deleted.append(fp)
+        if deleted:
+            log(f"{consumer} released intermediates: {' '.join(fp.name for fp in deleted)}")
+        return deleted
+
     def copy_workdir_to_assets(self) -> Path:
         """
         - copies all of working dir to Assets dir.
@@ -268,8 +434,9 @@ class FilePath:
 
     def rm_workdir(self):
         """Removes the the entire working directory"""
-        log(f"Removing working dir: {self.working_dir}")
-        shutil.rmtree(self.working_dir, ignore_errors=True)
+        log(f"Removing working dir: {self._working_dir}")
+        shutil.rmtree(self._working_dir, ignore_errors=True)
+        self._made_dirs.discard(self._working_dir)
 
     @staticmethod
     def run(cmd: List[str], log_file: str, env: Optional[Dict[AnyStr, AnyStr]] = None, *, copy_env: bool = True) -> int:
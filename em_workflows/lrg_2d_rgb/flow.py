@@ -3,7 +3,7 @@ from pathlib import Path
 
 import SimpleITK as sitk
 from pytools import HedwigZarrImage, HedwigZarrImages
-from prefect import flow, task
+from prefect import flow, task, unmapped
 
 from em_workflows.utils import utils
 from em_workflows.utils import neuroglancer as ng
@@ -20,58 +20,25 @@ from em_workflows.lrg_2d_rgb.constants import (
 )
 
 
-@task
-def convert_png_to_tiff(file_path: FilePath) -> FilePath:
-    """
-    convert input.png -background white -alpha remove -alpha off ouput.tiff
-    Adding argument: -define tiff:tile-geometry=128x128
-    """
-    input_png = file_path.fp_in.as_posix()
-    output_tiff = f"{file_path.working_dir}/{file_path.base}.tiff"
-    log_fp = f"{file_path.working_dir}/{file_path.base}_as_tiff.log"
-    cmd = [
-        "convert",
-        input_png,
-        "-define",
-        "tiff:tile-geometry=128x128",
-        "-background",
-        "white",
-        "-alpha",
-        "remove",
-        "-alpha",
-        "off",
-        output_tiff,
-    ]
-    utils.log(f"Generated cmd {cmd}")
-    FilePath.run(cmd, log_fp)
-    return file_path
-
-
 @task(
     name="Zarr generation",
 )
-def gen_zarr(file_path: FilePath) -> None:
-    input_tiff = f"{file_path.working_dir}/{file_path.base}.tiff"
-
-    ng.bioformats_gen_zarr(
+def gen_zarr(file_path: FilePath) -> FilePath:
+    """
+    Streams the input image into a chunked and multiscale zarr, alpha removed onto a white background.
+    """
+    ng.stream_gen_zarr(
         file_path=file_path,
-        input_fname=input_tiff,
+        input_fname=file_path.input_fp.as_posix(),
     )
-    return file_path
-
-
-@task(
-    name="Zarr rechunk",
-)
-def rechunk_zarr(file_path: FilePath) -> FilePath:
-    ng.rechunk_zarr(file_path=file_path)
+    file_path.release_intermediates("gen_zarr")
     return file_path
 
 
 @task
-def copy_zarr_to_assets_dir(file_path: FilePath):
+def copy_zarr_to_assets_dir(file_path: FilePath, sharded_zarr: bool = False):
     output_zarr = Path(f"{file_path.working_dir}/{file_path.base}.zarr")
-    file_path.copy_to_assets_dir(fp_to_cp=Path(output_zarr))
+    ng.copy_zarr_to_assets_dir(file_path, output_zarr, sharded=sharded_zarr)
     return file_path
 
 
@@ -100,7 +67,10 @@ def generate_ng_asset(file_path: FilePath) -> Dict:
     ng_asset["metadata"] = dict(
         shader=hw_image.shader_type,
         dimensions="XY",
-        shaderParameters=hw_image.neuroglancer_shader_parameters(),
+        # the zarr is already in the assets, see copy_zarr_to_assets_dir, the parameters are cached there too
+        shaderParameters=ng.neuroglancer_shader_parameters(
+            hw_image, assets_group=asset_fp / hw_image.path.name
+        ),
     )
     return ng_asset
 
@@ -162,11 +132,23 @@ def lrg_2d_flow(
     token: Optional[str] = None,
     x_no_api: bool = False,
     x_keep_workdir: bool = False,
+    x_sharded_zarr: bool = False,
+    x_order: str = "listed",
+    x_prefetch: bool = False,
+    x_callback_batch: int = 0,
 ):
     """
     -list all png inputs (assumes all are "large")
     -create tmp dir for each.
-    -convert to tiff -> zarr -> jpegs (thumb)
+    -stream to zarr -> jpegs (thumb)
+
+    :param x_sharded_zarr: write the zarr assets as zarr v3 with sharded arrays, which have far fewer files
+    :param x_order: order of submission of the files, "listed", "smallest" or "largest" first, see
+      ``utils.submission_order``. The callback keeps the listing order.
+    :param x_prefetch: copy each input into its working dir before it is read, with the copies bounded across the
+      workers, see ``utils.prefetch``
+    :param x_callback_batch: post the callback elements of the files as they complete, by batches of this many
+      files, before the final callback with all the files, see ``utils.IncrementalCallback``. 0 for the final only.
     """
     utils.notify_api_running(x_no_api, token, callback_url)
 
@@ -181,31 +163,40 @@ def lrg_2d_flow(
     )
     fps = utils.gen_fps.submit(
         share_name=file_share, input_dir=input_dir_fp, fps_in=input_fps
+    ).result()
+    # bad inputs are reported in the callback, without scheduling any of their heavy work
+    rejected = utils.preflight.submit(fps, "lrg_2d").result()
+    incremental = utils.IncrementalCallback(
+        x_callback_batch, x_no_api, token, callback_url
+    )
+    incremental.add(rejected)
+    submitted = utils.submission_order.submit(fps, x_order, rejected).result()
+    fps = [fps[idx] for idx in submitted]
+    if x_prefetch:
+        fps_in = utils.prefetch_input.map(file_path=fps, consumer=unmapped("gen_zarr"))
+    else:
+        fps_in = fps
+    zarrs = gen_zarr.map(file_path=fps_in)
+    copy_to_assets = copy_zarr_to_assets_dir.map(
+        file_path=zarrs, sharded_zarr=unmapped(x_sharded_zarr)
     )
-    tiffs = convert_png_to_tiff.map(file_path=fps)
-    zarrs = gen_zarr.map(file_path=tiffs)
-    rechunk = rechunk_zarr.map(file_path=zarrs)
-    copy_to_assets = copy_zarr_to_assets_dir.map(file_path=rechunk)
     zarr_assets = generate_ng_asset.map(file_path=copy_to_assets)
-    thumb_assets = gen_thumb.map(file_path=rechunk)
+    thumb_assets = gen_thumb.map(file_path=zarrs)
     prim_fps = utils.gen_prim_fps.map(fp_in=fps)
     callback_with_thumbs = utils.add_asset.map(prim_fp=prim_fps, asset=thumb_assets)
     callback_with_pyramids = utils.add_asset.map(
-        prim_fp=callback_with_thumbs, asset=zarr_assets, return_state=True
+        prim_fp=callback_with_thumbs, asset=zarr_assets
     )
 
-    callback_result = list()
-    for idx, (fp, cb) in enumerate(zip(fps.result(), callback_with_pyramids)):
-        try:
-            callback_result.append(cb.result())
-        except Exception as e:
-            callback_result.append(fp.gen_prim_fp_elt(f"Error: {str(e)}"))
+    callback_result = utils.collect_callback(fps, callback_with_pyramids, incremental)
+    callback_result = utils.listing_order(callback_result, submitted, rejected)
 
     send_callback_task = utils.send_callback_body.submit(
         x_no_api=x_no_api,
         token=token,
         callback_url=callback_url,
         files_elts=callback_result,
+        summary=x_callback_batch > 0,
     )
 
     utils.final_cleanup_task.submit(
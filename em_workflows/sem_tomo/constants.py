@@ -1,3 +0,0 @@
-FIBSEM_DEPTH = 128
-FIBSEM_HEIGHT = 128
-FIBSEM_WIDTH = 128
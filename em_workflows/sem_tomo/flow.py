@@ -22,10 +22,10 @@ Sem Tomo pipeline overview:
 import glob
 import math
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 from natsort import os_sorted
 
-from prefect import flow, task, unmapped, allow_failure
+from prefect import flow, task, allow_failure
 from pytools.HedwigZarrImages import HedwigZarrImages
 
 from em_workflows.utils import utils
@@ -33,7 +33,15 @@ from em_workflows.utils import neuroglancer as ng
 from em_workflows.file_path import FilePath
 from em_workflows.constants import AssetType
 from em_workflows.sem_tomo.config import SEMConfig
-from em_workflows.sem_tomo.constants import FIBSEM_DEPTH, FIBSEM_HEIGHT, FIBSEM_WIDTH
+
+# working files deleted as soon as their consumers have finished, see utils.declare_intermediates
+INTERMEDIATES = {
+    "source.mrc": ["gen_xfalign_comand", "gen_newstack_combi"],
+    "adjusted.mrc": ["mrc_to_movie", "gen_newstack_mid_mrc_command", "gen_zarr"],
+    "{base}_mp4.*.jpg": ["mrc_to_movie"],
+    "mid.mrc": ["gen_keyimg"],
+    "{base}.zarr": ["gen_ng_metadata"],
+}
 
 
 @task(
@@ -60,6 +68,7 @@ def gen_xfalign_comand(fp_in: FilePath) -> FilePath:
         align_xf.as_posix(),
     ]
     FilePath.run(cmd=cmd, log_file=log_file)
+    fp_in.release_intermediates("gen_xfalign_comand")
     return fp_in
 
 
@@ -118,6 +127,7 @@ def gen_newstack_combi(fp_in: FilePath, stretch: None) -> Dict:
     ]
     utils.log(f"Created {cmd}")
     FilePath.run(cmd=cmd, log_file=log_file)
+    fp_in.release_intermediates("gen_newstack_combi")
     assets_fp_adjusted_mrc = fp_in.copy_to_assets_dir(fp_to_cp=base_mrc)
     return fp_in.gen_asset(
         asset_type=AssetType.AVERAGED_VOLUME, asset_fp=assets_fp_adjusted_mrc
@@ -137,13 +147,14 @@ def convert_tif_to_mrc(file_path: FilePath) -> FilePath:
     """
     output_fp = file_path.gen_output_fp(out_fname="source.mrc")
     log_file = f"{output_fp.parent}/tif2mrc.log"
-    files = glob.glob(f"{file_path.fp_in.as_posix()}/*.tif")
+    files = glob.glob(f"{file_path.input_fp.as_posix()}/*.tif")
 
     cmd = [SEMConfig.tif2mrc_loc]
     cmd.extend(os_sorted(files))
     cmd.append(output_fp.as_posix())
     utils.log(f"Created {cmd}")
     FilePath.run(cmd=cmd, log_file=log_file)
+    file_path.release_intermediates("convert_tif_to_mrc")
     return file_path
 
 
@@ -193,6 +204,7 @@ def gen_newstack_mid_mrc_command(fp_in: FilePath, **kwargs) -> FilePath:
     ]
     utils.log(f"Created {cmd}")
     FilePath.run(cmd=cmd, log_file=log_file)
+    fp_in.release_intermediates("gen_newstack_mid_mrc_command")
     return fp_in
 
 
@@ -216,6 +228,7 @@ def gen_keyimg(fp_in: FilePath) -> Dict:
     ]
     utils.log(f"Created keyimg {cmd}")
     FilePath.run(cmd=cmd, log_file=log_file)
+    fp_in.release_intermediates("gen_keyimg")
     asset_fp = fp_in.copy_to_assets_dir(fp_to_cp=keyimg_fp)
     keyimg_asset = fp_in.gen_asset(asset_type=AssetType.KEY_IMAGE, asset_fp=asset_fp)
     return keyimg_asset
@@ -255,7 +268,11 @@ def gen_keyimg_small(fp_in: FilePath) -> Dict:
 @task(
     name="Zarr generation",
 )
-def gen_zarr(fp_in: FilePath, **kwargs) -> FilePath:
+def gen_zarr(fp_in: FilePath, sharded_zarr: bool = False, **kwargs) -> FilePath:
+    """
+    Converts the adjusted mrc to zarr and builds its multiscales in the working directory, then copies it to the
+    assets directory, as a sharded zarr v3 if ``sharded_zarr``.
+    """
     file_path = fp_in
     # fallback mrc file
     input_file = file_path.fp_in.as_posix()
@@ -267,15 +284,12 @@ def gen_zarr(fp_in: FilePath, **kwargs) -> FilePath:
     ng.bioformats_gen_zarr(
         file_path=file_path,
         input_fname=input_file,
-        depth=FIBSEM_DEPTH,
-        width=FIBSEM_WIDTH,
-        height=FIBSEM_HEIGHT,
         resolutions=1,
     )
     output_zarr = Path(f"{file_path.working_dir}/{file_path.base}.zarr")
-    file_path.copy_to_assets_dir(fp_to_cp=Path(output_zarr))
-
-    ng.zarr_build_multiscales(fp_in)
+    ng.zarr_build_multiscales2(output_zarr)
+    file_path.release_intermediates("gen_zarr")
+    ng.copy_zarr_to_assets_dir(file_path, output_zarr, sharded=sharded_zarr)
     return fp_in
 
 
@@ -311,80 +325,91 @@ def gen_ng_metadata(fp_in: FilePath) -> Dict:
     ng_asset["metadata"] = dict(
         shader=hw_image.shader_type,
         dimensions=hw_image.dims,
-        shaderParameters=hw_image.neuroglancer_shader_parameters(mad_scale=5.0),
+        # the zarr is already in the assets, see gen_zarr, the parameters are cached there too
+        shaderParameters=ng.neuroglancer_shader_parameters(
+            hw_image, assets_group=asset_fp / hw_image.path.name, mad_scale=5.0
+        ),
     )
+    file_path.release_intermediates("gen_ng_metadata")
     return ng_asset
 
 
-@flow(
-    name="SEM TOMO",
-    flow_run_name=utils.generate_flow_run_name,
-    log_prints=True,
-    task_runner=SEMConfig.get_slurm_task_runner(),
-    on_completion=[utils.notify_api_completion],
-    on_failure=[utils.notify_api_completion],
-    on_crashed=[utils.notify_api_completion],
-)
-def sem_tomo_flow(
-    file_share: str,
-    input_dir: str,
-    x_file_name: Optional[str] = None,
-    callback_url: Optional[str] = None,
-    token: Optional[str] = None,
-    x_no_api: bool = False,
-    x_keep_workdir: bool = False,
-    tilt_angle: float = 0,
-):
-    utils.notify_api_running(x_no_api, token, callback_url)
+def map_pipeline(
+    fps: List[FilePath],
+    tilt_angle: float,
+    x_keep_workdir: bool,
+    x_sharded_zarr: bool,
+    x_prefetch: bool = False,
+) -> List:
+    """
+    Submits a task per step and file.
 
-    input_dir_fp = utils.get_input_dir.submit(
-        share_name=file_share, input_dir=input_dir
+    :return: for each file, the future of its callback element
+    """
+    # intermediates are deleted by their last consumer, rather than with the working dir
+    declared_fps = utils.map_pinned(
+        utils.declare_intermediates,
+        fps,
+        file_path=fps,
+        intermediates=INTERMEDIATES,
+        x_keep_workdir=x_keep_workdir,
     )
-    # note FIBSEM is different to other flows in that it uses *directories*
-    # to define stacks. Therefore, will have to list dirs to discover stacks
-    # (rather than eg mrc files)
-    input_dir_fps = utils.list_dirs.submit(input_dir_fp=input_dir_fp)
-
-    fps = utils.gen_fps.submit(
-        share_name=file_share, input_dir=input_dir_fp, fps_in=input_dir_fps
+    # heavy steps wait for enough free scratch space
+    admitted_fps = utils.map_pinned(
+        utils.admit_to_scratch, fps, file_path=declared_fps, workflow="sem"
     )
-    tif_to_mrc = convert_tif_to_mrc.map(fps)
+    if x_prefetch:
+        admitted_fps = utils.map_pinned(
+            utils.prefetch_input,
+            fps,
+            file_path=admitted_fps,
+            consumer="convert_tif_to_mrc",
+        )
+    tif_to_mrc = utils.map_pinned(convert_tif_to_mrc, fps, file_path=admitted_fps)
 
     # using source.mrc gen align.xf
-    align_xfs = gen_xfalign_comand.map(fp_in=tif_to_mrc)
+    align_xfs = utils.map_pinned(gen_xfalign_comand, fps, fp_in=tif_to_mrc)
 
     # using align.xf create align.xg
-    align_xgs = gen_align_xg.map(fp_in=align_xfs)
+    align_xgs = utils.map_pinned(gen_align_xg, fps, fp_in=align_xfs)
 
     # create stretch file using tilt_parameter
-    stretchs = create_stretch_file.map(tilt=unmapped(tilt_angle), fp_in=fps)
+    stretchs = utils.map_pinned(create_stretch_file, fps, tilt=tilt_angle, fp_in=fps)
 
-    base_mrcs = gen_newstack_combi.map(fp_in=align_xgs, stretch=stretchs)
+    base_mrcs = utils.map_pinned(
+        gen_newstack_combi, fps, fp_in=align_xgs, stretch=stretchs
+    )
     # base_mrcs are passed in as kwargs to replace wait_for
 
-    corrected_movie_assets = utils.mrc_to_movie.map(
+    corrected_movie_assets = utils.map_pinned(
+        utils.mrc_to_movie,
+        fps,
         file_path=fps,
-        root=unmapped("adjusted"),
-        asset_type=unmapped(AssetType.REC_MOVIE),
+        root="adjusted",
+        asset_type=AssetType.REC_MOVIE,
         base_mrc=base_mrcs,
     )
 
     # generate midpoint mrc file
-    mid_mrcs = gen_newstack_mid_mrc_command.map(
+    mid_mrcs = utils.map_pinned(
+        gen_newstack_mid_mrc_command,
+        fps,
         fp_in=fps,
         base_mrc=base_mrcs,
     )
 
     # large thumb
-    keyimg_assets = gen_keyimg.map(fp_in=mid_mrcs)
+    keyimg_assets = utils.map_pinned(gen_keyimg, fps, fp_in=mid_mrcs)
     # small thumb
-    thumb_assets = gen_keyimg_small.map(
-        fp_in=fps, wait_for=[allow_failure(keyimg_assets)]
+    thumb_assets = utils.map_pinned(
+        gen_keyimg_small, fps, fp_in=fps, wait_for=[allow_failure(keyimg_assets)]
     )
 
     # zarr file generation
-    zarrs = gen_zarr.map(fp_in=fps, base_mrc=base_mrcs)
-    pyramid_assets = gen_ng_metadata.map(fp_in=zarrs)
+    zarrs = utils.map_pinned(
+        gen_zarr, fps, fp_in=fps, sharded_zarr=x_sharded_zarr, base_mrc=base_mrcs
+    )
+    pyramid_assets = utils.map_pinned(gen_ng_metadata, fps, fp_in=zarrs)
 
     # this is the toplevel element (the input file basically) onto which
     # the "assets" (ie the outputs derived from this file) are hung.
@@ -400,25 +425,171 @@ def sem_tomo_flow(
         prim_fp=callback_with_pyramids, asset=base_mrcs
     )
     callback_with_corr_movies = utils.add_asset.map(
-        prim_fp=callback_with_corr_mrcs, asset=corrected_movie_assets, return_state=True
+        prim_fp=callback_with_corr_mrcs, asset=corrected_movie_assets
+    )
+    return callback_with_corr_movies
+
+
+@task(name="SEM fused pipeline")
+def fused_pipeline(
+    file_path: FilePath,
+    tilt_angle: float,
+    x_keep_workdir: bool,
+    sharded_zarr: bool = False,
+    prefetch: bool = False,
+) -> Dict:
+    """
+    Runs all the steps of a file in this task, see ``utils.StageRunner``, rather than a task per step as
+    ``map_pipeline`` does, which saves their scheduling and state updates and keeps the intermediates in the page
+    cache of the node.
+
+    :return: the callback element of the file
+    """
+    stages = utils.StageRunner(file_path)
+    stages.run(
+        utils.declare_intermediates,
+        file_path=file_path,
+        intermediates=INTERMEDIATES,
+        x_keep_workdir=x_keep_workdir,
+    )
+    stages.run(utils.admit_to_scratch, file_path=file_path, workflow="sem")
+    if prefetch:
+        stages.run(
+            utils.prefetch_input, file_path=file_path, consumer="convert_tif_to_mrc"
+        )
+    stages.run(convert_tif_to_mrc, file_path=file_path)
+    stages.run(gen_xfalign_comand, fp_in=file_path)
+    stages.run(gen_align_xg, fp_in=file_path)
+    stages.run(create_stretch_file, tilt=tilt_angle, fp_in=file_path)
+    base_mrc_asset = stages.run(gen_newstack_combi, fp_in=file_path, stretch=None)
+    movie_asset = stages.run(
+        utils.mrc_to_movie,
+        file_path=file_path,
+        root="adjusted",
+        asset_type=AssetType.REC_MOVIE,
+    )
+    stages.run(gen_newstack_mid_mrc_command, fp_in=file_path)
+    keyimg_asset = stages.run(gen_keyimg, fp_in=file_path)
+    thumb_asset = stages.run(gen_keyimg_small, fp_in=file_path)
+    stages.run(gen_zarr, fp_in=file_path, sharded_zarr=sharded_zarr)
+    pyramid_asset = stages.run(gen_ng_metadata, fp_in=file_path)
+
+    utils.log(
+        f"{file_path.base}: {len(stages.timings)} steps in {sum(s for _, s in stages.timings):.1f}s"
+    )
+    # same order of the assets as map_pipeline
+    prim_fp = utils.gen_prim_fps.fn(fp_in=file_path)
+    for asset in (
+        thumb_asset,
+        keyimg_asset,
+        pyramid_asset,
+        base_mrc_asset,
+        movie_asset,
+    ):
+        prim_fp = utils.add_asset.fn(prim_fp=prim_fp, asset=asset)
+    return prim_fp
+
+
+@flow(
+    name="SEM TOMO",
+    flow_run_name=utils.generate_flow_run_name,
+    log_prints=True,
+    task_runner=SEMConfig.get_slurm_task_runner(),
+    on_completion=[utils.notify_api_completion],
+    on_failure=[utils.notify_api_completion],
+    on_crashed=[utils.notify_api_completion],
+)
+def sem_tomo_flow(
+    file_share: str,
+    input_dir: str,
+    x_file_name: Optional[str] = None,
+    callback_url: Optional[str] = None,
+    token: Optional[str] = None,
+    x_no_api: bool = False,
+    x_keep_workdir: bool = False,
+    x_sharded_zarr: bool = False,
+    x_local_scratch: bool = False,
+    x_fused: bool = False,
+    x_order: str = "listed",
+    x_prefetch: bool = False,
+    x_callback_batch: int = 0,
+    tilt_angle: float = 0,
+):
+    """
+    :param x_sharded_zarr: write the zarr asset as a zarr v3 with sharded arrays, which has far fewer files
+    :param x_local_scratch: put the working dirs on the local disk of the dask workers, rather than the shared
+      scratch, and run all the tasks of each file on its worker. A file whose worker is lost is run again in the
+      shared scratch.
+    :param x_fused: run all the steps of each file in a single task, see ``fused_pipeline``
+    :param x_order: order of submission of the files, "listed", "smallest" or "largest" first, see
+      ``utils.submission_order``. The callback keeps the listing order.
+    :param x_prefetch: copy each stack dir into its working dir before tif2mrc reads it, with the copies bounded
+      across the workers, see ``utils.prefetch``
+    :param x_callback_batch: post the callback elements of the files as they complete, by batches of this many
+      files, before the final callback with all the files, see ``utils.IncrementalCallback``. 0 for the final only.
+    """
+    utils.notify_api_running(x_no_api, token, callback_url)
+
+    input_dir_fp = utils.get_input_dir.submit(
+        share_name=file_share, input_dir=input_dir
     )
+    # note FIBSEM is different to other flows in that it uses *directories*
+    # to define stacks. Therefore, will have to list dirs to discover stacks
+    # (rather than eg mrc files)
+    input_dir_fps = utils.list_dirs.submit(input_dir_fp=input_dir_fp)
 
-    callback_result = list()
-    for idx, (fp, cb) in enumerate(zip(fps.result(), callback_with_corr_movies)):
-        try:
-            callback_result.append(cb.result())
-        except Exception as e:
-            callback_result.append(fp.gen_prim_fp_elt(f"Error: {str(e)}."))
+    fps = utils.gen_fps.submit(
+        share_name=file_share, input_dir=input_dir_fp, fps_in=input_dir_fps
+    ).result()
+    # bad inputs are reported in the callback, without scheduling any of their heavy work
+    rejected = utils.preflight.submit(fps, "sem").result()
+    incremental = utils.IncrementalCallback(
+        x_callback_batch, x_no_api, token, callback_url
+    )
+    incremental.add(rejected)
+    submitted = utils.submission_order.submit(fps, x_order, rejected).result()
+    fps = [fps[idx] for idx in submitted]
+    if x_local_scratch:
+        # working dirs on the local disk of the workers, the tasks of each file are pinned to its worker
+        fps = utils.use_local_work_dir.map(fps).result()
+
+    def pipeline(file_paths: List[FilePath]) -> List:
+        if x_fused:
+            # one task per file, without the orchestration overhead between its steps
+            return utils.map_pinned(
+                fused_pipeline,
+                file_paths,
+                file_path=file_paths,
+                tilt_angle=tilt_angle,
+                x_keep_workdir=x_keep_workdir,
+                sharded_zarr=x_sharded_zarr,
+                prefetch=x_prefetch,
+            )
+        return map_pipeline(
+            file_paths, tilt_angle, x_keep_workdir, x_sharded_zarr, x_prefetch
+        )
+
+    # the files whose local working dir was lost with their worker are run again in the shared scratch
+    callback_result = utils.collect_callback(
+        fps, pipeline(fps), incremental, rerun=pipeline if x_local_scratch else None
+    )
+    callback_result = utils.listing_order(callback_result, submitted, rejected)
 
     send_callback_task = utils.send_callback_body.submit(
         x_no_api=x_no_api,
         token=token,
         callback_url=callback_url,
         files_elts=callback_result,
+        summary=x_callback_batch > 0,
     )
 
-    utils.final_cleanup_task.submit(
-        fps, x_keep_workdir, wait_for=[utils.allow_failure(send_callback_task)]
+    # each working dir is cleaned up on its worker
+    utils.map_pinned(
+        utils.final_cleanup_task,
+        fps,
+        fps=[[fp] for fp in fps],
+        x_keep_workdir=x_keep_workdir,
+        wait_for=[utils.allow_failure(send_callback_task)],
     ).wait()
 
     return callback_result
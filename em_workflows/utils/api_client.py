@@ -0,0 +1,100 @@
+"""
+Client of the calls to the API: the status of the flow runs and the callback bodies.
+
+All the calls of a process go through a single ``httpx.Client``, which keeps its
+connections alive between calls (up to ``API_KEEPALIVE_SECONDS``), rather than a TCP and
+TLS handshake per call. HTTP/2 is used when the ``h2`` package is installed
+(``httpx[http2]``). The CA bundle is ``REQUESTS_CA_BUNDLE`` when set, as for the rest of
+the workflows, see ``config.py``.
+
+With ``HEDWIG_API_GZIP`` set (``Config.api_gzip``), bodies of ``API_GZIP_MIN_BYTES`` or
+more, eg the callback of a directory of many files, are sent gzipped. An API answering a
+gzipped body with a client error (4xx, eg 400, 415 or 422 from an API which does not
+decode it) gets it again uncompressed, and no longer gzipped ones from this process.
+"""
+import gzip
+import importlib.util
+import json
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from em_workflows.config import Config
+from em_workflows.constants import (
+    API_GZIP_MIN_BYTES,
+    API_KEEPALIVE_SECONDS,
+    API_MAX_CONNECTIONS,
+    API_TIMEOUT_SECONDS,
+)
+
+_lock = threading.Lock()
+# client of the process, recreated in forked processes, which must not share its
+# connections
+_client: Optional[Tuple[int, httpx.Client]] = None
+# cleared once the API rejects a gzipped body
+_gzip_accepted = True
+
+
+def _verify():
+    return (os.environ.get("REQUESTS_CA_BUNDLE") or "").strip() or True
+
+
+def get_client() -> httpx.Client:
+    """
+    :return: the client of the process, created on first use
+    """
+    global _client
+    with _lock:
+        if _client is None or _client[0] != os.getpid() or _client[1].is_closed:
+            client = httpx.Client(
+                verify=_verify(),
+                http2=importlib.util.find_spec("h2") is not None,
+                timeout=API_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=API_MAX_CONNECTIONS,
+                    max_keepalive_connections=API_MAX_CONNECTIONS,
+                    keepalive_expiry=API_KEEPALIVE_SECONDS,
+                ),
+            )
+            _client = (os.getpid(), client)
+        return _client[1]
+
+
+def encode_body(data: Dict, compress: bool = True) -> Tuple[bytes, Dict[str, str]]:
+    """
+    :return: the JSON body of data, gzipped if compress and at least
+      ``API_GZIP_MIN_BYTES``, and its headers
+    """
+    body = json.dumps(data).encode()
+    headers = {"Content-Type": "application/json"}
+    if compress and len(body) >= API_GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def _use_gzip() -> bool:
+    with _lock:
+        return Config.api_gzip and _gzip_accepted
+
+
+def post(url: str, token: str, data: Dict) -> httpx.Response:
+    """
+    Posts data as JSON to url of the API.
+
+    :param token: bearer token of the API
+    :return: the response, whatever its status
+    """
+    global _gzip_accepted
+    body, headers = encode_body(data, compress=_use_gzip())
+    headers["Authorization"] = "Bearer " + token
+    response = get_client().post(url, content=body, headers=headers)
+    if response.is_client_error and "Content-Encoding" in headers:
+        with _lock:
+            _gzip_accepted = False
+        body, headers = encode_body(data, compress=False)
+        headers["Authorization"] = "Bearer " + token
+        response = get_client().post(url, content=body, headers=headers)
+    return response
@@ -1,20 +1,372 @@
+import json
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+import zarr
+from distributed import get_worker, worker_client
+from numcodecs import Blosc
+from pytools.HedwigZarrImage import HedwigZarrImage
 from pytools.HedwigZarrImages import HedwigZarrImages
 from em_workflows.config import Config
 from em_workflows.file_path import FilePath
-from em_workflows.constants import BIOFORMATS_NUM_WORKERS, RECHUNK_SIZE
-from em_workflows.utils import utils
+from em_workflows.constants import (
+    BIOFORMATS_BYTES_PER_WORKER,
+    BIOFORMATS_MAX_CONCURRENT_SERIES,
+    BIOFORMATS_NUM_WORKERS,
+    JAVA_HEAP_MEMORY_FRACTION,
+    JAVA_MAX_HEAP_MB,
+    JAVA_MIN_HEAP_MB,
+    SHADER_PARAMETERS_MIN_PIXELS,
+    ZARR_CHUNK_ALIGN,
+    ZARR_CHUNK_TARGET_BYTES,
+    ZARR_CODECS,
+    ZARR_COMPRESSION_RATIO,
+    ZARR_FAST_CODEC,
+)
+from em_workflows.utils import sharding, utils
 from em_workflows.config import setup_pytools_log
 
 setup_pytools_log()
 
 
+def _plan_level_chunks(shape: Tuple[int, ...], n_pixels: float) -> Tuple[int, ...]:
+    """
+    Splits a chunk of ``n_pixels`` between the axes of ``shape``. Axes smaller than an equal split are covered by a
+    single chunk, from the smallest, and the other axes share the remaining pixels equally.
+    """
+    chunks = list(shape)
+    axes = sorted(range(len(shape)), key=lambda i: shape[i])
+    for n, axis in enumerate(axes):
+        edge = n_pixels ** (1 / (len(axes) - n))
+        edge = max(ZARR_CHUNK_ALIGN, round(edge / ZARR_CHUNK_ALIGN) * ZARR_CHUNK_ALIGN)
+        if shape[axis] > edge:
+            for larger_axis in axes[n:]:
+                chunks[larger_axis] = edge
+            break
+        n_pixels = max(1.0, n_pixels / shape[axis])
+    return tuple(chunks)
+
+
+def plan_chunks(
+    shape: Tuple[int, ...],
+    dtype,
+    channels: int = 1,
+    target_bytes: int = ZARR_CHUNK_TARGET_BYTES,
+    levels: int = None,
+) -> List[Tuple[int, ...]]:
+    """
+    Plans the chunk shape of each level of a multiscale zarr, for chunks of about ``target_bytes`` once compressed.
+
+    Thin axes (eg the Z of a thin tomogram) are covered by a single chunk and the remaining pixels of the chunk are
+    spread over the other axes, rather than padding fixed shape chunks. Chunks with all the ``channels`` are sized
+    for the dtype, so large 8-bit images get fewer, larger chunks. Lower levels, which are 2x downsampled along
+    each axis larger than 1, get the same chunks clipped to their shape.
+
+    :param shape: spatial shape of the full resolution level, eg z, y, x
+    :param dtype: numpy dtype of the pixels
+    :param channels: number of channels stored in each chunk
+    :param target_bytes: compressed size of a chunk, assuming ``ZARR_COMPRESSION_RATIO``
+    :param levels: number of levels, by default down to the first level held in a single chunk
+    :return: the chunk shape, with the axes of ``shape``, of each level
+    """
+    n_pixels = (
+        target_bytes * ZARR_COMPRESSION_RATIO / (np.dtype(dtype).itemsize * channels)
+    )
+    plan = []
+    while levels is None or len(plan) < levels:
+        plan.append(_plan_level_chunks(shape, n_pixels))
+        if levels is None and plan[-1] == tuple(shape):
+            break
+        shape = tuple(-(-size // 2) if size > 1 else size for size in shape)
+    return plan
+
+
+_BLOSC_SHUFFLE = {
+    "noshuffle": Blosc.NOSHUFFLE,
+    "shuffle": Blosc.SHUFFLE,
+    "bitshuffle": Blosc.BITSHUFFLE,
+}
+
+
+def select_codec(dtype, speed_critical: bool = False) -> Blosc:
+    """
+    Selects the blosc compressor of a zarr output by its pixel type, from ``ZARR_CODECS``: eg byte shuffle for
+    16-bit data, whose high bytes are mostly constant, and a lower zstd level for floats, which compress little.
+
+    :param dtype: numpy dtype of the pixels
+    :param speed_critical: use the faster lz4 of ``ZARR_FAST_CODEC``, for outputs written and read once, eg
+      intermediate zarrs
+    """
+    itemsize = np.dtype(dtype).itemsize
+    cname, clevel, shuffle = ZARR_CODECS.get(itemsize, ZARR_CODECS[4])
+    if speed_critical:
+        cname, clevel = ZARR_FAST_CODEC
+    if itemsize == 1:
+        shuffle = "noshuffle"
+    return Blosc(cname=cname, clevel=clevel, shuffle=_BLOSC_SHUFFLE[shuffle])
+
+
+def _bioformats_compression_args(codec: Blosc) -> List[str]:
+    config = codec.get_config()
+    return [
+        "--compression",
+        "blosc",
+        "--compression-properties",
+        f"cname={config['cname']}",
+        "--compression-properties",
+        f"clevel={config['clevel']}",
+        "--compression-properties",
+        f"shuffle={config['shuffle']}",
+    ]
+
+
 def rechunk_zarr(file_path: FilePath) -> None:
     zarr_fp = Path(f"{file_path.working_dir}/{file_path.base}.zarr")
     utils.log(f"{zarr_fp} output zarr")
     images = HedwigZarrImages(zarr_fp, read_only=False)
     for _, image in images.series():
-        image.rechunk(RECHUNK_SIZE, in_memory=True)
+        group = zarr.open_group(image.path.as_posix(), mode="r")
+        # arrays are TCZYX, channels are not split between chunks
+        array = group[group.attrs["multiscales"][0]["datasets"][0]["path"]]
+        _, channels, *shape = array.shape
+        chunks = plan_chunks(shape, array.dtype, channels=channels, levels=1)[0]
+        codec = select_codec(array.dtype)
+        utils.log(
+            f"Rechunking {image.path} of shape {array.shape} to {chunks} with {codec}"
+        )
+        image.rechunk(max(chunks[1:]), compressor=codec, in_memory=True)
+
+
+# zarr attribute of the series group caching the shader parameters, keyed by their arguments
+SHADER_PARAMETERS_ATTR = "neuroglancerShaderParameters"
+
+
+def _select_statistics_level(group: zarr.Group, min_pixels: int) -> str:
+    """
+    :return: path of the smallest pyramid level of the multiscale ``group`` with at least ``min_pixels`` pixels
+      per channel, or the full resolution level if none is that large.
+    """
+    paths = [dataset["path"] for dataset in group.attrs["multiscales"][0]["datasets"]]
+    for path in reversed(paths):
+        # arrays are TCZYX
+        if np.prod(group[path].shape[2:]) >= min_pixels:
+            return path
+    return paths[0]
+
+
+def _write_group_attr(group_fp: Path, key: str, value) -> None:
+    """
+    Sets an attribute of the zarr group at group_fp, a zarr v2 (``.zattrs``) or a zarr v3 group (``zarr.json``, eg
+    written by ``sharding.shard_zarr``).
+    """
+    v3_fp = group_fp / "zarr.json"
+    if v3_fp.is_file():
+        meta = json.loads(v3_fp.read_text())
+        meta.setdefault("attributes", dict())[key] = value
+        v3_fp.write_text(json.dumps(meta, indent=2))
+        return
+    attrs_fp = group_fp / ".zattrs"
+    attrs = json.loads(attrs_fp.read_text()) if attrs_fp.is_file() else dict()
+    attrs[key] = value
+    attrs_fp.write_text(json.dumps(attrs, indent=4, sort_keys=True))
+
+
+def neuroglancer_shader_parameters(
+    image: HedwigZarrImage,
+    compute_args: Dict = None,
+    assets_group: Optional[Path] = None,
+    **kwargs,
+) -> Dict:
+    """
+    Computes ``image.neuroglancer_shader_parameters(**kwargs)`` from a low resolution level of the pyramid, rather
+    than scanning the full resolution array, and caches the result in the attributes of the image's zarr group.
+    The working zarr is usually already copied to the assets, ``assets_group`` then gets the cached parameters too,
+    for the later requests of the published zarr.
+
+    The smallest level with at least ``SHADER_PARAMETERS_MIN_PIXELS`` pixels is copied to a temporary zarr with the
+    same OME metadata, where it is the only level, and the statistics are computed by pytools on it. Quantile and
+    MAD statistics of such a level are a close estimate of those of the full resolution image.
+
+    :param image: an image of a HedwigZarrImages
+    :param compute_args: compute_args for the HedwigZarrImages of the reduced level
+    :param assets_group: the group of the image in the zarr of the assets, zarr v2 or sharded zarr v3
+    :param kwargs: arguments of ``HedwigZarrImage.neuroglancer_shader_parameters``, eg mad_scale
+    :return: the neuroglancer shader parameters
+    """
+    group = zarr.open_group(image.path.as_posix(), mode="r+")
+    cache_key = json.dumps(kwargs, sort_keys=True)
+    cached = group.attrs.get(SHADER_PARAMETERS_ATTR, {})
+    if cache_key in cached:
+        utils.log(f"Reusing shader parameters of {image.path} for {cache_key}")
+        params = cached[cache_key]
+        if assets_group is not None:
+            _write_group_attr(assets_group, SHADER_PARAMETERS_ATTR, cached)
+        return params
+
+    level = _select_statistics_level(group, SHADER_PARAMETERS_MIN_PIXELS)
+    if level == group.attrs["multiscales"][0]["datasets"][0]["path"]:
+        params = image.neuroglancer_shader_parameters(**kwargs)
+    else:
+        utils.log(f"Computing shader parameters of {image.path} from level {level}")
+        with tempfile.TemporaryDirectory(dir=Config.tmp_dir) as tmp_dir:
+            reduced_fp = Path(tmp_dir) / image.path.parent.name
+            reduced = zarr.open_group(reduced_fp.as_posix(), mode="w")
+            reduced.attrs.update(
+                zarr.open_group(image.path.parent.as_posix(), mode="r").attrs.asdict()
+            )
+            shutil.copytree(image.path.parent / "OME", reduced_fp / "OME")
+
+            series = reduced.create_group(image.path.name)
+            multiscales = group.attrs["multiscales"]
+            datasets = multiscales[0]["datasets"]
+            multiscales[0]["datasets"] = [
+                dict(d, path="0") for d in datasets if d["path"] == level
+            ]
+            series.attrs.update(
+                {
+                    k: v
+                    for k, v in group.attrs.asdict().items()
+                    if k != SHADER_PARAMETERS_ATTR
+                }
+            )
+            series.attrs["multiscales"] = multiscales
+            zarr.copy(
+                group[level],
+                series,
+                name="0",
+                compressor=select_codec(group[level].dtype, speed_critical=True),
+            )
+
+            images_kwargs = (
+                dict(compute_args=compute_args) if compute_args is not None else dict()
+            )
+            reduced_images = HedwigZarrImages(
+                reduced_fp, read_only=True, **images_kwargs
+            )
+            params = reduced_images[
+                int(image.path.name)
+            ].neuroglancer_shader_parameters(**kwargs)
+
+    cached = dict(cached, **{cache_key: params})
+    group.attrs[SHADER_PARAMETERS_ATTR] = cached
+    if assets_group is not None:
+        _write_group_attr(assets_group, SHADER_PARAMETERS_ATTR, cached)
+    return params
+
+
+# number of bioformats2raw conversions running in this process, sharing the cpus and memory of the worker
+_active_conversions = 0
+_active_conversions_lock = threading.Lock()
+
+
+@contextmanager
+def _conversion_slot():
+    global _active_conversions
+    with _active_conversions_lock:
+        _active_conversions += 1
+    try:
+        yield
+    finally:
+        with _active_conversions_lock:
+            _active_conversions -= 1
+
+
+def _worker_resources() -> Tuple[int, int]:
+    """
+    :return: the number of cpus and bytes of memory of the dask worker running this task, or of this process
+      when not running on a dask worker.
+    """
+    try:
+        worker = get_worker()
+    except ValueError:
+        worker = None
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    if worker is None:
+        return len(os.sched_getaffinity(0)), memory
+    return worker.state.nthreads, worker.memory_manager.memory_limit or memory
+
+
+def bioformats_resources(input_fp: Path, concurrent: int = 1) -> Tuple[int, int]:
+    """
+    Sizes a bioformats2raw conversion for the resources it can use, rather than fixed values which
+    oversubscribe the cpus and memory of a worker running several conversions.
+
+    - The cpus and memory of the dask worker (see ``SLURM_exec``) are shared by the ``concurrent`` conversions
+    - No more workers than one per ``BIOFORMATS_BYTES_PER_WORKER`` of input are used, small inputs gain nothing
+      from more threads
+    - The values are bounded by ``BIOFORMATS_NUM_WORKERS``, ``JAVA_MIN_HEAP_MB`` and ``JAVA_MAX_HEAP_MB``
+
+    :param input_fp: input file of the conversion
+    :param concurrent: number of conversions running concurrently on the worker, including this one
+    :return: the number of bioformats2raw workers, and the JVM maximum heap size in MB
+    """
+    cpus, memory = _worker_resources()
+    concurrent = max(1, concurrent)
+    input_size = input_fp.stat().st_size if input_fp.is_file() else 0
+    max_workers = min(
+        BIOFORMATS_NUM_WORKERS,
+        max(1, cpus // concurrent),
+        max(1, math.ceil(input_size / BIOFORMATS_BYTES_PER_WORKER)),
+    )
+    heap_mb = int(memory / concurrent * JAVA_HEAP_MEMORY_FRACTION / 2**20)
+    heap_mb = max(JAVA_MIN_HEAP_MB, min(JAVA_MAX_HEAP_MB, heap_mb))
+    return max_workers, heap_mb
+
+
+def _run_bioformats2raw(cmd: List[str], input_fp: Path, log_fp: str) -> None:
+    """
+    Runs the bioformats2raw ``cmd`` with a number of workers and JVM heap size from ``bioformats_resources``,
+    accounting for the other conversions running on the worker.
+    """
+    with _conversion_slot():
+        max_workers, heap_mb = bioformats_resources(
+            input_fp, concurrent=_active_conversions
+        )
+        cmd = [cmd[0], f"--max_workers={max_workers}"] + cmd[1:]
+        FilePath.run(
+            cmd=cmd,
+            log_file=log_fp,
+            env={
+                "JAVA_OPTS": f"{Config.java_opts} -Xmx{heap_mb}m",
+                "JAVA_TOOL_OPTIONS": Config.java_tool_options,
+            },
+        )
+
+
+def _plan_mrc_output(
+    input_fp: Path, width: int, height: int, depth: int, codec: Blosc
+) -> Tuple[int, int, int, Blosc]:
+    """
+    Plans the bioformats2raw tile width, height and chunk depth with ``plan_chunks``, when none is given, and the
+    codec with ``select_codec``, when not given, from the header of an MRC input.
+
+    :return: width, height, depth and codec of the conversion
+    """
+    header = None
+    if input_fp.suffix.lower() == ".mrc":
+        header = utils.read_mrc_header(input_fp)
+    # the defaults of bioformats2raw for the modes without a dtype
+    if header is not None and header.dtype is not None:
+        if all(arg is None for arg in (width, height, depth)):
+            depth, height, width = plan_chunks(
+                (header.z, header.y, header.x), header.dtype, levels=1
+            )[0]
+        if codec is None:
+            codec = select_codec(header.dtype)
+    if codec is None:
+        codec = Blosc(cname="zstd", clevel=5, shuffle=Blosc.SHUFFLE)
+    return width, height, depth, codec
 
 
 def bioformats_gen_zarr_dup(
@@ -24,6 +376,7 @@ def bioformats_gen_zarr_dup(
     height: int = None,
     resolutions: int = None,
     depth: int = None,
+    codec: Blosc = None,
 ):
     """
     Following params alter based on what kind of flow is running...
@@ -33,23 +386,14 @@ def bioformats_gen_zarr_dup(
     :param width:
     :param height:
     :param resolutions:
-    :param depth: These arguments are only used by BRT and SEM flows
+    :param depth: These arguments are only used by BRT and SEM flows, when not given for an MRC input they are
+      planned from its header
+    :param codec: blosc compressor of the zarr, by default selected for the dtype of an MRC input
     """
+    width, height, depth, codec = _plan_mrc_output(fp_in, width, height, depth, codec)
     output_zarr = f"{fp_in.parent}/{fp_in.stem}.zarr"
     log_fp = f"{fp_in.parent}/{fp_in.stem}_as_zarr.log"
-    cmd = [
-        Config.bioformats2raw,
-        f"--max_workers={BIOFORMATS_NUM_WORKERS}",
-        "--overwrite",
-        "--compression",
-        "blosc",
-        "--compression-properties",
-        "cname=zstd",
-        "--compression-properties",
-        "clevel=5",
-        "--compression-properties",
-        "shuffle=1",
-    ]
+    cmd = [Config.bioformats2raw, "--overwrite"] + _bioformats_compression_args(codec)
     if resolutions is not None:
         cmd.extend(["--resolutions", str(resolutions)])
     if width is not None:
@@ -63,14 +407,7 @@ def bioformats_gen_zarr_dup(
         cmd.extend(["--downsample-type", "AREA"])
 
     cmd.extend([fp_in.as_posix(), output_zarr])
-    FilePath.run(
-        cmd=cmd,
-        log_file=log_fp,
-        env={
-            "JAVA_OPTS": Config.java_opts,
-            "JAVA_TOOL_OPTIONS": Config.java_tool_options,
-        },
-    )
+    _run_bioformats2raw(cmd, fp_in, log_fp)
     return Path(output_zarr)
 
 
@@ -82,6 +419,9 @@ def bioformats_gen_zarr(
     height: int = None,
     resolutions: int = None,
     depth: int = None,
+    series: List[int] = None,
+    output_zarr: str = None,
+    codec: Blosc = None,
 ):
     """
     Following params alter based on what kind of flow is running...
@@ -91,23 +431,19 @@ def bioformats_gen_zarr(
     :param width:
     :param height:
     :param resolutions:
-    :param depth: These arguments are only used by BRT and SEM flows
+    :param depth: These arguments are only used by BRT and SEM flows, when not given for an MRC input they are
+      planned from its header
+    :param series: Only convert these series of the input
+    :param output_zarr: Defaults to the zarr of the file in the working directory
+    :param codec: blosc compressor of the zarr, by default selected for the dtype of an MRC input
     """
-    output_zarr = f"{file_path.working_dir}/{file_path.base}.zarr"
-    log_fp = f"{file_path.working_dir}/{file_path.base}_as_zarr.log"
-    cmd = [
-        Config.bioformats2raw,
-        f"--max_workers={BIOFORMATS_NUM_WORKERS}",
-        "--overwrite",
-        "--compression",
-        "blosc",
-        "--compression-properties",
-        "cname=zstd",
-        "--compression-properties",
-        "clevel=5",
-        "--compression-properties",
-        "shuffle=1",
-    ]
+    width, height, depth, codec = _plan_mrc_output(
+        Path(input_fname), width, height, depth, codec
+    )
+    if output_zarr is None:
+        output_zarr = f"{file_path.working_dir}/{file_path.base}.zarr"
+    log_fp = f"{output_zarr.removesuffix('.zarr')}_as_zarr.log"
+    cmd = [Config.bioformats2raw, "--overwrite"] + _bioformats_compression_args(codec)
     if resolutions is not None:
         cmd.extend(["--resolutions", str(resolutions)])
     if width is not None:
@@ -119,19 +455,172 @@ def bioformats_gen_zarr(
         cmd.extend(["--chunk_depth", str(depth)])
     else:
         cmd.extend(["--downsample-type", "AREA"])
+    if series is not None:
+        cmd.extend(["--series", ",".join(str(s) for s in series)])
 
     cmd.extend([input_fname, output_zarr])
-    FilePath.run(
-        cmd=cmd,
-        log_file=log_fp,
-        env={
-            "JAVA_OPTS": Config.java_opts,
-            "JAVA_TOOL_OPTIONS": Config.java_tool_options,
-        },
-    )
+    _run_bioformats2raw(cmd, Path(input_fname), log_fp)
     return Path(output_zarr)
 
 
+def _run_concurrently(fn: Callable, kwargs_list: List[Dict], max_threads: int) -> List:
+    """
+    Runs ``fn`` for each of the kwargs, as tasks of the dask cluster when called from a dask worker, otherwise in
+    a pool of ``max_threads`` threads.
+    """
+    try:
+        get_worker()
+    except ValueError:
+        with ThreadPoolExecutor(max_workers=max_threads) as executor:
+            return list(executor.map(lambda kwargs: fn(**kwargs), kwargs_list))
+    with worker_client() as client:
+        futures = [client.submit(fn, pure=False, **kwargs) for kwargs in kwargs_list]
+        return client.gather(futures)
+
+
+def _bioformats_series_group(zarr_fp: Path) -> Optional[str]:
+    """
+    :return: the path of the only series group in a bioformats2raw zarr, or None if there is not exactly one
+    """
+    series = zarr.open_group((zarr_fp / "OME").as_posix(), mode="r").attrs.get(
+        "series", []
+    )
+    return series[0] if len(series) == 1 else None
+
+
+def _ome_xml_image_count(ome_xml: str) -> int:
+    """
+    :return: the number of Image elements (series) described by the OME-XML
+    """
+    root = ET.fromstring(ome_xml)
+    return len([elt for elt in root if elt.tag.split("}")[-1] == "Image"])
+
+
+def _bioformats_ome_xml(input_fname: str) -> Optional[str]:
+    """
+    Reads the OME-XML metadata of the input with showinf, without reading its pixels.
+
+    :return: the OME-XML, or None if showinf failed
+    """
+    cmd = [
+        Config.showinf_loc,
+        "-nopix",
+        "-omexml-only",
+        "-no-upgrade",
+        "-novalid",
+        input_fname,
+    ]
+    try:
+        p = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError as e:
+        utils.log(f"Failed to run command: {' '.join(cmd)} {e}")
+        return None
+    if p.returncode != 0 or "<" not in p.stdout:
+        utils.log(f"Failed to run command: {' '.join(cmd)} {p.stderr}")
+        return None
+    # skip any log line of the reader before the XML
+    start = p.stdout.index("<")
+    return p.stdout[start:]
+
+
+def bioformats_gen_zarr_by_series(
+    file_path: FilePath, input_fname: str, **kwargs
+) -> Path:
+    """
+    Converts each series of a multi-series input with its own bioformats2raw run, concurrently, and merges the
+    results in a single zarr, as ``bioformats_gen_zarr`` would have produced.
+
+    The number of series is read from the OME-XML metadata of the input with showinf, without reading its pixels.
+    The series are converted on the dask cluster when running on a dask worker, otherwise concurrently in local
+    subprocesses, the first one to the output zarr, and the groups of the others moved into it. The OME-XML
+    metadata of the merged zarr is the one read by showinf, which describes all the series. If the number of
+    series cannot be read, or there is a single one, the whole input is converted with a single run instead.
+
+    :param kwargs: arguments of ``bioformats_gen_zarr``, eg width, height
+    :return: path of the zarr in the working directory
+    :raises RuntimeError: if a series group is missing from the merged zarr
+    """
+    ome_xml = _bioformats_ome_xml(input_fname)
+    try:
+        n_series = _ome_xml_image_count(ome_xml) if ome_xml else 0
+    except ET.ParseError as e:
+        utils.log(f"Unable to read the OME-XML of {input_fname}: {e}")
+        n_series = 0
+    if n_series < 2:
+        if n_series < 1:
+            utils.log(
+                f"Unable to read the series of {input_fname}, converting all series at once."
+            )
+        return bioformats_gen_zarr(file_path, input_fname, **kwargs)
+
+    utils.log(f"{input_fname} has {n_series} series")
+    output_zarr = Path(f"{file_path.working_dir}/{file_path.base}.zarr")
+    series_zarrs = [output_zarr] + [
+        Path(f"{file_path.working_dir}/{file_path.base}_series{idx}.zarr")
+        for idx in range(1, n_series)
+    ]
+    kwargs_list = [
+        dict(
+            kwargs,
+            file_path=file_path,
+            input_fname=input_fname,
+            series=[idx],
+            output_zarr=series_zarr.as_posix(),
+        )
+        for idx, series_zarr in enumerate(series_zarrs)
+    ]
+    _run_concurrently(
+        bioformats_gen_zarr, kwargs_list, BIOFORMATS_MAX_CONCURRENT_SERIES
+    )
+
+    for idx, series_zarr in enumerate(series_zarrs):
+        series_group = _bioformats_series_group(series_zarr)
+        if series_group is None:
+            raise RuntimeError(
+                f"Unexpected bioformats2raw output for series {idx} in {series_zarr}"
+            )
+        if series_zarr == output_zarr:
+            if series_group != "0":
+                (output_zarr / series_group).rename(output_zarr / "0")
+        else:
+            (series_zarr / series_group).rename(output_zarr / str(idx))
+            shutil.rmtree(series_zarr)
+
+    groups = sorted(
+        int(fp.name)
+        for fp in output_zarr.iterdir()
+        if fp.is_dir() and fp.name.isdigit()
+    )
+    if groups != list(range(n_series)):
+        shutil.rmtree(output_zarr)
+        raise RuntimeError(
+            f"Merged series groups {groups} of {input_fname}, expected {n_series}"
+        )
+    # the OME-XML of each run may only describe the series it converted
+    (output_zarr / "OME" / "METADATA.ome.xml").write_text(ome_xml)
+    zarr.open_group((output_zarr / "OME").as_posix(), mode="r+").attrs["series"] = [
+        str(idx) for idx in range(n_series)
+    ]
+    return output_zarr
+
+
+def copy_zarr_to_assets_dir(
+    file_path: FilePath, zarr_fp: Path, sharded: bool = False
+) -> Path:
+    """
+    Copies a zarr of the working directory to the assets directory, as ``FilePath.copy_to_assets_dir`` does, or
+    writes it as a zarr v3 with sharded arrays (see ``sharding.shard_zarr``), which has far fewer files.
+
+    :param sharded: write the sharded zarr v3 rather than copying the zarr
+    :return: path of the zarr in the assets directory
+    """
+    if not sharded:
+        return file_path.copy_to_assets_dir(fp_to_cp=zarr_fp)
+    dest = Path(f"{file_path.assets_dir}/{zarr_fp.name}")
+    utils.log(f"writing {zarr_fp} to {dest} as a sharded zarr")
+    return sharding.shard_zarr(zarr_fp, dest)
+
+
 def zarr_build_multiscales(file_path: FilePath) -> None:
     zarr = Path(f"{file_path.assets_dir}/{file_path.base}.zarr/0")
     log_file = f"{file_path.working_dir}/{file_path.base}.log"
@@ -148,3 +637,215 @@ def zarr_build_multiscales2(zarr_fp: Path) -> None:
     utils.log("Building multiscales...")
     cmd_ms = ["zarr_build_multiscales", zarr.as_posix()]
     FilePath.run(cmd=cmd_ms, log_file=log_file)
+
+
+def _identify_image(input_fname: str) -> Tuple[int, int, int]:
+    """
+    Reads the header of the first image in ``input_fname`` with ImageMagick identify.
+
+    :return: width, height and number of color channels (1 for gray-scale, otherwise 3)
+    """
+    cmd = [
+        Config.identify_loc,
+        "-ping",
+        "-format",
+        "%w %h %[channels]",
+        f"{input_fname}[0]",
+    ]
+    p = subprocess.run(cmd, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise RuntimeError(f"Failed to run command: {' '.join(cmd)} {p.stderr}")
+    width, height, channels = p.stdout.split()[:3]
+    return int(width), int(height), 1 if channels.startswith("gray") else 3
+
+
+def _downsample_rows(rows: np.ndarray) -> np.ndarray:
+    """
+    Averages 2x2 blocks of a band of rows indexed y, x, c. Odd sizes are padded by repeating the edge.
+    """
+    pad = [(0, rows.shape[0] % 2), (0, rows.shape[1] % 2), (0, 0)]
+    if any(after for _, after in pad):
+        rows = np.pad(rows, pad, mode="edge")
+    h, w, c = rows.shape
+    blocks = rows.reshape(h // 2, 2, w // 2, 2, c).sum(axis=(1, 3), dtype=np.uint16)
+    return ((blocks + 2) // 4).astype(np.uint8)
+
+
+class _StreamingPyramid:
+    """
+    Writes bands of rows of a 2D image to the full resolution array of a multiscale zarr group, and their 2x2
+    averages to each of the lower resolution arrays, as the rows arrive. Only a band of rows per level is held in
+    memory, each chunk is written once.
+    """
+
+    def __init__(
+        self,
+        group: zarr.Group,
+        width: int,
+        height: int,
+        channels: int,
+        chunks: List[Tuple[int, int]],
+    ) -> None:
+        """
+        :param chunks: the y, x chunk shape of each level, as planned by ``plan_chunks``
+        """
+        self.chunk_rows = [chunk_y for chunk_y, _ in chunks]
+        self.arrays = []
+        compressor = select_codec(np.uint8)
+        for level, (chunk_y, chunk_x) in enumerate(chunks):
+            self.arrays.append(
+                group.create_dataset(
+                    str(level),
+                    shape=(1, channels, 1, height, width),
+                    chunks=(1, channels, 1, chunk_y, chunk_x),
+                    dtype=np.uint8,
+                    compressor=compressor,
+                    dimension_separator="/",
+                    overwrite=True,
+                )
+            )
+            width, height = -(-width // 2), -(-height // 2)
+        self._pending = [
+            np.empty((0, a.shape[4], channels), dtype=np.uint8) for a in self.arrays
+        ]
+        self._carry = [None] * len(self.arrays)
+        self._written = [0] * len(self.arrays)
+
+    def _write(self, level: int, rows: np.ndarray) -> None:
+        start = self._written[level]
+        stop = start + rows.shape[0]
+        self.arrays[level][0, :, 0, start:stop, :] = np.moveaxis(rows, 2, 0)
+        self._written[level] += rows.shape[0]
+
+    def push(self, rows: np.ndarray, level: int = 0) -> None:
+        """
+        :param rows: the next rows of the image at ``level``, indexed y, x, c
+        """
+        pending = np.concatenate([self._pending[level], rows])
+        n_full = pending.shape[0] // self.chunk_rows[level] * self.chunk_rows[level]
+        if n_full:
+            self._write(level, pending[:n_full])
+        self._pending[level] = pending[n_full:]
+
+        if level + 1 < len(self.arrays):
+            if self._carry[level] is not None:
+                rows = np.concatenate([self._carry[level], rows])
+            n_even = rows.shape[0] // 2 * 2
+            self._carry[level] = rows[n_even:] if n_even < rows.shape[0] else None
+            if n_even:
+                self.push(_downsample_rows(rows[:n_even]), level + 1)
+
+    def close(self) -> None:
+        """
+        Writes the remaining rows of each level.
+        """
+        for level in range(len(self.arrays)):
+            if self._carry[level] is not None:
+                carry, self._carry[level] = self._carry[level], None
+                self.push(_downsample_rows(carry), level + 1)
+            if self._pending[level].shape[0]:
+                self._write(level, self._pending[level])
+                self._pending[level] = self._pending[level][:0]
+
+
+def _ome_xml(name: str, width: int, height: int, channels: int) -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        f'<Image ID="Image:0" Name={quoteattr(name)}>'
+        f'<Pixels BigEndian="false" DimensionOrder="XYCZT" ID="Pixels:0" Interleaved="false" SizeC="{channels}" '
+        f'SizeT="1" SizeX="{width}" SizeY="{height}" SizeZ="1" Type="uint8">'
+        f'<Channel ID="Channel:0:0" SamplesPerPixel="{channels}"><LightPath/></Channel>'
+        "<MetadataOnly/></Pixels></Image></OME>"
+    )
+
+
+def _multiscales_attrs(name: str, n_levels: int) -> List[dict]:
+    axes = [{"name": "t", "type": "time"}, {"name": "c", "type": "channel"}]
+    axes += [{"name": ax, "type": "space"} for ax in "zyx"]
+    datasets = [
+        {
+            "path": str(level),
+            "coordinateTransformations": [
+                {"type": "scale", "scale": [1.0, 1.0, 1.0, 2.0**level, 2.0**level]}
+            ],
+        }
+        for level in range(n_levels)
+    ]
+    return [{"name": name, "version": "0.4", "axes": axes, "datasets": datasets}]
+
+
+def stream_gen_zarr(file_path: FilePath, input_fname: str) -> Path:
+    """
+    Converts a 2D PNG or TIFF image to a multiscale OME-NGFF zarr, laid out as bioformats2raw does, without
+    decoding the whole image in memory.
+
+    ImageMagick ``stream`` decodes the image band by band to raw pixels, alpha is composited onto a white background,
+    and each band is written to RGB-contiguous chunks planned by ``plan_chunks``, along with the 2x2 averaged pyramid
+    levels, so no rechunking is needed.
+
+    :param input_fname: the PNG or TIFF image to convert
+    :return: path of the zarr in the working directory
+    """
+    output_zarr = Path(f"{file_path.working_dir}/{file_path.base}.zarr")
+    log_fp = f"{file_path.working_dir}/{file_path.base}_as_zarr.log"
+    width, height, channels = _identify_image(input_fname)
+    pixel_map = "ia" if channels == 1 else "rgba"
+
+    root = zarr.open_group(output_zarr.as_posix(), mode="w")
+    root.attrs["bioformats2raw.layout"] = 3
+    series = root.create_group("0")
+    chunks = [
+        chunk[1:]
+        for chunk in plan_chunks((1, height, width), np.uint8, channels=channels)
+    ]
+    utils.log(f"Writing {input_fname} of {width}x{height} pixels to chunks {chunks}")
+    pyramid = _StreamingPyramid(series, width, height, channels, chunks)
+
+    cmd = [
+        Config.stream_loc,
+        "-map",
+        pixel_map,
+        "-storage-type",
+        "char",
+        f"{input_fname}[0]",
+        "-",
+    ]
+    utils.log(f"Running subprocess: {' '.join(cmd)} logfile: {log_fp}")
+    row_bytes = width * (channels + 1)
+    rows_read = 0
+    with open(log_fp, "ab") as log_file:
+        log_file.write(f"Running subprocess: {' '.join(cmd)}\n".encode())
+        log_file.flush()
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log_file) as p:
+            try:
+                while rows_read < height:
+                    n_rows = min(pyramid.chunk_rows[0], height - rows_read)
+                    buffer = p.stdout.read(n_rows * row_bytes)
+                    if len(buffer) != n_rows * row_bytes:
+                        break
+                    band = np.frombuffer(buffer, dtype=np.uint8).reshape(
+                        n_rows, width, channels + 1
+                    )
+                    # composite onto a white background
+                    alpha = band[..., channels:].astype(np.uint16)
+                    band = (
+                        band[..., :channels] * alpha + 255 * (255 - alpha) + 127
+                    ) // 255
+                    pyramid.push(band.astype(np.uint8))
+                    rows_read += n_rows
+            finally:
+                p.stdout.close()
+                if rows_read < height:
+                    p.kill()
+            if p.wait() != 0 or rows_read < height:
+                raise RuntimeError(f"Failed to run command: {' '.join(cmd)}")
+    pyramid.close()
+
+    name = Path(input_fname).name
+    series.attrs["multiscales"] = _multiscales_attrs(name, len(pyramid.arrays))
+    root.create_group("OME").attrs["series"] = ["0"]
+    (output_zarr / "OME" / "METADATA.ome.xml").write_text(
+        _ome_xml(name, width, height, channels)
+    )
+    return output_zarr
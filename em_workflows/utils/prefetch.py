@@ -0,0 +1,125 @@
+"""
+Prefetch of the inputs from the Projects share into their working dirs.
+
+The steps reading an input (eg tif2mrc on a FIBSEM stack, bioformats2raw on a CZI file)
+otherwise read it from NFS while they compute. With prefetch, an input is copied into
+``FilePath.PREFETCH_DIR`` of its working dir by a task of its own, while the inputs
+before it compute, and then read from there, see ``FilePath.input_fp``.
+
+The copies are bounded across the workers by ``PREFETCH_MAX_CONCURRENT`` and
+``PREFETCH_MAX_BYTES`` in flight, which keeps NFS responsive. As for the scratch
+admission (see ``scratch``), each copy in progress is recorded as a file per working dir
+in ``Config.tmp_dir``, shared by the workers and guarded by a lock file. A record no
+longer counts once its working dir is removed, eg after a crash.
+"""
+import fcntl
+import json
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List
+
+from em_workflows.config import Config
+from em_workflows.constants import (
+    PREFETCH_MAX_BYTES,
+    PREFETCH_MAX_CONCURRENT,
+    PREFETCH_POLL_SECONDS,
+)
+from em_workflows.file_path import FilePath, log
+
+IN_FLIGHT_DIR = ".prefetch_in_flight"
+
+
+@contextmanager
+def _locked_in_flight() -> Iterator[Path]:
+    """
+    :return: the dir of the copies in flight, locked for the other processes
+    """
+    in_flight_dir = Path(Config.tmp_dir) / IN_FLIGHT_DIR
+    in_flight_dir.mkdir(parents=True, exist_ok=True)
+    with open(in_flight_dir / ".lock", "w") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield in_flight_dir
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def _in_flight(in_flight_dir: Path) -> List[int]:
+    """
+    :return: sizes of the copies in flight, records of removed working dirs are dropped
+    """
+    sizes = list()
+    for record_fp in in_flight_dir.iterdir():
+        if record_fp.name.startswith("."):
+            continue
+        try:
+            record = json.loads(record_fp.read_text())
+        except FileNotFoundError:
+            continue
+        if not Path(record["working_dir"]).is_dir():
+            record_fp.unlink(missing_ok=True)
+            continue
+        sizes.append(record["bytes"])
+    return sizes
+
+
+@contextmanager
+def in_flight(
+    working_dir: Path, n_bytes: int, poll_seconds: float = PREFETCH_POLL_SECONDS
+) -> Iterator[None]:
+    """
+    Waits until fewer than ``PREFETCH_MAX_CONCURRENT`` copies are in flight, and
+    ``n_bytes`` more stay within ``PREFETCH_MAX_BYTES``, then records the copy of
+    working_dir as in flight until the end of the context. A copy is always started when
+    no other is in flight.
+    """
+    start = time.monotonic()
+    while True:
+        with _locked_in_flight() as in_flight_dir:
+            sizes = _in_flight(in_flight_dir)
+            if not sizes or (
+                len(sizes) < PREFETCH_MAX_CONCURRENT
+                and sum(sizes) + n_bytes <= PREFETCH_MAX_BYTES
+            ):
+                record_fp = in_flight_dir / working_dir.name
+                record_fp.write_text(
+                    json.dumps(dict(working_dir=working_dir.as_posix(), bytes=n_bytes))
+                )
+                break
+        time.sleep(poll_seconds)
+    log(f"Prefetch of {working_dir} started after {time.monotonic() - start:.0f}s")
+    try:
+        yield
+    finally:
+        with _locked_in_flight():
+            record_fp.unlink(missing_ok=True)
+
+
+def prefetch(file_path: FilePath, n_bytes: int) -> Path:
+    """
+    Copies the input of file_path, a file or a dir of files, into
+    ``FilePath.PREFETCH_DIR`` of its working dir. The copy is renamed in place once
+    complete, so that a partial copy is never read.
+
+    :param n_bytes: size of the input
+    :return: Path of the copy
+    """
+    prefetch_dir = file_path.working_dir / FilePath.PREFETCH_DIR
+    dest = prefetch_dir / file_path.fp_in.name
+    if dest.exists():
+        return dest
+    partial = prefetch_dir / f".{file_path.fp_in.name}.partial"
+    prefetch_dir.mkdir(exist_ok=True)
+    with in_flight(file_path.working_dir, n_bytes):
+        start = time.monotonic()
+        if file_path.fp_in.is_dir():
+            shutil.rmtree(partial, ignore_errors=True)
+            shutil.copytree(file_path.fp_in, partial)
+        else:
+            shutil.copyfile(file_path.fp_in, partial)
+        partial.rename(dest)
+        seconds = time.monotonic() - start
+    log(f"Prefetched {n_bytes} bytes of {file_path.fp_in} in {seconds:.1f}s")
+    return dest
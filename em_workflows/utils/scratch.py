@@ -0,0 +1,154 @@
+"""
+Admission control of the inputs to the scratch space (``Config.tmp_dir``).
+
+Mapped tasks start as soon as dask has worker slots, so many large inputs processed
+concurrently can fill the scratch space and fail every file. Before its heavy steps,
+each input reserves an estimate of its peak scratch use, and waits until that fits in
+the free space left by the reservations of the other inputs.
+
+The reservations are kept in ``Config.tmp_dir``, shared by the workers, as a file per
+working dir, guarded by a lock file. A reservation only counts for the part of the
+footprint its working dir has not written yet, and no longer counts once all the
+declared intermediates of the working dir have been released (see
+``FilePath.release_intermediates``) or the working dir is removed.
+"""
+import fcntl
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from em_workflows.config import Config
+from em_workflows.constants import (
+    SCRATCH_ADMISSION_TIMEOUT_SECONDS,
+    SCRATCH_FOOTPRINT_FACTORS,
+    SCRATCH_FREE_MARGIN,
+    SCRATCH_POLL_SECONDS,
+)
+from em_workflows.file_path import FilePath, log
+
+RESERVATIONS_DIR = ".scratch_reservations"
+
+
+def estimate_footprint(input_bytes: int, workflow: str) -> int:
+    """
+    :param input_bytes: size of the uncompressed input
+    :param workflow: key of ``SCRATCH_FOOTPRINT_FACTORS``, eg "brt"
+    :return: estimate of the peak scratch use of the input, in bytes
+    """
+    if workflow not in SCRATCH_FOOTPRINT_FACTORS:
+        raise RuntimeError(f"No scratch footprint factor for workflow {workflow}")
+    return int(input_bytes * SCRATCH_FOOTPRINT_FACTORS[workflow])
+
+
+def _disk_usage(path: Path) -> int:
+    """
+    :return: bytes allocated to the files under ``path``
+    """
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += _disk_usage(Path(entry.path))
+            else:
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except FileNotFoundError:
+            # deleted by a concurrent task
+            continue
+    return total
+
+
+def _outstanding(reservation_fp: Path) -> int:
+    """
+    :return: bytes of the reservation not yet written to its working dir, 0 once its
+      intermediates are released. The reservation is removed when its working dir no
+      longer exists.
+    """
+    try:
+        reservation = json.loads(reservation_fp.read_text())
+    except FileNotFoundError:
+        return 0
+    working_dir = Path(reservation["working_dir"])
+    if not working_dir.is_dir():
+        reservation_fp.unlink(missing_ok=True)
+        return 0
+    intermediates_dir = working_dir / FilePath.INTERMEDIATES_DIR
+    if intermediates_dir.is_dir() and not any(intermediates_dir.iterdir()):
+        return 0
+    return max(0, reservation["bytes"] - _disk_usage(working_dir))
+
+
+@contextmanager
+def _locked_reservations() -> Iterator[Path]:
+    """
+    :return: the reservations dir, locked for the other processes
+    """
+    reservations_dir = Path(Config.tmp_dir) / RESERVATIONS_DIR
+    reservations_dir.mkdir(parents=True, exist_ok=True)
+    with open(reservations_dir / ".lock", "w") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield reservations_dir
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def admit(
+    working_dir: Path,
+    n_bytes: int,
+    poll_seconds: float = SCRATCH_POLL_SECONDS,
+    timeout_seconds: float = SCRATCH_ADMISSION_TIMEOUT_SECONDS,
+) -> None:
+    """
+    Waits until ``n_bytes`` fit in the free scratch space, less ``SCRATCH_FREE_MARGIN``
+    and the outstanding reservations of the other working dirs, then reserves them for
+    ``working_dir``. An input is always admitted when no other reservation is
+    outstanding, as waiting would not free any space.
+
+    :raises RuntimeError: when not admitted within ``timeout_seconds``
+    """
+    start = time.monotonic()
+    waiting = False
+    while True:
+        with _locked_reservations() as reservations_dir:
+            reservation_fp = reservations_dir / working_dir.name
+            outstanding = sum(
+                _outstanding(fp)
+                for fp in reservations_dir.iterdir()
+                if fp != reservation_fp and not fp.name.startswith(".")
+            )
+            usage = shutil.disk_usage(reservations_dir)
+            available = usage.free - SCRATCH_FREE_MARGIN * usage.total - outstanding
+            if n_bytes <= available or outstanding == 0:
+                if n_bytes > available:
+                    log(
+                        f"{working_dir} needs {n_bytes} bytes of scratch, "
+                        f"only {int(available)} are free"
+                    )
+                reservation_fp.write_text(
+                    json.dumps(dict(working_dir=working_dir.as_posix(), bytes=n_bytes))
+                )
+                log(
+                    f"{working_dir} admitted to scratch with {n_bytes} bytes "
+                    f"after {time.monotonic() - start:.0f}s"
+                )
+                return
+        if time.monotonic() - start > timeout_seconds:
+            raise RuntimeError(
+                f"Not enough scratch space for {working_dir} after {timeout_seconds}s, "
+                f"needs {n_bytes} bytes, {int(available)} available"
+            )
+        if not waiting:
+            log(
+                f"{working_dir} waits for {n_bytes} bytes of scratch, "
+                f"{int(available)} available"
+            )
+            waiting = True
+        time.sleep(poll_seconds)
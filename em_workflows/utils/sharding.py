@@ -0,0 +1,316 @@
+"""
+Conversion of the zarr v2 outputs of the workflows to zarr v3 with the
+``sharding_indexed`` codec.
+
+A shard file holds many chunks, followed by an index of their offsets and sizes, so a
+sharded zarr has two to three orders of magnitude fewer files than the zarr v2 layout of
+one file per chunk, which makes copying, cleaning up and backing up the assets on NFS
+much faster. Neuroglancer reads sharded zarr v3 arrays with range requests.
+
+The encoded chunks of the zarr v2 arrays (C order, little endian, blosc compressed, as
+written by bioformats2raw and ``neuroglancer.py``) are copied to the shards as they are,
+other arrays are re-encoded. The group attributes are converted to OME-NGFF 0.5, which
+keeps the OME metadata under the ``ome`` key of the zarr v3 attributes.
+
+Existing assets can be converted with::
+
+    python -m em_workflows.utils.sharding Assets/Lab/PI/sample.zarr --in-place
+"""
+import argparse
+import json
+import math
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numcodecs
+import numpy as np
+from numcodecs import Blosc
+
+from em_workflows.constants import ZARR_SHARD_CHUNKS, ZARR_SHARD_MAX_WORKERS
+
+# attributes of the zarr v2 groups moved under the "ome" attribute of OME-NGFF 0.5
+OME_ATTRS = (
+    "multiscales",
+    "omero",
+    "bioformats2raw.layout",
+    "series",
+    "labels",
+    "image-label",
+    "plate",
+    "well",
+)
+# shard index entry of a chunk which is not stored (all fill value)
+EMPTY_CHUNK = 2**64 - 1
+# blosc shuffle of the zarr v3 codec, AUTOSHUFFLE is bit shuffle for single byte types,
+# otherwise byte shuffle
+_BLOSC_SHUFFLE = {
+    Blosc.NOSHUFFLE: "noshuffle",
+    Blosc.SHUFFLE: "shuffle",
+    Blosc.BITSHUFFLE: "bitshuffle",
+}
+
+
+def shard_shape(
+    shape: Tuple[int, ...], chunks: Tuple[int, ...], shard_chunks: int
+) -> Tuple[int, ...]:
+    """
+    :return: the shape of shards of about ``shard_chunks`` chunks. Axes with fewer
+      chunks than an equal split are covered by a single shard, the other axes share the
+      remaining chunks equally.
+    """
+    grid = [math.ceil(size / chunk) for size, chunk in zip(shape, chunks)]
+    factors = list(grid)
+    axes = sorted(range(len(grid)), key=lambda i: grid[i])
+    n_chunks = shard_chunks
+    for n, axis in enumerate(axes):
+        factor = max(1, round(n_chunks ** (1 / (len(axes) - n))))
+        if grid[axis] > factor:
+            for larger_axis in axes[n:]:
+                factors[larger_axis] = factor
+            break
+        n_chunks = max(1, n_chunks // grid[axis])
+    return tuple(chunk * factor for chunk, factor in zip(chunks, factors))
+
+
+def _v3_attributes(attrs: Dict) -> Dict:
+    ome = {key: attrs[key] for key in OME_ATTRS if key in attrs}
+    if not ome:
+        return dict(attrs)
+    if "multiscales" in ome:
+        ome["multiscales"] = [
+            {k: v for k, v in ms.items() if k != "version"} for ms in ome["multiscales"]
+        ]
+    others = {key: value for key, value in attrs.items() if key not in OME_ATTRS}
+    return dict(others, ome=dict(version="0.5", **ome))
+
+
+def _write_json(fp: Path, value: Dict) -> None:
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    fp.write_text(json.dumps(value, indent=2))
+
+
+class _ShardedArray:
+    """
+    Writes the shards of a zarr v3 array from the chunks of a zarr v2 array.
+    """
+
+    def __init__(self, src: Path, dest: Path, shard_chunks: int) -> None:
+        self.src = src
+        self.dest = dest
+        meta = json.loads((src / ".zarray").read_text())
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.shards = shard_shape(self.shape, self.chunks, shard_chunks)
+        self.separator = meta.get("dimension_separator", ".")
+        self.dtype = np.dtype(meta["dtype"])
+        self.order = meta.get("order", "C")
+        self.src_codec = (
+            numcodecs.get_codec(meta["compressor"]) if meta.get("compressor") else None
+        )
+        self.src_filters = [numcodecs.get_codec(f) for f in meta.get("filters") or []]
+        # chunks compressed with blosc, with no filters, are copied as they are
+        self.copy_chunks = (
+            isinstance(self.src_codec, Blosc)
+            and not self.src_filters
+            and self.order == "C"
+            and self.dtype.byteorder in "<|="
+        )
+        self.codec = (
+            self.src_codec
+            if self.copy_chunks
+            else Blosc(cname="zstd", clevel=5, shuffle=Blosc.SHUFFLE)
+        )
+        self.fill_value = meta.get("fill_value")
+        self.attrs = (
+            json.loads((src / ".zattrs").read_text())
+            if (src / ".zattrs").is_file()
+            else {}
+        )
+
+    def metadata(self) -> Dict:
+        codec = self.codec.get_config()
+        blosc = dict(
+            cname=codec["cname"],
+            clevel=codec["clevel"],
+            shuffle=_BLOSC_SHUFFLE.get(
+                codec["shuffle"],
+                "bitshuffle" if self.dtype.itemsize == 1 else "shuffle",
+            ),
+            typesize=self.dtype.itemsize,
+            blocksize=codec.get("blocksize", 0),
+        )
+        fill_value = 0 if self.fill_value is None else self.fill_value
+        if isinstance(fill_value, float) and math.isnan(fill_value):
+            fill_value = "NaN"
+        return dict(
+            zarr_format=3,
+            node_type="array",
+            shape=list(self.shape),
+            data_type=self.dtype.name,
+            chunk_grid=dict(
+                name="regular", configuration=dict(chunk_shape=list(self.shards))
+            ),
+            chunk_key_encoding=dict(name="default", configuration=dict(separator="/")),
+            fill_value=fill_value,
+            codecs=[
+                dict(
+                    name="sharding_indexed",
+                    configuration=dict(
+                        chunk_shape=list(self.chunks),
+                        codecs=[
+                            dict(name="bytes", configuration=dict(endian="little")),
+                            dict(name="blosc", configuration=blosc),
+                        ],
+                        index_codecs=[
+                            dict(name="bytes", configuration=dict(endian="little"))
+                        ],
+                        index_location="end",
+                    ),
+                )
+            ],
+            attributes=self.attrs,
+        )
+
+    def _read_chunk(self, chunk_idx: Tuple[int, ...]) -> Optional[bytes]:
+        """
+        :return: the encoded chunk for the shard, or None if it is not stored
+        """
+        try:
+            data = (
+                self.src / self.separator.join(str(i) for i in chunk_idx)
+            ).read_bytes()
+        except FileNotFoundError:
+            return None
+        if self.copy_chunks:
+            return data
+        if self.src_codec is not None:
+            data = self.src_codec.decode(data)
+        for f in reversed(self.src_filters):
+            data = f.decode(data)
+        chunk = np.frombuffer(data, dtype=self.dtype).reshape(
+            self.chunks, order=self.order
+        )
+        return self.codec.encode(
+            np.ascontiguousarray(chunk, dtype=self.dtype.newbyteorder("<"))
+        )
+
+    def write_shard(self, shard_idx: Tuple[int, ...]) -> None:
+        per_shard = [shard // chunk for shard, chunk in zip(self.shards, self.chunks)]
+        chunk_ranges = [
+            range(idx * n, min((idx + 1) * n, math.ceil(size / chunk)))
+            for idx, n, size, chunk in zip(
+                shard_idx, per_shard, self.shape, self.chunks
+            )
+        ]
+        index = np.full(per_shard + [2], EMPTY_CHUNK, dtype="<u8")
+        offset = 0
+        shard_fp = self.dest / "/".join(["c"] + [str(i) for i in shard_idx])
+        shard_fp.parent.mkdir(parents=True, exist_ok=True)
+        with open(shard_fp, "wb") as f:
+            for chunk_idx in product(*chunk_ranges):
+                data = self._read_chunk(chunk_idx)
+                if data is None:
+                    continue
+                f.write(data)
+                index[tuple(i % n for i, n in zip(chunk_idx, per_shard))] = (
+                    offset,
+                    len(data),
+                )
+                offset += len(data)
+            if offset:
+                f.write(index.tobytes())
+        if not offset:
+            # all the chunks of the shard are fill value
+            shard_fp.unlink()
+
+    def shard_indices(self) -> List[Tuple[int, ...]]:
+        return list(
+            product(
+                *[
+                    range(math.ceil(size / shard))
+                    for size, shard in zip(self.shape, self.shards)
+                ]
+            )
+        )
+
+
+def shard_zarr(src: Path, dest: Path, shard_chunks: int = ZARR_SHARD_CHUNKS) -> Path:
+    """
+    Writes the zarr v2 hierarchy ``src`` to ``dest`` as zarr v3 with sharded arrays and
+    OME-NGFF 0.5 metadata. Files which are not zarr metadata or chunks (eg
+    ``OME/METADATA.ome.xml``) are copied.
+
+    :param shard_chunks: number of chunks in a shard, see ``shard_shape``
+    :return: ``dest``
+    """
+    if dest.exists():
+        shutil.rmtree(dest)
+    arrays = list()
+    for group_fp in [src] + sorted(
+        p.parent for p in src.rglob(".zgroup") if p.parent != src
+    ):
+        rel = group_fp.relative_to(src)
+        attrs = (
+            json.loads((group_fp / ".zattrs").read_text())
+            if (group_fp / ".zattrs").is_file()
+            else {}
+        )
+        _write_json(
+            dest / rel / "zarr.json",
+            dict(zarr_format=3, node_type="group", attributes=_v3_attributes(attrs)),
+        )
+        for child in group_fp.iterdir():
+            if (child / ".zarray").is_file():
+                arrays.append(
+                    _ShardedArray(child, dest / rel / child.name, shard_chunks)
+                )
+            elif child.is_file() and not child.name.startswith(".z"):
+                shutil.copyfile(child, dest / rel / child.name)
+
+    for array in arrays:
+        _write_json(array.dest / "zarr.json", array.metadata())
+    with ThreadPoolExecutor(max_workers=ZARR_SHARD_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(a.write_shard, idx)
+            for a in arrays
+            for idx in a.shard_indices()
+        ]
+        for future in futures:
+            future.result()
+    return dest
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("src", type=Path, help="zarr v2 to convert")
+    parser.add_argument("dest", type=Path, nargs="?", help="output zarr v3")
+    parser.add_argument(
+        "--in-place", action="store_true", help="replace src by its sharded conversion"
+    )
+    parser.add_argument(
+        "--shard-chunks",
+        type=int,
+        default=ZARR_SHARD_CHUNKS,
+        help="number of chunks per shard",
+    )
+    args = parser.parse_args(argv)
+    if args.in_place == (args.dest is not None):
+        parser.error("either dest or --in-place is required")
+    if args.in_place:
+        tmp_fp = args.src.with_name(f"{args.src.name}.sharding")
+        shard_zarr(args.src, tmp_fp, args.shard_chunks)
+        old_fp = args.src.with_name(f"{args.src.name}.v2")
+        args.src.rename(old_fp)
+        tmp_fp.rename(args.src)
+        shutil.rmtree(old_fp)
+    else:
+        shard_zarr(args.src, args.dest, args.shard_chunks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Staging of the input files into the working dirs.
+
+Batchruntomo writes its outputs next to the tilt series (the ``datasetDirectory`` of the
+adoc), so the input has to be in the working dir. Rather than copying the multi-GB input
+from the Projects share, it is staged with the first of ``BRT_STAGING_MODES`` the
+filesystems allow: a reflink (copy on write clone, which shares no writes with the
+original) or a copy.
+
+Hard and symbolic links (``BRT_LINK_STAGING_MODES``, the ``x_link_input`` parameter of
+the BRT flow) save the copy on any filesystem, but a write into the staged stack would
+then modify the original on the Projects share. The size and modification time of the
+linked sources are recorded in the working dir, and ``check_sources`` fails the input
+if they have changed after batchruntomo, rather than silently publishing from a
+modified original.
+"""
+import errno
+import fcntl
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Sequence
+
+from em_workflows.constants import BRT_STAGING_MODES
+from em_workflows.file_path import log
+
+# sources sharing their data with the staged files of a working dir, see check_sources
+STAGED_SOURCES = "staged_sources.json"
+LINK_MODES = ("hardlink", "symlink")
+
+# ioctl cloning a file into another, on filesystems with copy on write support, eg btrfs
+# and xfs
+FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            dest.unlink(missing_ok=True)
+            raise
+
+
+def _copy(src: Path, dest: Path) -> None:
+    shutil.copyfile(src, dest)
+
+
+STAGERS = {
+    "reflink": _reflink,
+    "hardlink": os.link,
+    "symlink": lambda src, dest: os.symlink(src.absolute(), dest),
+    "copy": _copy,
+}
+
+
+def stage_file(src: Path, dest: Path, modes: Sequence[str] = BRT_STAGING_MODES) -> str:
+    """
+    Puts src at dest with the first of modes that works. Does nothing if dest is already
+    staged, eg by a previous attempt of the task.
+
+    :param modes: keys of ``STAGERS``, in order of preference
+    :return: the mode used, or "staged" if dest was already there
+    """
+    if dest.exists() and dest.stat().st_size == src.stat().st_size:
+        return "staged"
+    dest.unlink(missing_ok=True)
+    errors = list()
+    for mode in modes:
+        try:
+            STAGERS[mode](src, dest)
+        except OSError as e:
+            if e.errno not in (
+                errno.EXDEV,
+                errno.EPERM,
+                errno.EOPNOTSUPP,
+                errno.ENOTTY,
+                errno.EINVAL,
+                errno.EACCES,
+            ):
+                raise
+            errors.append(f"{mode}: {e.strerror}")
+            continue
+        log(
+            f"Staged {src} to {dest} by {mode}"
+            + (f" ({', '.join(errors)})" if errors else "")
+        )
+        if mode in LINK_MODES:
+            _record_source(src, dest.parent)
+        return mode
+    raise RuntimeError(f"Unable to stage {src} to {dest}: {', '.join(errors)}")
+
+
+def _record_source(src: Path, working_dir: Path) -> None:
+    sources_fp = working_dir / STAGED_SOURCES
+    sources = json.loads(sources_fp.read_text()) if sources_fp.exists() else {}
+    stat = src.stat()
+    sources[src.absolute().as_posix()] = [stat.st_size, stat.st_mtime_ns]
+    sources_fp.write_text(json.dumps(sources))
+
+
+def check_sources(working_dir: Path) -> None:
+    """
+    Checks that the sources linked into working_dir are unchanged since staged, eg by a
+    step writing into its staged input. Does nothing if nothing was linked.
+    """
+    sources_fp = working_dir / STAGED_SOURCES
+    if not sources_fp.exists():
+        return
+    for src, (size, mtime_ns) in json.loads(sources_fp.read_text()).items():
+        stat = Path(src).stat()
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            raise RuntimeError(
+                f"{src} was modified through its link in {working_dir}, "
+                "run again without x_link_input"
+            )
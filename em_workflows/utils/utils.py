@@ -1,26 +1,58 @@
+import asyncio
 import subprocess
 from collections import namedtuple
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import heapq
+import math
+import numpy as np
 import os
 import shutil
 import json
-from typing import List, Dict, Optional
+import time
+from typing import Callable, List, Dict, Optional, Tuple
 from pathlib import Path
 
+import dask
 from jinja2 import Environment, FileSystemLoader
-from prefect import task, get_run_logger, allow_failure
+from prefect import task, get_run_logger, allow_failure, unmapped
 from prefect.exceptions import MissingContextError
 from prefect.states import State
 from prefect.flows import Flow, FlowRun
+from prefect.futures import PrefectFuture, PrefectFutureList, as_completed
 from prefect.tasks import Task, TaskRun
 from prefect.runtime import flow_run
 
 from em_workflows.config import Config
+from em_workflows.constants import (
+    BRT_LINK_STAGING_MODES,
+    BRT_STAGING_MODES,
+    FILE_ORDERS,
+    PREFLIGHT_THREADS,
+)
 from em_workflows.file_path import FilePath
+from em_workflows.utils import api_client, prefetch, scratch, staging
 
 # used for keeping outputs of imod's header command (dimensions of image).
 Header = namedtuple("Header", "x y z")
 BrtOutput = namedtuple("BrtOutput", ["ali_file", "rec_file"])
+# dimensions and pixel dtype from the header of an MRC file
+# dtype is None for the modes missing from MRC_MODE_DTYPES, ext_bytes is the size of the extended header (NSYMBT)
+MrcHeader = namedtuple("MrcHeader", "x y z dtype mode byte_order ext_bytes")
+# entry of an input directory, from a single scan of the directory, see scan_dir
+FileInfo = namedtuple("FileInfo", "path size mtime inode")
+
+# MRC mode to pixel dtype, complex modes are read as a pair of values, RGB as 3 bytes
+MRC_MODE_DTYPES = {
+    0: "i1",
+    1: "i2",
+    2: "f4",
+    3: "(2,)i2",
+    4: "(2,)f4",
+    6: "u2",
+    12: "f2",
+    16: "(3,)u1",
+}
 
 
 def log(msg):
@@ -63,6 +95,25 @@ def lookup_dims(fp: Path) -> Header:
         return xyz_cleaned
 
 
+def read_mrc_header(fp: Path) -> MrcHeader:
+    """
+    :param fp: pathlib.Path to an MRC file
+    :returns: the x, y, z dims and the numpy dtype of the pixels of the file, None for a mode missing from
+      ``MRC_MODE_DTYPES`` (eg 101, 4 bits), the mode, byte order and size of the extended header
+
+    Reads the first words of the MRC header directly, the byte order is given by the machine stamp.
+    """
+    with open(fp, "rb") as f:
+        header = f.read(216)
+    if len(header) < 216:
+        raise RuntimeError(f"{fp} is too small to be an MRC file")
+    byte_order = ">" if header[212] == 0x11 else "<"
+    nx, ny, nz, mode = np.frombuffer(header[:16], dtype=f"{byte_order}i4").tolist()
+    ext_bytes = int(np.frombuffer(header[92:96], dtype=f"{byte_order}i4")[0])
+    dtype = np.dtype(MRC_MODE_DTYPES[mode]) if mode in MRC_MODE_DTYPES else None
+    return MrcHeader(nx, ny, nz, dtype, mode, byte_order, ext_bytes)
+
+
 @task(
     name="mrc to movie generation",
 )
@@ -105,6 +156,7 @@ def mrc_to_movie(file_path: FilePath, root: str, asset_type: str, **kwargs):
     ]
     log_file = f"{file_path.working_dir}/{file_path.base}_{asset_type}.log"
     FilePath.run(cmd=cmd, log_file=log_file)
+    file_path.release_intermediates("mrc_to_movie")
     asset_fp = file_path.copy_to_assets_dir(fp_to_cp=Path(mov))
     asset = file_path.gen_asset(asset_type=asset_type, asset_fp=asset_fp)
     return asset
@@ -237,6 +289,297 @@ def add_asset(prim_fp: dict, asset: dict, image_idx: int = None) -> dict:
     return prim_fp
 
 
+@task
+def declare_intermediates(
+    file_path: FilePath, intermediates: Dict[str, List[str]], x_keep_workdir: bool = False
+) -> FilePath:
+    """
+    Declares the intermediates of a file, which consumer steps delete as soon as they are no longer needed, see
+    ``FilePath.declare_intermediates``. Nothing is declared if ``x_keep_workdir``, to keep the full working dir.
+
+    :param intermediates: glob patterns mapped to their consumers, ``{base}`` and ``{name}`` in the patterns are
+      replaced by the base and name of the input file
+    :return: file_path, for downstream tasks to wait for the declaration
+    """
+    if not x_keep_workdir:
+        file_path.declare_intermediates(
+            {
+                pattern.format(base=file_path.base, name=file_path.fp_in.name): consumers
+                for pattern, consumers in intermediates.items()
+            }
+        )
+    return file_path
+
+
+def input_size(fp: Path) -> int:
+    """
+    :param fp: an input file, or directory of files
+    :return: uncompressed size in bytes, from the header of MRC files, otherwise the size of the file(s)
+    """
+    if fp.is_dir():
+        return sum(f.stat().st_size for f in fp.iterdir() if f.is_file())
+    if not fp.exists():
+        # pair of a and b files, see copy_tg_to_working_dir
+        return sum(input_size(f) for f in fp.parent.glob(f"{fp.stem}[ab]{fp.suffix}"))
+    if fp.suffix.lower() in (".mrc", ".st", ".ali", ".rec"):
+        header = read_mrc_header(fp)
+        if header.dtype is not None:
+            return header.x * header.y * header.z * header.dtype.itemsize
+    return fp.stat().st_size
+
+
+def file_size(file_path: FilePath) -> int:
+    """
+    :return: size of the input of file_path, from its listing if any, see ``gen_fps``, otherwise ``input_size``
+    """
+    if file_path.input_bytes is not None:
+        return file_path.input_bytes
+    return input_size(file_path.fp_in)
+
+
+@task(name="Input prefetch")
+def prefetch_input(file_path: FilePath, consumer: str) -> FilePath:
+    """
+    Copies the input into the working dir, see ``prefetch``, so the downstream steps read it from scratch, see
+    ``FilePath.input_fp``. The copy is deleted once ``consumer`` has finished with it.
+
+    :param consumer: name of the step reading the input, which calls ``FilePath.release_intermediates``
+    :return: file_path
+    """
+    file_path.declare_intermediates({FilePath.PREFETCH_DIR: [consumer]})
+    prefetch.prefetch(file_path, file_size(file_path))
+    return file_path
+
+
+@task(name="Scratch admission")
+def admit_to_scratch(file_path: FilePath, workflow: str) -> FilePath:
+    """
+    Waits for enough free scratch space for the peak footprint of the input, see ``scratch.admit``.
+    Downstream heavy steps wait for this task, so the inputs are queued rather than filling the scratch space.
+
+    :param workflow: key of ``SCRATCH_FOOTPRINT_FACTORS``
+    :return: file_path
+    """
+    if file_path.worker:
+        log(f"{file_path.working_dir} is on the local disk of {file_path.worker}, not admitted to shared scratch")
+        return file_path
+    n_bytes = scratch.estimate_footprint(file_size(file_path), workflow)
+    scratch.admit(file_path.working_dir, n_bytes)
+    return file_path
+
+
+@task
+def submission_order(fps: List[FilePath], order: str = "listed", rejected: Optional[List] = None) -> List[int]:
+    """
+    :param fps: FilePaths in the listing order
+    :param order: "listed" keeps the listing order, "smallest" submits the smallest inputs first, so the results of
+      the small files are not held up by a large one, "largest" submits the largest first, for the shortest run
+    :param rejected: for each of fps, None or its error callback element, see ``preflight``. Rejected inputs
+      are not submitted.
+    :return: indexes of fps in the order their tasks are to be submitted, see ``listing_order``
+    """
+    if order not in FILE_ORDERS:
+        raise RuntimeError(f"Unknown file order {order}, expected one of {FILE_ORDERS}")
+    idxs = [idx for idx in range(len(fps)) if not rejected or rejected[idx] is None]
+    if order == "listed":
+        return idxs
+    sizes = [file_size(fp) for fp in fps]
+    idxs.sort(key=lambda i: sizes[i], reverse=order == "largest")
+    log(f"Submission order ({order}): " + ", ".join(f"{fps[i].fp_in.name} {sizes[i]}" for i in idxs))
+    return idxs
+
+
+def listing_order(items: List, submitted: List[int], rejected: Optional[List] = None) -> List:
+    """
+    :param items: one item per submitted input, in the submission order
+    :param submitted: indexes of the inputs in the listing order, from ``submission_order``
+    :param rejected: for each input, None or its error callback element, see ``preflight``
+    :return: the items in the listing order of their inputs, with the error elements of the rejected inputs
+    """
+    listed = list(rejected) if rejected else [None] * len(items)
+    for item, idx in zip(items, submitted):
+        listed[idx] = item
+    return listed
+
+
+# leading bytes of the input formats, checked by validate_input
+TIFF_MAGICS = (b"II*\0", b"MM\0*", b"II+\0", b"MM\0+")
+FILE_MAGICS = {
+    ".tif": TIFF_MAGICS,
+    ".tiff": TIFF_MAGICS,
+    ".svs": TIFF_MAGICS,
+    ".png": (b"\x89PNG\r\n\x1a\n",),
+    ".jpg": (b"\xff\xd8\xff",),
+    ".jpeg": (b"\xff\xd8\xff",),
+    ".czi": (b"ZISRAWFILE",),
+    # version 3 or 4, big endian
+    ".dm3": (b"\0\0\0\x03",),
+    ".dm4": (b"\0\0\0\x04",),
+}
+MRC_SUFFIXES = (".mrc", ".st", ".ali", ".rec")
+
+
+def _validate_mrc(fp: Path, require_2d: bool = False) -> None:
+    """
+    Checks the header of an MRC file, and that the file holds all the data the header describes.
+    """
+    header = read_mrc_header(fp)
+    if min(header.x, header.y, header.z) < 1:
+        raise RuntimeError(f"{fp.name} has invalid dimensions {header.x}x{header.y}x{header.z}")
+    if require_2d and header.z != 1:
+        raise RuntimeError(f"{fp.name} is not 2 dimensional, it has {header.z} sections")
+    if header.dtype is None:
+        # eg mode 101, handled by IMOD
+        log(f"{fp.name} has MRC mode {header.mode}, size not checked")
+        return
+    expected = 1024 + header.ext_bytes + header.x * header.y * header.z * header.dtype.itemsize
+    size = fp.stat().st_size
+    if size < expected:
+        raise RuntimeError(f"{fp.name} is truncated, {size} bytes rather than {expected}")
+
+
+def validate_input(fp_in: Path, workflow: str) -> None:
+    """
+    Cheap checks of an input, which catch the bad inputs before any heavy work: the leading bytes of its format,
+    the header and size of MRC files, the tifs of the SEM stack dirs, the a and b files of BRT dual axis inputs.
+
+    :param workflow: "brt", "sem", "dm", "lrg_2d" or "czi"
+    :raises RuntimeError: with the reason the input is invalid
+    """
+    if workflow == "sem":
+        tifs = sorted(fp_in.glob("*.tif"))
+        if not tifs:
+            raise RuntimeError(f"Stack dir {fp_in.name} has no tif files")
+        for tif in tifs:
+            validate_input(tif, "")
+        return
+    if workflow == "brt" and not fp_in.exists():
+        # dual axis, see copy_tg_to_working_dir
+        pair = [fp_in.parent / f"{fp_in.stem}{axis}{fp_in.suffix}" for axis in "ab"]
+        missing = [fp.name for fp in pair if not fp.exists()]
+        if missing:
+            raise RuntimeError(f"{fp_in.name} not found, nor its dual axis files {', '.join(missing)}")
+        for fp in pair:
+            validate_input(fp, workflow)
+        return
+    if not fp_in.is_file():
+        raise RuntimeError(f"{fp_in.name} is not a file")
+    if fp_in.stat().st_size == 0:
+        raise RuntimeError(f"{fp_in.name} is empty")
+    suffix = fp_in.suffix.lower()
+    if suffix in MRC_SUFFIXES:
+        _validate_mrc(fp_in, require_2d=workflow == "dm")
+    elif suffix in FILE_MAGICS:
+        magics = FILE_MAGICS[suffix]
+        with open(fp_in, "rb") as f:
+            head = f.read(max(len(magic) for magic in magics))
+        if not any(head.startswith(magic) for magic in magics):
+            raise RuntimeError(f"{fp_in.name} is not a {suffix.strip('.')} file")
+
+
+@task(name="Pre-flight validation")
+def preflight(fps: List[FilePath], workflow: str) -> List[Optional[Dict]]:
+    """
+    Validates all the inputs concurrently, see ``validate_input``, before any heavy work is scheduled, so that a bad
+    input fails in seconds rather than after the files listed before it. The empty working dirs of the rejected
+    inputs are removed.
+
+    :param workflow: see ``validate_input``
+    :return: for each of fps, None if valid, otherwise its callback element with the error, see ``submission_order``
+    """
+
+    def _validate(fp: FilePath) -> Optional[Dict]:
+        try:
+            validate_input(fp.fp_in, workflow)
+            return None
+        except (RuntimeError, OSError) as e:
+            log(f"Rejected {fp.fp_in}: {e}")
+            fp.rm_workdir()
+            return fp.gen_prim_fp_elt(f"Error: {str(e)}.")
+
+    with ThreadPoolExecutor(max_workers=PREFLIGHT_THREADS) as executor:
+        rejected = list(executor.map(_validate, fps))
+    log(f"{sum(elt is not None for elt in rejected)} of {len(fps)} inputs rejected")
+    return rejected
+
+
+@task(name="Local working dir")
+def use_local_work_dir(file_path: FilePath) -> FilePath:
+    """
+    Moves the working dir of the input to the local disk of the dask worker running this task, see
+    ``FilePath.use_local_work_dir``. The downstream tasks are submitted with ``map_pinned``.
+
+    :return: file_path, with its local working dir and worker
+    """
+    file_path.use_local_work_dir()
+    return file_path
+
+
+def map_pinned(task: Task, file_paths: List[FilePath], **kwargs) -> PrefectFutureList:
+    """
+    Like ``task.map``, but the task of each input is submitted to the dask worker holding its local working dir,
+    if any, see ``use_local_work_dir``. Lists are mapped, ``unmapped`` and other values are passed to every task, and
+    ``wait_for`` applies to all of them.
+
+    Other workers are allowed, so that the tasks of a lost worker are not stuck, they then fail as the local working
+    dir is missing, see ``FilePath.working_dir``, and the input is run again in the shared scratch by
+    ``collect_callback``.
+
+    :param file_paths: FilePaths of the inputs, in the order of the mapped arguments
+    :return: futures of the tasks, in the order of file_paths
+    """
+    wait_for = kwargs.pop("wait_for", None)
+    futures = list()
+    for idx, file_path in enumerate(file_paths):
+        parameters = dict()
+        for key, value in kwargs.items():
+            if isinstance(value, unmapped):
+                parameters[key] = value.value
+            elif isinstance(value, (list, tuple)):
+                parameters[key] = value[idx]
+            else:
+                parameters[key] = value
+        placement = (
+            dask.annotate(workers=[file_path.worker], allow_other_workers=True) if file_path.worker else nullcontext()
+        )
+        with placement:
+            futures.append(task.submit(**parameters, wait_for=wait_for))
+    return PrefectFutureList(futures)
+
+
+class StageRunner:
+    """
+    Runs the steps of a fused per-file pipeline within the current task, rather than as separate Prefect tasks,
+    see eg ``sem_tomo_flow`` with ``x_fused``. The duration of each step is logged and appended to ``stages.log``
+    in the working dir, which is copied to the assets with the other logs. Errors are raised with the name of the
+    failed step, which ends up in the callback message of the file.
+    """
+
+    def __init__(self, file_path: FilePath) -> None:
+        self.file_path = file_path
+        self.timings = list()
+
+    def run(self, step: Task, **kwargs):
+        """
+        :param step: a task, whose function is called with ``kwargs``
+        :return: the result of the step
+        """
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            result = step.fn(**kwargs)
+            status = "ok"
+            return result
+        except Exception as e:
+            raise RuntimeError(f"{step.name} failed: {e}") from e
+        finally:
+            seconds = time.perf_counter() - start
+            self.timings.append((step.name, seconds))
+            log(f"{self.file_path.base}: {step.name} {status} in {seconds:.1f}s")
+            with open(self.file_path.working_dir / "stages.log", "a") as f:
+                f.write(f"{step.name}\t{status}\t{seconds:.1f}s\n")
+
+
 # triggers like "always_run" are managed when calling the task itself
 @task(retries=3, retry_delay_seconds=10)
 def cleanup_workdir(fps: List[FilePath], x_keep_workdir: bool):
@@ -351,27 +694,47 @@ def update_adoc(
     return adoc_loc
 
 
-def copy_tg_to_working_dir(fname: Path, working_dir: Path) -> Path:
+def copy_tg_to_working_dir(
+    fname: Path, working_dir: Path, modes: Tuple[str, ...] = BRT_STAGING_MODES
+) -> Path:
     """
-    copies files (tomograms/mrc files) into working_dir
-    returns Path of copied file
+    stages files (tomograms/mrc files) into working_dir, cloned rather than copied when possible,
+    see ``staging.stage_file``
+    returns Path of staged file
+    :param modes: staging modes, in order of preference
     :todo: Determine if the 'a' & 'b' files still exist and if these files need
     to be copied. (See comment in ``run_brt`` before this call is made)
     """
     new_loc = Path(f"{working_dir}/{fname.name}")
     if fname.exists():
-        shutil.copyfile(src=fname.as_posix(), dst=new_loc)
+        staging.stage_file(fname, new_loc, modes)
     else:
         fp_1 = Path(f"{fname.parent}/{fname.stem}a{fname.suffix}")
         fp_2 = Path(f"{fname.parent}/{fname.stem}b{fname.suffix}")
         if fp_1.exists() and fp_2.exists():
-            shutil.copyfile(src=fp_1.as_posix(), dst=f"{working_dir}/{fp_1.name}")
-            shutil.copyfile(src=fp_2.as_posix(), dst=f"{working_dir}/{fp_2.name}")
+            staging.stage_file(fp_1, Path(f"{working_dir}/{fp_1.name}"), modes)
+            staging.stage_file(fp_2, Path(f"{working_dir}/{fp_2.name}"), modes)
         else:
             raise RuntimeError(f"Files missing. {fp_1},{fp_2}. BRT run failure.")
     return new_loc
 
 
+@task(name="BRT input staging")
+def stage_brt_input(file_path: FilePath, link_input: bool = False) -> FilePath:
+    """
+    Stages the tilt series into the working dir, see ``copy_tg_to_working_dir``. As a task of its own, the
+    copy of an input, when it cannot be cloned, runs while batchruntomo processes the inputs before it.
+
+    :param link_input: also allow hard and symbolic links to the original, see ``staging``
+    :return: file_path
+    """
+    modes = BRT_LINK_STAGING_MODES if link_input else BRT_STAGING_MODES
+    copy_tg_to_working_dir(
+        fname=file_path.fp_in, working_dir=file_path.working_dir, modes=modes
+    )
+    return file_path
+
+
 def copy_template(working_dir: Path, template_name: str) -> Path:
     """
     :param working_dir: libpath.Path of temporary working directory
@@ -430,13 +793,15 @@ def run_brt(
         LocalAlignments=LocalAlignments,
         THICKNESS=THICKNESS,
     )
-    # why do we need to copy these?
+    # brt writes its outputs next to the stack, usually already staged by stage_brt_input
     copy_tg_to_working_dir(fname=file_path.fp_in, working_dir=file_path.working_dir)
 
     # START BRT (Batchruntomo) - long running process.
     cmd = [Config.brt_binary, "-di", updated_adoc.as_posix(), "-cp", "60", "-gpu", "1"]
     log_file = f"{file_path.working_dir}/brt_run.log"
     FilePath.run(cmd, log_file)
+    # inputs linked with x_link_input must not have been written through
+    staging.check_sources(file_path.working_dir)
     rec_file = Path(f"{file_path.working_dir}/{file_path.base}_rec.mrc")
     ali_file = Path(f"{file_path.working_dir}/{file_path.base}_ali.mrc")
     log(f"checking that dir {file_path.working_dir} contains ok BRT run")
@@ -444,6 +809,7 @@ def run_brt(
     for _file in [rec_file, ali_file]:
         if not _file.exists():
             raise ValueError(f"File {_file} does not exist. BRT run failure.")
+    file_path.release_intermediates("run_brt")
     return BrtOutput(ali_file=ali_file, rec_file=rec_file)
 
 
@@ -476,37 +842,72 @@ def copy_workdir_logs(file_path: FilePath) -> Path:
     return file_path.copy_workdir_logs_to_assets()
 
 
+def _matches(name: str, exts: List[str]) -> bool:
+    """
+    :return: True if the file name ends with one of the extensions, ignoring the case
+    """
+    name = name.lower()
+    return any(name.endswith(f".{ext.lower()}") for ext in exts)
+
+
+def scan_dir(input_dir: Path, exts: Optional[List[str]] = None) -> List[FileInfo]:
+    """
+    :param input_dir: directory to scan
+    :param exts: extensions of the files to list, case insensitive. If None, the subdirs are listed instead,
+      with the total size of their files.
+    :return: FileInfos sorted by name
+
+    Reads the directory once, rather than a glob per extension. The types of the entries come with the listing,
+    but on Linux their sizes do not: ``DirEntry.stat`` still makes a stat call per listed file (cached on the
+    entry, so one per file). The size is then kept on ``FilePath.input_bytes``, so that the later steps
+    (submission order, scratch admission, batches) do not stat the inputs again.
+    """
+    infos = list()
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if exts is None:
+                if not entry.is_dir():
+                    continue
+                with os.scandir(entry.path) as files:
+                    size = sum(f.stat().st_size for f in files if f.is_file())
+            elif entry.is_file() and _matches(entry.name, exts):
+                size = entry.stat().st_size
+            else:
+                continue
+            stat = entry.stat()
+            infos.append(FileInfo(Path(entry.path), size, stat.st_mtime, stat.st_ino))
+    return sorted(infos, key=lambda info: info.path.name)
+
+
 @task
 def list_files(
     input_dir: Path, exts: List[str], single_file: Optional[str] = None
-) -> List[Path]:
+) -> List[FileInfo]:
     """
     :param input_dir: libpath.Path of the input directory
-    :param exts: List of str extensions to be checked
+    :param exts: List of str extensions to be checked, case insensitive
     :param single_file: if present, only that file returned
-    :return: List of pathlib.Paths of matching files
+    :return: List of FileInfos of matching files, see ``scan_dir``
 
     - List all files within input_dir with specified extension.
     - if a specific file is requested that file is returned only.
     - This allows workflows to run on single files rather than entire dirs (default).
-    - Note, if no files are found does NOT raise exception. Function can be called
-      multiple times, sometimes there will be no files of that extension.
+    - Raises an exception if no files are found.
     """
-    _files = list()
     if single_file:
         log(f"Looking for single file: {single_file} in {input_dir}")
         fp = input_dir / single_file
-        if any([single_file.endswith(f".{e}") for e in exts]):
+        _files = list()
+        if _matches(single_file, exts):
             if not fp.exists():
                 raise RuntimeError(
                     f"Expected file: {single_file}, not found in input_dir"
                 )
-            else:
-                _files.append(fp)
+            stat = fp.stat()
+            _files.append(FileInfo(fp, stat.st_size, stat.st_mtime, stat.st_ino))
     else:
         log(f"Looking for *.{exts} in {input_dir}")
-        for ext in exts:
-            _files.extend(input_dir.glob(f"*.{ext}"))
+        _files = scan_dir(input_dir, exts)
     if not _files:
         raise RuntimeError(f"Input dir {input_dir} not contain anything to process.")
     log(f"found {len(_files)} files")
@@ -514,17 +915,17 @@ def list_files(
 
 
 @task
-def list_dirs(input_dir_fp: Path) -> List[Path]:
+def list_dirs(input_dir_fp: Path) -> List[FileInfo]:
     """
     Lists subdirs of directory input_dir
     Some pipelines, eg SEM, store image stacks in dirs (rather than
     single files.
     """
     log(f"trying to list {input_dir_fp}")
-    dirs = [Path(x) for x in input_dir_fp.iterdir() if x.is_dir()]
+    dirs = scan_dir(input_dir_fp)
     if len(dirs) == 0:
         raise RuntimeError(f"Unable to find any subdirs in dir: {input_dir_fp}")
-    log(f"Found {dirs}")
+    log(f"Found {[info.path for info in dirs]}")
     return dirs
 
 
@@ -542,20 +943,14 @@ def notify_api_running(
         raise RuntimeError(
             "notify_api_running: Either callback_url or token is missing"
         )
-    headers = {
-        "Authorization": "Bearer " + token,
-        "Content-Type": "application/json",
-    }
-    response = requests.post(
-        callback_url, headers=headers, data=json.dumps({"status": "running"})
-    )
+    response = api_client.post(callback_url, token, {"status": "running"})
     log(response.text)
     log(response.headers)
-    if not response.ok:
+    if not response.is_success:
         msg = f"Bad response on notify_api_running: {response}"
         log(msg=msg)
         raise RuntimeError(msg)
-    return response.ok
+    return response.is_success
 
 
 # def custom_terminal_state_handler(
@@ -616,16 +1011,6 @@ async def notify_api_completion(flow: Flow, flow_run: FlowRun, state: State) ->
         log(f"x_no_api flag used\nCompletion status: {status}")
         return None
 
-    # Use httpx (same library Prefect uses internally) so SSL cert configuration
-    # is consistent. aiohttp was causing ssl.SSLError: passed invalid argument
-    # due to SSL_CERT_FILE being empty in the HPC environment.
-    import httpx
-
-    ca_bundle = (os.environ.get("REQUESTS_CA_BUNDLE") or "").strip() or True
-    headers = {
-        "Authorization": "Bearer " + token,
-        "Content-Type": "application/json",
-    }
     redacted_token = (token[:4] + "****") if token else "(empty)"
     log_dir = os.path.join(os.environ.get("HOME", "."), "slurm-log")
     os.makedirs(log_dir, exist_ok=True)
@@ -636,18 +1021,18 @@ async def notify_api_completion(flow: Flow, flow_run: FlowRun, state: State) ->
         )
         hooks_log.write(f"Pipeline status is:{status}\n")
         try:
-            async with httpx.AsyncClient(verify=ca_bundle) as client:
-                response = await client.post(
-                    callback_url, headers=headers, json={"status": status}
-                )
-                hooks_log.write(f"status_code={response.status_code}\n")
-                hooks_log.write(f"headers={response.headers}\n")
-                hooks_log.write(f"text={response.text}\n")
-                if not response.is_success:
-                    msg = f"Bad response code on callback: {response.status_code}"
-                    log(msg=msg)
-                    hooks_log.write(f"{msg}\n")
-                    raise RuntimeError(msg)
+            # the client of the process (httpx, as used by Prefect, for a consistent SSL configuration), in a thread
+            response = await asyncio.to_thread(
+                api_client.post, callback_url, token, {"status": status}
+            )
+            hooks_log.write(f"status_code={response.status_code}\n")
+            hooks_log.write(f"headers={response.headers}\n")
+            hooks_log.write(f"text={response.text}\n")
+            if not response.is_success:
+                msg = f"Bad response code on callback: {response.status_code}"
+                log(msg=msg)
+                hooks_log.write(f"{msg}\n")
+                raise RuntimeError(msg)
         except Exception as e:
             hooks_log.write(f"Exception: {e}\n")
             raise
@@ -694,22 +1079,48 @@ def get_input_dir(share_name: str, input_dir: str) -> Path:
     return p
 
 
+@task
+def gen_batches(fps: List[FilePath], batch_size: int) -> List[List[FilePath]]:
+    """
+    :param fps: List of FilePaths to be grouped
+    :param batch_size: the average number of files per batch
+    :return: List of batches, each a List of FilePaths
+
+    Groups the inputs into ``ceil(len(fps) / batch_size)`` batches of roughly equal total input
+    size, so a batch of large files does not hold up the run while the other batches idle.
+    Files are assigned largest first to the batch with the least bytes so far (LPT scheduling).
+    Within each batch the original listing order is kept.
+    """
+    n_batches = max(1, math.ceil(len(fps) / batch_size))
+    sizes = [file_size(fp) for fp in fps]
+    batch_totals = [(0, b_idx) for b_idx in range(n_batches)]
+    batch_idxs = [list() for _ in range(n_batches)]
+    for idx in sorted(range(len(fps)), key=lambda i: sizes[i], reverse=True):
+        total, b_idx = heapq.heappop(batch_totals)
+        batch_idxs[b_idx].append(idx)
+        heapq.heappush(batch_totals, (total + sizes[idx], b_idx))
+    batches = [[fps[idx] for idx in sorted(idxs)] for idxs in batch_idxs if idxs]
+    log(f"Grouped {len(fps)} files into {len(batches)} batches")
+    return batches
+
+
 @task(
     # persisting to retrieve again in hooks
     persist_result=True,
 )
-def gen_fps(share_name: str, input_dir: Path, fps_in: List[Path]) -> List[FilePath]:
+def gen_fps(share_name: str, input_dir: Path, fps_in: List[FileInfo]) -> List[FilePath]:
     """
-    Given in input directory (Path) and a list of input files (Path), return
+    Given in input directory (Path) and a list of input files (FileInfo, see ``list_files``), return
     a list of FilePaths for the input files. This includes a temporary working
-    directory for each file to keep the files separate on the HPC.
+    directory for each file to keep the files separate on the HPC, created on first use.
+    The listed sizes are kept, see ``file_size``.
     """
     fps = list()
-    for fp in fps_in:
-        file_path = FilePath(share_name=share_name, input_dir=input_dir, fp_in=fp)
-        msg = f"created working_dir {file_path.working_dir} for {fp.as_posix()}"
-        log(msg)
+    for info in fps_in:
+        file_path = FilePath(share_name=share_name, input_dir=input_dir, fp_in=info.path)
+        file_path.input_bytes = info.size
         fps.append(file_path)
+    log(f"Generated FilePaths of {len(fps)} inputs")
     return fps
 
 
@@ -720,6 +1131,8 @@ def send_callback_body(
     files_elts: List[Dict],
     token: Optional[str] = None,
     callback_url: Optional[str] = None,
+    partial: bool = False,
+    summary: bool = False,
 ) -> None:
     """
     Upon completion of file conversion a callback is made to the calling
@@ -728,25 +1141,29 @@ def send_callback_body(
 
     .. code-block::
         Refer to docs/demo_callback.json for expected
+
+    :param partial: the files are only some of the completed ones, see ``IncrementalCallback``
+    :param summary: add the numbers of files and of failed files, to the final callback after partial ones
     """
     data = {"files": files_elts}
+    if partial:
+        data["partial"] = True
+    elif summary:
+        errors = sum(elt.get("status") == "error" for elt in files_elts)
+        data["summary"] = {"files": len(files_elts), "errors": errors}
     if x_no_api is True:
         log("x_no_api flag used, not interacting with API")
         log(json.dumps(data))
         return
 
     if callback_url and token:
-        headers = {
-            "Authorization": "Bearer " + token,
-            "Content-Type": "application/json",
-        }
-        response = requests.post(callback_url, headers=headers, data=json.dumps(data))
+        response = api_client.post(callback_url, token, data)
         log(response.url)
         log(response.status_code)
         log(json.dumps(data))
         log(response.text)
         log(response.headers)
-        if not response.ok:
+        if not response.is_success:
             msg = f"Bad response code on callback: {response}"
             log(msg=msg)
             raise RuntimeError(msg)
@@ -756,6 +1173,97 @@ def send_callback_body(
         )
 
 
+class IncrementalCallback:
+    """
+    Posts the callback elements of the files as they complete, by batches of ``batch_size`` files, as partial
+    callbacks ahead of the final one with all the files, see ``send_callback_body``. The API then shows the first
+    results of a large submission without waiting for its slowest file. Does nothing if batch_size is 0.
+    """
+
+    def __init__(
+        self, batch_size: int, x_no_api: bool, token: Optional[str] = None, callback_url: Optional[str] = None
+    ) -> None:
+        self.batch_size = batch_size
+        self.x_no_api = x_no_api
+        self.token = token
+        self.callback_url = callback_url
+        self.pending = list()
+        self.posts = list()
+
+    def add(self, elts: List[Dict]) -> None:
+        """
+        :param elts: callback elements of completed files, posted once a batch is complete
+        """
+        if self.batch_size <= 0:
+            return
+        self.pending.extend(elt for elt in elts if elt is not None)
+        while len(self.pending) >= self.batch_size:
+            self._post(self.pending[: self.batch_size])
+            del self.pending[: self.batch_size]
+
+    def flush(self) -> None:
+        """
+        Posts the remaining elements, and waits for the partial callbacks to be sent, before the final callback.
+        """
+        if self.pending:
+            self._post(self.pending)
+            self.pending = list()
+        for post in self.posts:
+            post.wait()
+
+    def _post(self, elts: List[Dict]) -> None:
+        self.posts.append(
+            send_callback_body.submit(
+                x_no_api=self.x_no_api,
+                files_elts=elts,
+                token=self.token,
+                callback_url=self.callback_url,
+                partial=True,
+            )
+        )
+
+
+def collect_callback(
+    fps: List[FilePath],
+    elts: List[PrefectFuture],
+    incremental: Optional[IncrementalCallback] = None,
+    rerun: Optional[Callable[[List[FilePath]], List[PrefectFuture]]] = None,
+) -> List[Dict]:
+    """
+    Waits for the callback element of each file, or builds its error element if any of its tasks failed.
+
+    :param elts: futures of the callback elements, one per file of fps
+    :param incremental: posts the elements as they complete
+    :param rerun: submits the tasks of the given files, as for elts. A file whose local working dir was lost with its
+      worker (see ``FilePath.use_shared_work_dir``) is run again with it, once, in the shared scratch.
+    :return: the elements, in the order of fps
+    """
+    callback_result = [None] * len(fps)
+
+    def collect(idx_of: Dict[int, int], futures: List[PrefectFuture], reruns: Dict[int, PrefectFuture]) -> None:
+        for elt in as_completed(futures):
+            idx = idx_of[id(elt)]
+            try:
+                callback_result[idx] = elt.result()
+            except Exception as e:
+                if rerun and fps[idx].use_shared_work_dir():
+                    log(f"Running {fps[idx].fp_in.name} again in {fps[idx].working_dir}")
+                    reruns[idx] = rerun([fps[idx]])[0]
+                    continue
+                callback_result[idx] = fps[idx].gen_prim_fp_elt(f"Error: {str(e)}.")
+            if incremental:
+                incremental.add([callback_result[idx]])
+
+    reruns = dict()
+    collect({id(elt): idx for idx, elt in enumerate(elts)}, list(elts), reruns)
+    if reruns:
+        # the files run again are no longer pinned, they are not run a third time
+        collect({id(elt): idx for idx, elt in reruns.items()}, list(reruns.values()), dict())
+    if incremental:
+        incremental.flush()
+    return callback_result
+
+
 def callback_with_cleanup(
     fps: List[FilePath],
     callback_result: List,
@@ -109,3 +109,93 @@ async def test_czi_workflow_server_response_structure(
     label_element = label_element[0]
     assert len(label_element["assets"]) == 1
     assert label_element["assets"][0]["type"] == "thumbnail"
+
+    # paths refer to the assets copy, not the working zarr the metadata was read from
+    assert Path(nzarr["path"]).exists()
+    assert first["fileMetadata"]["omeXml"].endswith("OME/METADATA.ome.xml")
+    assert Path(first["fileMetadata"]["omeXml"]).exists()
+
+
+def _ome_xml(n_series):
+    return (
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        + "".join(f'<Image ID="Image:{i}" Name="scene {i}"/>' for i in range(n_series))
+        + "</OME>"
+    )
+
+
+def _fake_gen_zarr(ome_xml, converted):
+    import zarr
+
+    def fake_gen_zarr(file_path, input_fname, series=None, output_zarr=None, **kwargs):
+        # bioformats2raw writes the selected series as the only series group
+        output_zarr = output_zarr or f"{file_path.working_dir}/{file_path.base}.zarr"
+        root = zarr.open_group(output_zarr, mode="w")
+        root.create_group("0").attrs["converted_series"] = series[0] if series else None
+        root.create_group("OME").attrs["series"] = ["0"]
+        (Path(output_zarr) / "OME" / "METADATA.ome.xml").write_text(ome_xml)
+        converted.append(series)
+        return Path(output_zarr)
+
+    return fake_gen_zarr
+
+
+def test_bioformats_gen_zarr_by_series_merges_series(monkeypatch, tmp_path):
+    from types import SimpleNamespace
+    import zarr
+    from em_workflows.utils import neuroglancer as ng
+
+    n_series = 3
+    converted = []
+    monkeypatch.setattr(
+        ng, "_bioformats_ome_xml", lambda input_fname: _ome_xml(n_series)
+    )
+    monkeypatch.setattr(
+        ng, "bioformats_gen_zarr", _fake_gen_zarr(_ome_xml(n_series), converted)
+    )
+    file_path = SimpleNamespace(working_dir=tmp_path, base="input")
+    output_zarr = ng.bioformats_gen_zarr_by_series(
+        file_path, "input.czi", width=512, height=512
+    )
+
+    assert sorted(converted) == [[idx] for idx in range(n_series)]
+    root = zarr.open_group(output_zarr.as_posix(), mode="r")
+    assert root["OME"].attrs["series"] == ["0", "1", "2"]
+    for idx in range(n_series):
+        assert root[str(idx)].attrs["converted_series"] == idx
+    # only the merged zarr remains
+    assert [p.name for p in tmp_path.glob("*.zarr")] == ["input.zarr"]
+
+
+def test_bioformats_gen_zarr_by_series_xml_mismatch(monkeypatch, tmp_path):
+    from types import SimpleNamespace
+    import zarr
+    from em_workflows.utils import neuroglancer as ng
+
+    # the metadata of each run only describes its own series
+    monkeypatch.setattr(ng, "_bioformats_ome_xml", lambda input_fname: _ome_xml(3))
+    monkeypatch.setattr(ng, "bioformats_gen_zarr", _fake_gen_zarr(_ome_xml(1), []))
+    file_path = SimpleNamespace(working_dir=tmp_path, base="input")
+    output_zarr = ng.bioformats_gen_zarr_by_series(
+        file_path, "input.czi", width=512, height=512
+    )
+
+    root = zarr.open_group(output_zarr.as_posix(), mode="r")
+    assert root["OME"].attrs["series"] == ["0", "1", "2"]
+    ome_xml_fp = output_zarr / "OME" / "METADATA.ome.xml"
+    assert ng._ome_xml_image_count(ome_xml_fp.read_text()) == 3
+
+
+def test_bioformats_gen_zarr_by_series_probe_failure(monkeypatch, tmp_path):
+    from types import SimpleNamespace
+    from em_workflows.utils import neuroglancer as ng
+
+    converted = []
+    monkeypatch.setattr(ng, "_bioformats_ome_xml", lambda input_fname: None)
+    monkeypatch.setattr(
+        ng, "bioformats_gen_zarr", _fake_gen_zarr(_ome_xml(3), converted)
+    )
+    file_path = SimpleNamespace(working_dir=tmp_path, base="input")
+    ng.bioformats_gen_zarr_by_series(file_path, "input.czi", width=512, height=512)
+    # all series at once
+    assert converted == [None]
@@ -127,3 +127,149 @@ def test_single_file_not_found_gens_exception(mock_nfs_mount):
         return_state=True,
     )
     assert state.is_failed()
+
+
+def test_dm4_conv_batched(mock_nfs_mount, mock_callback_data):
+    from em_workflows.dm_conversion.flow import dm_flow
+
+    state = dm_flow(
+        file_share="test",
+        input_dir="/test/input_files/dm_inputs/Projects/Lab/PI",
+        x_no_api=True,
+        x_batch_size=4,
+        return_state=True,
+    )
+    assert state.is_completed(), f"State is {state}"
+
+    with open(mock_callback_data) as fd:
+        response = json.load(fd)
+
+    results = response["files"]
+    assert len(results) > 4, "expected more than a single batch of inputs"
+    for result in results:
+        assert result["status"] == "success"
+        assert sorted(asset["type"] for asset in result["imageSet"][0]["assets"]) == [
+            "keyImage",
+            "thumbnail",
+        ]
+
+
+def _write_dm4(fp, arr):
+    """
+    Writes a minimal little endian DM4 file with a small thumbnail and ``arr`` in the ImageList,
+    as Digital Micrograph does.
+    """
+    import struct
+    import numpy as np
+
+    dm_types = {np.dtype("int16"): (2, 1), np.dtype("uint16"): (4, 10), np.dtype("float32"): (6, 2)}
+    enc_type, data_type = dm_types[arr.dtype]
+
+    def tag(label, body, tag_type=21):
+        label = label.encode()
+        return struct.pack(">bh", tag_type, len(label)) + label + struct.pack(">q", len(body)) + body
+
+    def data_tag(label, info, payload):
+        body = b"%%%%" + struct.pack(">q", len(info)) + struct.pack(f">{len(info)}q", *info)
+        return tag(label, body + payload)
+
+    def group(label, tags):
+        body = b"\x00\x01" + struct.pack(">q", len(tags)) + b"".join(tags)
+        return tag(label, body, tag_type=20)
+
+    def image(a):
+        dims = [data_tag("", [5], struct.pack("<I", n)) for n in reversed(a.shape)]
+        image_data = group(
+            "ImageData",
+            [
+                data_tag("Data", [20, enc_type, a.size], a.astype("<" + a.dtype.str[1:]).tobytes()),
+                data_tag("DataType", [5], struct.pack("<I", data_type)),
+                group("Dimensions", dims),
+            ],
+        )
+        return group("", [image_data])
+
+    thumbnail = np.zeros((4, 4), dtype=arr.dtype)
+    root = group("", [group("ImageList", [image(thumbnail), image(arr)])])
+    with open(fp, "wb") as fh:
+        # version, root length, little endian data, then the root group without its tag header
+        fh.write(struct.pack(">iqi", 4, 0, 1) + root[3 + 8:])
+
+
+def test_read_dm_synthetic(tmp_path):
+    import numpy as np
+    from em_workflows.dm_conversion.dm_reader import read_dm
+
+    arr = np.arange(60 * 40, dtype=np.uint16).reshape(60, 40)
+    fp = tmp_path / "synthetic.dm4"
+    _write_dm4(fp, arr)
+
+    read_arr = read_dm(fp)
+    assert read_arr.shape == (60, 40)
+    np.testing.assert_array_equal(read_arr, arr)
+
+
+def test_read_dm_test_data():
+    from pathlib import Path
+    from em_workflows.dm_conversion.dm_reader import read_dm
+
+    fp = Path("test/input_files/dm_inputs/Projects/Lab/PI/20210525_1416_A000_G000.dm4")
+    if not fp.exists():
+        pytest.skip(f"Missing test data {fp}")
+    assert read_dm(fp).shape == (4095, 3842)
+
+
+def test_read_2d_image_dm_shrinks_to_target(tmp_path):
+    import numpy as np
+    from em_workflows.dm_conversion.flow import _read_2d_image
+
+    rng = np.random.default_rng(0)
+    arr = rng.normal(1000, 100, size=(300, 200)).astype(np.float32)
+    fp = tmp_path / "synthetic.dm4"
+    _write_dm4(fp, arr)
+
+    img = _read_2d_image(fp, target_size=100)
+    assert img.GetSize() == (66, 100)
+    assert img.GetPixelIDValue() == 1  # sitkUInt8
+
+
+@pytest.mark.parametrize("filename", ["image16.tif", "image.mrc"])
+def test_read_2d_image_scales_em_images(tmp_path, filename):
+    import numpy as np
+    import SimpleITK as sitk
+    from em_workflows.dm_conversion.flow import _read_2d_image
+
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 4096, size=(50, 80)).astype(np.uint16)
+    fp = tmp_path / filename
+    sitk.WriteImage(sitk.GetImageFromArray(arr), fp)
+
+    img = _read_2d_image(fp, target_size=40)
+    assert img.GetSize() == (40, 25)
+    assert img.GetPixelID() == sitk.sitkUInt8
+    if fp.suffix == ".mrc":
+        # "meansd" scaling, to a mean of 140
+        assert abs(sitk.GetArrayViewFromImage(img).mean() - 140) < 5
+
+
+def test_read_2d_image_rejects_3d_mrc(tmp_path):
+    import numpy as np
+    import SimpleITK as sitk
+    from em_workflows.dm_conversion.flow import _read_2d_image
+
+    fp = tmp_path / "stack.mrc"
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((3, 20, 20), dtype=np.float32)), fp)
+    with pytest.raises(RuntimeError, match="not 2 dimensional"):
+        _read_2d_image(fp)
+
+
+def test_shrink_antialias_preserves_constant():
+    import numpy as np
+    from em_workflows.dm_conversion.flow import _shrink_antialias
+
+    arr = np.full((101, 64), 7.0)
+    shrunk = _shrink_antialias(arr, 4)
+    assert shrunk.shape == (25, 16)
+    np.testing.assert_allclose(shrunk, 7.0, rtol=1e-5)
+    # images are not enlarged
+    assert _shrink_antialias(arr, 0.5).shape == arr.shape
@@ -123,3 +123,78 @@ def test_filepath_run_env(mock_nfs_mount, tmp_path, request):
         assert "env_var_value" not in log_content
         assert "parent_env_value" not in log_content
     log_file.unlink()
+
+
+def test_release_intermediates(mock_nfs_mount):
+    input_filename = "test/input_files/dm_inputs/Projects/Lab/PI/PrP - Protein.007.tif"
+    input_dir = Path(input_filename).absolute()
+
+    fp_in = FilePath(share_name="test", input_dir=input_dir.parent, fp_in=input_dir)
+    source = fp_in.gen_output_fp(out_fname="source.mrc")
+    source.write_bytes(b"source")
+    for i in range(3):
+        fp_in.gen_output_fp(out_fname=f"mp4.{i:03d}.jpg").write_bytes(b"jpg")
+    fp_in.declare_intermediates({"source.mrc": ["align", "stack"], "mp4.*.jpg": ["movie"]})
+
+    assert fp_in.release_intermediates("align") == []
+    assert source.exists()
+    # undeclared consumers and intermediates are ignored
+    assert fp_in.release_intermediates("thumbs") == []
+    assert fp_in.release_intermediates("stack", patterns=["mp4.*.jpg"]) == []
+
+    assert fp_in.release_intermediates("stack") == [source]
+    assert not source.exists()
+    assert len(fp_in.release_intermediates("movie")) == 3
+    assert not list(fp_in.working_dir.glob("*.jpg"))
+    fp_in.rm_workdir()
+
+
+def test_filepath_lazy_dirs(mock_nfs_mount, monkeypatch, tmp_path):
+    """
+    A FilePath only names its directories, they are created on first use, and it pickles without them
+    """
+    import pickle
+    from em_workflows.config import Config
+
+    monkeypatch.setattr(Config, "tmp_dir", str(tmp_path / "scratch"))
+    input_dir = tmp_path / "Projects" / "Lab"
+    input_dir.mkdir(parents=True)
+    fp_in = input_dir / "image.tif"
+    fp_in.write_bytes(b"II*\0")
+
+    file_path = FilePath(share_name="test", input_dir=input_dir, fp_in=fp_in)
+    assert not hasattr(file_path, "__dict__")
+    assert not (tmp_path / "scratch").exists()
+    assert not (tmp_path / "Assets").exists()
+
+    copied = pickle.loads(pickle.dumps(file_path))
+    assert copied.working_dir.is_dir()
+    assert copied.working_dir == file_path.working_dir
+    assert copied.assets_dir == tmp_path / "Assets" / "Lab" / "image"
+    assert copied.assets_dir.is_dir()
+    copied.rm_workdir()
+    assert not copied._working_dir.exists()
+
+
+def test_prefetch_input_fp(mock_nfs_mount, monkeypatch, tmp_path):
+    """
+    The input is read from the Projects share until its prefetched copy is complete, the copy in flight is then
+    no longer recorded
+    """
+    from em_workflows.config import Config
+    from em_workflows.utils import prefetch
+
+    monkeypatch.setattr(Config, "tmp_dir", str(tmp_path / "scratch"))
+    input_dir = tmp_path / "Projects" / "Lab"
+    input_dir.mkdir(parents=True)
+    fp_in = input_dir / "image.tif"
+    fp_in.write_bytes(b"II*\0tiff")
+
+    file_path = FilePath(share_name="test", input_dir=input_dir, fp_in=fp_in)
+    assert file_path.input_fp == fp_in
+    copy = prefetch.prefetch(file_path, n_bytes=fp_in.stat().st_size)
+    assert file_path.input_fp == copy
+    assert copy.read_bytes() == fp_in.read_bytes()
+    assert prefetch.prefetch(file_path, n_bytes=fp_in.stat().st_size) == copy
+    with prefetch._locked_in_flight() as in_flight_dir:
+        assert prefetch._in_flight(in_flight_dir) == []
@@ -52,7 +52,7 @@ def test_lrg_2d_flow_failure_server_response(
     from em_workflows.lrg_2d_rgb.flow import lrg_2d_flow
     from em_workflows.lrg_2d_rgb.flow import ng
 
-    original_gen_zarr = ng.bioformats_gen_zarr
+    original_gen_zarr = ng.stream_gen_zarr
 
     def fake_gen_zarr(file_path, input_fname):
         print(f"Fake called for {input_fname=}")
@@ -60,7 +60,7 @@ def test_lrg_2d_flow_failure_server_response(
             raise RuntimeError(f"Bad input file {input_fname}")
         return original_gen_zarr(file_path, input_fname)
 
-    monkeypatch.setattr(ng, "bioformats_gen_zarr", fake_gen_zarr)
+    monkeypatch.setattr(ng, "stream_gen_zarr", fake_gen_zarr)
 
     state = lrg_2d_flow(
         file_share="test",
@@ -90,14 +90,14 @@ def test_lrg_2d_flow_partial_failure_server_response(
     from em_workflows.lrg_2d_rgb.flow import lrg_2d_flow
     from em_workflows.lrg_2d_rgb.flow import ng
 
-    original_gen_zarr = ng.bioformats_gen_zarr
+    original_gen_zarr = ng.stream_gen_zarr
 
     def fake_gen_zarr(file_path, input_fname):
         if fails_for in input_fname:
             raise RuntimeError(f"Bad input file {input_fname}")
         return original_gen_zarr(file_path, input_fname)
 
-    monkeypatch.setattr(ng, "bioformats_gen_zarr", fake_gen_zarr)
+    monkeypatch.setattr(ng, "stream_gen_zarr", fake_gen_zarr)
 
     state = lrg_2d_flow(
         file_share="test",
@@ -125,6 +125,31 @@ def test_lrg_2d_flow_partial_failure_server_response(
             assert result["message"] is None
 
 
+def test_lrg_2d_flow_sharded_zarr(mock_nfs_mount):
+    from em_workflows.lrg_2d_rgb.flow import lrg_2d_flow
+
+    state = lrg_2d_flow(
+        file_share="test",
+        input_dir="/test/input_files/lrg_ROI_pngs/Projects",
+        file_name="even_smaller.png",
+        x_no_api=True,
+        x_sharded_zarr=True,
+        return_state=True,
+    )
+    assert state.is_completed(), "lrg flow run failed"
+
+    zarr_fp = Path(
+        "test/input_files/lrg_ROI_pngs/Assets/even_smaller/even_smaller.zarr"
+    )
+    assert (
+        json.loads((zarr_fp / "zarr.json").read_text())["attributes"]["ome"]["version"]
+        == "0.5"
+    )
+    array_meta = json.loads((zarr_fp / "0" / "0" / "zarr.json").read_text())
+    assert array_meta["codecs"][0]["name"] == "sharding_indexed"
+    assert not list(zarr_fp.rglob(".zarray"))
+
+
 def test_only_wd_logs_are_copied(mock_nfs_mount):
     from em_workflows.lrg_2d_rgb.flow import lrg_2d_flow
 
@@ -142,3 +167,32 @@ def test_only_wd_logs_are_copied(mock_nfs_mount):
     assert (
         len(list(asset_path.glob("logs*/even_smaller/*"))) > 0
     ), "Log files are missing"
+
+
+def test_streaming_pyramid_matches_full_image():
+    import numpy as np
+    import zarr
+    from em_workflows.utils.neuroglancer import _StreamingPyramid, _downsample_rows
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(301, 203, 3)).astype(np.uint8)
+    group = zarr.group()
+    pyramid = _StreamingPyramid(
+        group, width=203, height=301, channels=3, chunks=[(64, 64)] * 4
+    )
+    # bands do not need to be aligned to the chunks
+    for start in range(0, 301, 50):
+        stop = start + 50
+        pyramid.push(image[start:stop])
+    pyramid.close()
+
+    assert [a.shape for a in pyramid.arrays] == [
+        (1, 3, 1, 301, 203),
+        (1, 3, 1, 151, 102),
+        (1, 3, 1, 76, 51),
+        (1, 3, 1, 38, 26),
+    ]
+    expected = image
+    for array in pyramid.arrays:
+        np.testing.assert_array_equal(np.moveaxis(array[0, :, 0], 0, 2), expected)
+        expected = _downsample_rows(expected)
@@ -109,6 +109,8 @@ def test_mount_config(mock_nfs_mount):
     assert shutil.which(Config.header_loc)
     assert shutil.which(Config.mrc2tif_loc)
     assert shutil.which(Config.newstack_loc)
+    assert shutil.which(Config.identify_loc)
+    assert shutil.which(Config.stream_loc)
     assert shutil.which(SEMConfig.tif2mrc_loc)
     assert shutil.which(SEMConfig.xfalign_loc)
     assert shutil.which(SEMConfig.xftoxg_loc)
@@ -343,6 +345,34 @@ def test_list_files(mock_nfs_mount):
     assert len(files) == 1
 
 
+def test_scan_dir(tmp_path):
+    """
+    Extensions match regardless of their case, in a single scan, and subdirs are listed with the size of their files
+    """
+    for name, size in [
+        ("a.CZI", 3),
+        ("b.czi", 5),
+        ("c.ome.TIF", 7),
+        ("d.tif", 1),
+        ("e.txt", 1),
+    ]:
+        (tmp_path / name).write_bytes(b"\0" * size)
+    (tmp_path / "stack.czi").mkdir()
+    (tmp_path / "stack.czi" / "1.tif").write_bytes(b"\0" * 11)
+    (tmp_path / "stack.czi" / "2.tif").write_bytes(b"\0" * 13)
+
+    infos = utils.scan_dir(tmp_path, ["czi", "ome.tif"])
+    assert [(info.path.name, info.size) for info in infos] == [
+        ("a.CZI", 3),
+        ("b.czi", 5),
+        ("c.ome.TIF", 7),
+    ]
+    assert infos[0].inode == (tmp_path / "a.CZI").stat().st_ino
+
+    dirs = utils.scan_dir(tmp_path)
+    assert [(info.path, info.size) for info in dirs] == [(tmp_path / "stack.czi", 24)]
+
+
 def test_state_hooks_calls(prefect_test_fixture):
     """
     Tests whether states hooks are called appropriately
@@ -646,3 +676,668 @@ async def test_async_and_sync_subflows(prefect_test_fixture):
 
     s_results = await myflow()
     assert s_results == [2, 4, 6]
+
+
+def test_gen_batches_balances_sizes(tmp_path):
+    """
+    Batches are balanced by input size and keep the listing order within a batch
+    """
+    from types import SimpleNamespace
+
+    fps = list()
+    for idx, size in enumerate([100, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 90]):
+        fp_in = tmp_path / f"{idx:02d}.tif"
+        fp_in.write_bytes(b"\0" * size)
+        fps.append(SimpleNamespace(fp_in=fp_in, input_bytes=None))
+
+    batches = utils.gen_batches.fn(fps, batch_size=4)
+    assert len(batches) == 3
+    assert sorted(fp.fp_in.name for batch in batches for fp in batch) == [
+        fp.fp_in.name for fp in fps
+    ]
+    totals = [sum(fp.fp_in.stat().st_size for fp in batch) for batch in batches]
+    assert max(totals) - min(totals) <= 10
+    for batch in batches:
+        assert [fp.fp_in.name for fp in batch] == sorted(fp.fp_in.name for fp in batch)
+
+
+@pytest.mark.parametrize(
+    "order, expected",
+    [("listed", [0, 1, 2, 3]), ("smallest", [1, 3, 0, 2]), ("largest", [2, 0, 1, 3])],
+)
+def test_submission_order(tmp_path, order, expected):
+    """
+    Files are submitted in the requested order of their sizes, ties keep the listing order, and the
+    results are put back in the listing order
+    """
+    from types import SimpleNamespace
+
+    fps = list()
+    for idx, size in enumerate([50, 10, 90, 10]):
+        fp_in = tmp_path / f"{idx}.tif"
+        fp_in.write_bytes(b"\0" * size)
+        fps.append(SimpleNamespace(fp_in=fp_in, input_bytes=None))
+
+    submitted = utils.submission_order.fn(fps, order)
+    assert submitted == expected
+    results = [fps[idx].fp_in.name for idx in submitted]
+    assert utils.listing_order(results, submitted) == [
+        "0.tif",
+        "1.tif",
+        "2.tif",
+        "3.tif",
+    ]
+
+
+def test_submission_order_unknown(tmp_path):
+    with pytest.raises(RuntimeError, match="Unknown file order"):
+        utils.submission_order.fn([], "random")
+
+
+def _gen_test_zarr(zarr_fp: Path, image) -> None:
+    """
+    Writes a gray-scale 2D image to a multiscale zarr in the bioformats2raw layout.
+    """
+    import zarr
+    from em_workflows.utils import neuroglancer as ng
+
+    height, width = image.shape
+    root = zarr.open_group(zarr_fp.as_posix(), mode="w")
+    root.attrs["bioformats2raw.layout"] = 3
+    pyramid = ng._StreamingPyramid(
+        root.create_group("0"), width, height, 1, [(64, 64)] * 4
+    )
+    pyramid.push(image[..., None])
+    pyramid.close()
+    root["0"].attrs["multiscales"] = ng._multiscales_attrs("test", len(pyramid.arrays))
+    root.create_group("OME").attrs["series"] = ["0"]
+    (zarr_fp / "OME" / "METADATA.ome.xml").write_text(
+        ng._ome_xml("test", width, height, 1)
+    )
+
+
+def test_neuroglancer_shader_parameters_reduced_and_cached(monkeypatch, tmp_path):
+    import numpy as np
+    import zarr
+    from pytools.HedwigZarrImages import HedwigZarrImages
+    from em_workflows.utils import neuroglancer as ng
+
+    rng = np.random.default_rng(0)
+    image = np.clip(rng.normal(120, 20, size=(512, 512)), 0, 255).astype(np.uint8)
+    zarr_fp = tmp_path / "test.zarr"
+    _gen_test_zarr(zarr_fp, image)
+
+    monkeypatch.setattr(Config, "tmp_dir", tmp_path.as_posix())
+    monkeypatch.setattr(ng, "SHADER_PARAMETERS_MIN_PIXELS", 128 * 128)
+    assert (
+        ng._select_statistics_level(
+            zarr.open_group((zarr_fp / "0").as_posix()), 128 * 128
+        )
+        == "2"
+    )
+
+    hw_image = HedwigZarrImages(zarr_fp, read_only=False)[0]
+    full_params = hw_image.neuroglancer_shader_parameters(mad_scale=5.0)
+    params = ng.neuroglancer_shader_parameters(hw_image, mad_scale=5.0)
+    assert params.keys() == full_params.keys()
+    for key, value in full_params.items():
+        if isinstance(value, list):
+            np.testing.assert_allclose(params[key], value, atol=10)
+
+    cached = zarr.open_group((zarr_fp / "0").as_posix()).attrs[
+        ng.SHADER_PARAMETERS_ATTR
+    ]
+    assert cached == {'{"mad_scale": 5.0}': params}
+    # the cached parameters are reused
+    monkeypatch.setattr(
+        ng, "_select_statistics_level", Mock(side_effect=AssertionError)
+    )
+    assert ng.neuroglancer_shader_parameters(hw_image, mad_scale=5.0) == params
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_neuroglancer_shader_parameters_assets(monkeypatch, tmp_path, sharded):
+    """
+    The parameters computed after the zarr is copied to the assets are cached in the assets zarr too
+    """
+    import numpy as np
+    import zarr
+    from pytools.HedwigZarrImages import HedwigZarrImages
+    from em_workflows.utils import neuroglancer as ng
+    from em_workflows.utils import sharding
+
+    rng = np.random.default_rng(0)
+    image = np.clip(rng.normal(120, 20, size=(256, 256)), 0, 255).astype(np.uint8)
+    zarr_fp = tmp_path / "work" / "test.zarr"
+    _gen_test_zarr(zarr_fp, image)
+    assets_fp = tmp_path / "assets" / "test.zarr"
+    if sharded:
+        sharding.shard_zarr(zarr_fp, assets_fp)
+    else:
+        shutil.copytree(zarr_fp, assets_fp)
+    monkeypatch.setattr(Config, "tmp_dir", tmp_path.as_posix())
+
+    hw_image = HedwigZarrImages(zarr_fp, read_only=False)[0]
+    params = ng.neuroglancer_shader_parameters(
+        hw_image, assets_group=assets_fp / "0", mad_scale=5.0
+    )
+
+    if sharded:
+        attrs = json.loads((assets_fp / "0" / "zarr.json").read_text())["attributes"]
+        assert "multiscales" in attrs["ome"]
+    else:
+        attrs = zarr.open_group((assets_fp / "0").as_posix(), mode="r").attrs.asdict()
+        assert "multiscales" in attrs
+    assert attrs[ng.SHADER_PARAMETERS_ATTR] == {'{"mad_scale": 5.0}': params}
+
+
+@pytest.mark.parametrize(
+    "cpus, memory_gb, input_mb, concurrent, expected",
+    [
+        (20, 256, 10240, 1, (20, 40 * 1024)),
+        (20, 64, 10240, 4, (5, 12 * 1024)),
+        (60, 256, 1, 1, (1, 40 * 1024)),
+        (4, 2, 10240, 2, (2, 2 * 1024)),
+    ],
+)
+def test_bioformats_resources(
+    monkeypatch, tmp_path, cpus, memory_gb, input_mb, concurrent, expected
+):
+    from em_workflows.utils import neuroglancer as ng
+
+    monkeypatch.setattr(ng, "_worker_resources", lambda: (cpus, memory_gb * 2**30))
+    input_fp = tmp_path / "input.czi"
+    with open(input_fp, "wb") as f:
+        f.truncate(input_mb * 2**20)
+
+    assert ng.bioformats_resources(input_fp, concurrent=concurrent) == expected
+
+
+@pytest.mark.parametrize(
+    "shape, dtype, channels, expected",
+    [
+        # large RGB slide, lower levels get the same chunks until a level fits in one
+        ((1, 20000, 16000), "uint8", 3, [(1, 1344, 1344)] * 4 + [(1, 1250, 1000)]),
+        # thin tomogram, the whole depth in each chunk
+        (
+            (40, 2048, 2048),
+            "float32",
+            1,
+            [(40, 192, 192), (20, 256, 256), (10, 384, 384), (5, 256, 256)],
+        ),
+        ((1, 301, 203), "uint8", 3, [(1, 301, 203)]),
+    ],
+)
+def test_plan_chunks(shape, dtype, channels, expected):
+    from em_workflows.utils import neuroglancer as ng
+
+    assert ng.plan_chunks(shape, dtype, channels=channels) == expected
+    assert ng.plan_chunks(shape, dtype, channels=channels, levels=1) == expected[:1]
+
+
+@pytest.mark.parametrize(
+    "dtype, speed_critical, expected",
+    [
+        ("uint8", False, ("zstd", 5, 0)),
+        ("int8", True, ("lz4", 5, 0)),
+        ("uint16", False, ("zstd", 5, 1)),
+        ("float32", False, ("zstd", 3, 1)),
+        ("float32", True, ("lz4", 5, 1)),
+        # unlisted sizes are compressed as 4-byte types
+        ("complex128", False, ("zstd", 3, 1)),
+    ],
+)
+def test_select_codec(dtype, speed_critical, expected):
+    from em_workflows.utils import neuroglancer as ng
+
+    config = ng.select_codec(dtype, speed_critical=speed_critical).get_config()
+    assert (config["cname"], config["clevel"], config["shuffle"]) == expected
+
+
+def test_read_mrc_header(tmp_path):
+    import numpy as np
+
+    header = np.zeros(256, dtype="<i4")
+    header[:4] = [300, 200, 30, 6]
+    # NSYMBT
+    header[23] = 2048
+    mrc_fp = tmp_path / "test.mrc"
+    mrc_fp.write_bytes(header.tobytes())
+
+    assert utils.read_mrc_header(mrc_fp) == utils.MrcHeader(
+        300, 200, 30, np.dtype("uint16"), 6, "<", 2048
+    )
+    # 4 bits
+    header[3] = 101
+    mrc_fp.write_bytes(header.tobytes())
+    assert utils.read_mrc_header(mrc_fp).dtype is None
+
+
+def _write_mrc(
+    fp: Path, x: int, y: int, z: int, n_bytes: int = None, mode: int = 6
+) -> None:
+    """
+    Writes a uint16 MRC file, truncated to ``n_bytes`` if given
+    """
+    import numpy as np
+
+    header = np.zeros(256, dtype="<i4")
+    header[:4] = [x, y, z, mode]
+    data = header.tobytes() + bytes(x * y * z * 2)
+    fp.write_bytes(data[:n_bytes])
+
+
+@pytest.mark.parametrize(
+    "name, workflow, error",
+    [
+        ("ok.mrc", "brt", None),
+        ("truncated.mrc", "brt", "truncated"),
+        ("packed.mrc", "brt", None),
+        ("ok.mrc", "dm", "not 2 dimensional"),
+        ("plane.mrc", "dm", None),
+        ("ok.png", "lrg_2d", None),
+        ("fake.tif", "lrg_2d", "not a tif file"),
+        ("empty.czi", "czi", "empty"),
+        ("stack", "sem", None),
+        ("empty_stack", "sem", "no tif files"),
+        ("dual.mrc", "brt", None),
+        ("single.mrc", "brt", "singleb.mrc"),
+    ],
+)
+def test_validate_input(tmp_path, name, workflow, error):
+    """
+    Bad inputs are caught by their header, size, leading bytes, and the files of stacks and dual axis pairs
+    """
+    _write_mrc(tmp_path / "ok.mrc", 30, 20, 3)
+    _write_mrc(tmp_path / "truncated.mrc", 30, 20, 3, n_bytes=2000)
+    # 4 bits, the size is not checked
+    _write_mrc(tmp_path / "packed.mrc", 30, 20, 3, n_bytes=1024 + 900, mode=101)
+    _write_mrc(tmp_path / "plane.mrc", 30, 20, 1)
+    (tmp_path / "ok.png").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(10))
+    (tmp_path / "fake.tif").write_bytes(b"<html></html>")
+    (tmp_path / "empty.czi").touch()
+    (tmp_path / "stack").mkdir()
+    (tmp_path / "stack" / "1.tif").write_bytes(b"II*\0" + bytes(10))
+    (tmp_path / "empty_stack").mkdir()
+    _write_mrc(tmp_path / "duala.mrc", 30, 20, 3)
+    _write_mrc(tmp_path / "dualb.mrc", 30, 20, 3)
+    _write_mrc(tmp_path / "singlea.mrc", 30, 20, 3)
+
+    if error is None:
+        utils.validate_input(tmp_path / name, workflow)
+    else:
+        with pytest.raises(RuntimeError, match=error):
+            utils.validate_input(tmp_path / name, workflow)
+
+
+@pytest.mark.parametrize(
+    "modes", [("hardlink",), ("symlink",), ("copy",), ("reflink", "copy")]
+)
+def test_stage_file(tmp_path, modes):
+    """
+    Inputs are staged with the first mode the filesystem allows, restaging is a no-op and leaves the source intact
+    """
+    from em_workflows.utils import staging
+
+    src = tmp_path / "Projects" / "tilt.mrc"
+    src.parent.mkdir()
+    src.write_bytes(b"tilt series")
+    working_dir = tmp_path / "work"
+    working_dir.mkdir()
+    dest = working_dir / src.name
+
+    mode = staging.stage_file(src, dest, modes)
+    assert mode in modes
+    assert dest.read_bytes() == b"tilt series"
+    assert staging.stage_file(src, dest, modes) == "staged"
+    shutil.rmtree(working_dir)
+    assert src.read_bytes() == b"tilt series"
+
+
+def test_stage_file_links(tmp_path):
+    """
+    The default modes never share writes with the original, links are recorded and a write through them fails
+    """
+    import os
+    from em_workflows.constants import BRT_STAGING_MODES
+    from em_workflows.utils import staging
+
+    src = tmp_path / "Projects" / "tilt.mrc"
+    src.parent.mkdir()
+    src.write_bytes(b"tilt series")
+    working_dir = tmp_path / "work"
+    working_dir.mkdir()
+    dest = working_dir / src.name
+
+    assert staging.stage_file(src, dest, BRT_STAGING_MODES) in BRT_STAGING_MODES
+    with open(dest, "r+b") as f:
+        f.write(b"TILT")
+    assert src.read_bytes() == b"tilt series"
+    staging.check_sources(working_dir)
+
+    dest.unlink()
+    assert staging.stage_file(src, dest, ("hardlink",)) == "hardlink"
+    staging.check_sources(working_dir)
+    stat = src.stat()
+    with open(dest, "r+b") as f:
+        f.write(b"TILT")
+    # same size, the write is caught by the modification time, whatever the clock resolution
+    os.utime(src, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    with pytest.raises(RuntimeError, match="modified through its link"):
+        staging.check_sources(working_dir)
+
+
+def test_map_pinned(prefect_test_fixture):
+    from types import SimpleNamespace
+    from prefect import flow, task, unmapped
+
+    @task
+    def add(a, b, c):
+        return a + b + c
+
+    @flow
+    def pinned_flow():
+        # no local working dirs, the tasks are not pinned
+        fps = [SimpleNamespace(worker=None)] * 3
+        return utils.map_pinned(add, fps, a=[1, 2, 3], b=unmapped(10), c=100).result()
+
+    assert pinned_flow() == [111, 112, 113]
+
+
+def test_lost_local_work_dir(
+    prefect_test_fixture, mock_nfs_mount, monkeypatch, tmp_path
+):
+    """
+    An input whose local working dir is lost with its worker is run again from its input, in the shared scratch
+    """
+    from types import SimpleNamespace
+    from em_workflows import file_path as file_path_module
+
+    monkeypatch.setattr(Config, "tmp_dir", str(tmp_path / "scratch"))
+    monkeypatch.setattr(Config, "local_tmp_dir", str(tmp_path / "local"))
+    monkeypatch.setattr(
+        file_path_module,
+        "get_worker",
+        lambda: SimpleNamespace(address="tcp://node1:8786"),
+    )
+    fp_in = tmp_path / "Projects" / "tilt.mrc"
+    fp_in.parent.mkdir()
+    fp_in.write_text("tilt series")
+    file_path = FilePath(share_name="test", input_dir=fp_in.parent, fp_in=fp_in)
+    file_path.use_local_work_dir()
+    assert file_path.worker == "tcp://node1:8786"
+    assert file_path.working_dir.parent == tmp_path / "local"
+    # the node of the worker is gone with its local disk
+    shutil.rmtree(file_path.working_dir)
+
+    @task
+    def stage(file_path):
+        shutil.copy(file_path.fp_in, file_path.working_dir)
+        return file_path
+
+    @task
+    def convert(file_path):
+        staged = file_path.working_dir / file_path.fp_in.name
+        return {"working_dir": file_path.working_dir, "input": staged.read_text()}
+
+    def pipeline(fps):
+        staged = utils.map_pinned(stage, fps, file_path=fps)
+        return utils.map_pinned(convert, fps, file_path=staged)
+
+    @flow
+    def local_flow():
+        fps = [file_path]
+        return utils.collect_callback(fps, pipeline(fps), rerun=pipeline)
+
+    [elt] = local_flow()
+    assert file_path.worker is None
+    assert elt["working_dir"] == tmp_path / "scratch" / file_path.working_dir.name
+    assert elt["input"] == "tilt series"
+    assert not (file_path.working_dir / FilePath.LOST_MARKER).exists()
+
+
+def test_stage_runner(tmp_path):
+    from types import SimpleNamespace
+    from prefect import task
+
+    @task(name="Double")
+    def double(x):
+        return 2 * x
+
+    @task(name="Broken step")
+    def broken(x):
+        raise ValueError(f"bad input {x}")
+
+    stages = utils.StageRunner(SimpleNamespace(base="test", working_dir=tmp_path))
+    assert stages.run(double, x=2) == 4
+    with pytest.raises(RuntimeError, match="Broken step failed: bad input 4"):
+        stages.run(broken, x=4)
+
+    assert [name for name, _ in stages.timings] == ["Double", "Broken step"]
+    lines = (tmp_path / "stages.log").read_text().splitlines()
+    assert [line.split("\t")[:2] for line in lines] == [
+        ["Double", "ok"],
+        ["Broken step", "failed"],
+    ]
+
+
+def test_scratch_admission(monkeypatch, tmp_path):
+    from collections import namedtuple
+    from em_workflows.utils import scratch
+
+    monkeypatch.setattr(scratch.Config, "tmp_dir", tmp_path.as_posix())
+    DiskUsage = namedtuple("DiskUsage", "total used free")
+    monkeypatch.setattr(
+        scratch.shutil, "disk_usage", lambda path: DiskUsage(10**6, 0, 150_000)
+    )
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    (first / ".intermediates" / "source.mrc").mkdir(parents=True)
+
+    # always admitted when no other input is running
+    scratch.admit(first, 200_000)
+    with pytest.raises(RuntimeError, match="Not enough scratch space"):
+        scratch.admit(second, 50_000, poll_seconds=0.01, timeout_seconds=0.05)
+
+    # the reservation no longer counts once the intermediates are released
+    (first / ".intermediates" / "source.mrc").rmdir()
+    scratch.admit(second, 50_000, poll_seconds=0.01, timeout_seconds=0.05)
+
+    # reservations of removed working dirs are dropped
+    (first / ".intermediates").rmdir()
+    first.rmdir()
+    scratch.admit(tmp_path / "third", 50_000, poll_seconds=0.01, timeout_seconds=0.05)
+    assert not (tmp_path / scratch.RESERVATIONS_DIR / "first").exists()
+
+
+def test_viewer_benchmark_replay(tmp_path):
+    import numpy as np
+    from em_workflows.benchmarks import viewer
+    from em_workflows.utils import sharding
+
+    image = np.random.default_rng(0).integers(0, 256, size=(500, 300), dtype=np.uint8)
+    zarr_fp = tmp_path / "test.zarr"
+    _gen_test_zarr(zarr_fp, image)
+
+    levels = viewer._multiscale_levels(zarr_fp)
+    assert [level.path for level in levels] == ["0/0", "0/1", "0/2", "0/3"]
+    views = list(viewer.gen_views(levels, (128, 96), pans=3))
+    # zoom in from the lowest resolution level
+    assert [path for path, _ in views] == [
+        path for path in ["0/3", "0/2", "0/1", "0/0"] for _ in range(4)
+    ]
+
+    # each chunk is fetched once
+    keys = {
+        f"{path}/" + "/".join(str(i) for i in idx)
+        for path, ranges in views
+        for idx in levels[int(path[-1])].chunk_indices(ranges)
+    }
+    fs_result = viewer.replay(levels, views, viewer.fs_fetcher(zarr_fp))
+    with viewer.LocalServer(zarr_fp) as server:
+        http_result = viewer.replay(levels, views, viewer.http_fetcher(server.url))
+    for result in (fs_result, http_result):
+        assert result["chunks"] == len(result["chunk_s"]) == len(keys)
+        assert result["missing"] == 0
+        assert len(result["view_s"]) == len(views)
+    assert (
+        fs_result["bytes"]
+        == http_result["bytes"]
+        == sum((zarr_fp / key).stat().st_size for key in keys)
+    )
+
+    # the same chunks are read from the shards of the sharded zarr
+    sharded_fp = sharding.shard_zarr(zarr_fp, tmp_path / "sharded.zarr", shard_chunks=4)
+    sharded_levels = viewer._multiscale_levels(sharded_fp)
+    assert sharded_levels[0].shards == (1, 1, 1, 128, 128)
+    with viewer.LocalServer(sharded_fp) as server:
+        sharded_result = viewer.replay(
+            sharded_levels, views, viewer.http_fetcher(server.url)
+        )
+    assert sharded_result["chunks"] == fs_result["chunks"]
+    assert sharded_result["bytes"] == fs_result["bytes"]
+    assert 0 < sharded_result["index_fetches"] < sharded_result["chunks"]
+
+
+def test_shard_zarr(tmp_path):
+    import numpy as np
+    from em_workflows.utils import sharding
+
+    image = np.random.default_rng(0).integers(0, 256, size=(500, 300), dtype=np.uint8)
+    zarr_fp = tmp_path / "test.zarr"
+    _gen_test_zarr(zarr_fp, image)
+    sharded_fp = sharding.shard_zarr(zarr_fp, tmp_path / "sharded.zarr", shard_chunks=4)
+
+    root = json.loads((sharded_fp / "zarr.json").read_text())
+    assert root["attributes"]["ome"] == {"version": "0.5", "bioformats2raw.layout": 3}
+    series = json.loads((sharded_fp / "0" / "zarr.json").read_text())
+    assert [
+        d["path"] for d in series["attributes"]["ome"]["multiscales"][0]["datasets"]
+    ] == ["0", "1", "2", "3"]
+    assert (sharded_fp / "OME" / "METADATA.ome.xml").read_text() == (
+        zarr_fp / "OME" / "METADATA.ome.xml"
+    ).read_text()
+
+    # 8 x 5 chunks of 64 x 64 in 4 x 3 shards of 2 x 2 chunks
+    meta = json.loads((sharded_fp / "0" / "0" / "zarr.json").read_text())
+    assert meta["chunk_grid"]["configuration"]["chunk_shape"] == [1, 1, 1, 128, 128]
+    shards = list((sharded_fp / "0" / "0").rglob("c/*/*/*/*/*"))
+    assert len(shards) == 12
+    # each chunk is copied to its shard, and its offset and size are in the index at the end of the shard
+    for y, x in [(0, 0), (3, 1), (7, 4)]:
+        chunk = (zarr_fp / "0" / "0" / f"0/0/0/{y}/{x}").read_bytes()
+        shard = (sharded_fp / "0" / "0" / f"c/0/0/0/{y // 2}/{x // 2}").read_bytes()
+        # 4 chunks of 16 bytes, the offset and size
+        index_nbytes = 4 * 16
+        index = np.frombuffer(shard[-index_nbytes:], dtype="<u8").reshape(2, 2, 2)
+        offset, nbytes = index[y % 2, x % 2]
+        end = offset + nbytes
+        assert shard[offset:end] == chunk
+
+
+def test_api_client_post(monkeypatch):
+    """
+    Calls share the client of the process, large bodies are gzipped if enabled, unless the API rejects them
+    """
+    import gzip
+    import json
+    import os
+    import httpx
+    from em_workflows.config import Config
+    from em_workflows.utils import api_client
+
+    received = list()
+
+    def handler(request):
+        received.append(request)
+        if (
+            request.headers.get("Content-Encoding") == "gzip"
+            and request.url.path == "/plain"
+        ):
+            return httpx.Response(400)
+        return httpx.Response(200, json={})
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(api_client, "_client", (os.getpid(), client))
+    monkeypatch.setattr(api_client, "_gzip_accepted", True)
+    files = {"files": [{"primaryFilePath": f"image_{idx}.tif"} for idx in range(1000)]}
+
+    monkeypatch.setattr(Config, "api_gzip", False)
+    assert api_client.post("https://api/callback", "token", files).is_success
+    assert "Content-Encoding" not in received[-1].headers
+    monkeypatch.setattr(Config, "api_gzip", True)
+
+    assert api_client.post(
+        "https://api/running", "token", {"status": "running"}
+    ).is_success
+    assert received[-1].headers["Authorization"] == "Bearer token"
+    assert "Content-Encoding" not in received[-1].headers
+    assert json.loads(received[-1].content) == {"status": "running"}
+
+    assert api_client.post("https://api/callback", "token", files).is_success
+    assert received[-1].headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(received[-1].content)) == files
+
+    assert api_client.post("https://api/plain", "token", files).is_success
+    assert "Content-Encoding" not in received[-1].headers
+    assert json.loads(received[-1].content) == files
+    # no longer gzipped once rejected
+    assert api_client.post("https://api/callback", "token", files).is_success
+    assert "Content-Encoding" not in received[-1].headers
+    assert api_client.get_client() is client
+
+
+def test_incremental_callback(prefect_test_fixture, monkeypatch):
+    """
+    The elements are posted by batches as the files complete, then all of them with a summary
+    """
+    from types import SimpleNamespace
+    from prefect import flow, task
+
+    bodies = list()
+
+    def post(url, token, data):
+        bodies.append(data)
+        return SimpleNamespace(
+            is_success=True, url=url, status_code=200, text="", headers={}
+        )
+
+    monkeypatch.setattr(utils.api_client, "post", post)
+
+    @task
+    def convert(name):
+        if name == "bad":
+            raise RuntimeError("unreadable")
+        return {"primaryFilePath": name, "status": "success"}
+
+    @flow
+    def incremental_flow():
+        names = ["a", "bad", "c"]
+        fps = [
+            SimpleNamespace(
+                gen_prim_fp_elt=lambda msg, name=name: dict(
+                    primaryFilePath=name, status="error"
+                )
+            )
+            for name in names
+        ]
+        incremental = utils.IncrementalCallback(
+            2, False, "token", "https://api/callback"
+        )
+        elts = utils.collect_callback(fps, convert.map(names), incremental)
+        utils.send_callback_body.fn(
+            False, elts, "token", "https://api/callback", summary=True
+        )
+        return elts
+
+    elts = incremental_flow()
+    assert [elt["status"] for elt in elts] == ["success", "error", "success"]
+    partials = [body["files"] for body in bodies if body.get("partial")]
+    assert [len(files) for files in partials] == [2, 1]
+    assert sorted(elt["primaryFilePath"] for files in partials for elt in files) == [
+        "a",
+        "bad",
+        "c",
+    ]
+    assert bodies[-1] == {"files": elts, "summary": {"files": 3, "errors": 1}}